@@ -14,21 +14,92 @@
 # OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import json
 import logging
-import boto3
 import os
+import uuid
 from datetime import datetime
+from wks_automation import aws_client
+from wks_automation.aws_client import is_throttling_error
+from wks_automation.builder_pool import BUILDER_AUTO_STOP_MINUTES, pool_from_environment
+from wks_automation.checkpoint import LEASE_CHECKPOINTS, restore
+from wks_automation.endpoint_lease import EndpointLeaseCoordinator
+from wks_automation.quality import DEFAULT_QUALITY_GATE
+from wks_automation.rollout import DEFAULT_ROLLOUT, validate_rollout
+from wks_automation.replay import traced
+from wks_automation.structured_log import bind, logged
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-WorkspacesClient = boto3.client("workspaces")
+WorkspacesClient = aws_client.client("workspaces")
 
 
+def recommend_compute_type(Objective, InstallRoutine, SkipWindowsUpdates):
+    """Asks the run history function which builder compute type suits a routine best
+
+    :param Objective: string, "cost" or "time"
+    :param InstallRoutine: list of steps
+    :param SkipWindowsUpdates: boolean
+    :return: dictionary with the Recommended compute type and the estimates compared
+    """
+
+    response = aws_client.client("lambda").invoke(
+        FunctionName=os.environ["Run_History_Function"],
+        Payload=json.dumps(
+            {
+                "Action": "recommend",
+                "Objective": Objective,
+                "Input": {
+                    "InstallRoutine": InstallRoutine or [],
+                    "SkipWindowsUpdates": SkipWindowsUpdates,
+                },
+            }
+        ),
+    )
+    if "FunctionError" in response:
+        raise RuntimeError(response["Payload"].read().decode(errors="ignore")[:500])
+    return json.loads(response["Payload"].read())
+
+
+def resume_execution(event):
+    """Rebuilds the state of a failed execution so this one continues from its checkpoint
+
+    :param event: dictionary, state machine input with the ResumeExecution name or ARN
+    :return: dictionary, state machine input at the checkpoint
+    """
+
+    State = restore(event["ResumeExecution"], event["PipelineExecution"])
+    Parameters = State["AutomationParameters"]
+
+    # Move the failed execution's lease on the automation API endpoint to this one
+    if State["Resume"]["Checkpoint"] in LEASE_CHECKPOINTS:
+        Coordinator = EndpointLeaseCoordinator(Parameters["ImageBuilderAPI"])
+        EndpointLease = Coordinator.acquire(Parameters["PipelineExecutionId"])
+        if EndpointLease["EndpointChanged"]:
+            logger.info("API endpoint enabled, API will be live in approx. 30 seconds.")
+        Coordinator.release(State["Resume"]["Execution"], disable=False)
+
+    logger.info(
+        "Resuming image builder WorkSpace %s at %s.",
+        Parameters["ImageBuilderWorkSpaceId"],
+        State["Resume"]["State"],
+    )
+    logger.info("AWS API usage: %s.", aws_client.counters.snapshot()["Totals"])
+    return State
+
+
+@logged
+@traced
 def lambda_handler(event, context):
     logger.info(
         "Beginning execution of WorkSpaces_Automation_Windows_Create_Builder function."
     )
+    aws_client.counters.reset()
+
+    # A failed execution is resumed from its newest checkpoint instead of starting over
+    if "ResumeExecution" in event:
+        return resume_execution(event)
 
     # Retrieve starting parameters from event data
     # If parameter not found, inject default values defined in Lambda function
@@ -142,6 +213,16 @@ def lambda_handler(event, context):
     else:
         BundleTags = False
 
+    if "BundleMatrix" in event:
+        BundleMatrix = event["BundleMatrix"]
+    else:
+        BundleMatrix = False
+
+    if "BundleConcurrency" in event:
+        BundleConcurrency = int(event["BundleConcurrency"])
+    else:
+        BundleConcurrency = 2
+
     if "SoftwareS3Bucket" in event:
         SoftwareS3Bucket = event["SoftwareS3Bucket"]
     else:
@@ -157,6 +238,79 @@ def lambda_handler(event, context):
     else:
         SkipWindowsUpdates = True        
 
+    # Install and reboot passes before Windows Updates stops with updates still applicable
+    if "WindowsUpdateMaxPasses" in event:
+        WindowsUpdateMaxPasses = event["WindowsUpdateMaxPasses"]
+    else:
+        WindowsUpdateMaxPasses = 3
+
+    # Execution name is injected by the state machine, used to identify this pipeline run
+    if "PipelineExecution" in event:
+        PipelineExecutionId = event["PipelineExecution"]["Name"]
+    else:
+        PipelineExecutionId = str(uuid.uuid4())
+
+    if "DiskCleanup" in event:
+        DiskCleanup = event["DiskCleanup"]
+    else:
+        DiskCleanup = False
+
+    # Fleet rollout settings, missing settings use the defaults
+    if "FleetRollout" in event and event["FleetRollout"]:
+        Problems = validate_rollout(event["FleetRollout"])
+        if Problems:
+            raise ValueError(" ".join(Problems))
+        FleetRollout = dict(DEFAULT_ROLLOUT, **event["FleetRollout"])
+    else:
+        FleetRollout = False
+
+    # Image quality gate settings, thresholds not given use the defaults
+    if "QualityGate" in event and event["QualityGate"]:
+        QualityGate = dict(event["QualityGate"])
+        for setting in ("MaxIncrease", "MinIncrease", "Limits"):
+            QualityGate[setting] = dict(DEFAULT_QUALITY_GATE[setting], **QualityGate.get(setting, {}))
+    else:
+        QualityGate = False
+
+    if "ReplicationRegions" in event:
+        ReplicationRegions = event["ReplicationRegions"]
+    else:
+        ReplicationRegions = []
+
+    if "AutoRebootIfPending" in event:
+        AutoRebootIfPending = event["AutoRebootIfPending"]
+    else:
+        AutoRebootIfPending = False
+
+    # Retry policy for failed install routine steps, False turns retries off
+    if "StepRetry" in event:
+        StepRetry = event["StepRetry"]
+    else:
+        StepRetry = {}
+
+    if "ModuleGalleryFallback" in event:
+        ModuleGalleryFallback = event["ModuleGalleryFallback"]
+    else:
+        ModuleGalleryFallback = False
+
+    if "UseBuilderPool" in event:
+        UseBuilderPool = event["UseBuilderPool"]
+    else:
+        UseBuilderPool = True
+
+    if "ProfileBuilder" in event:
+        ProfileBuilder = event["ProfileBuilder"]
+    else:
+        ProfileBuilder = False
+
+    # "cost" or "time", True is the same as "cost"
+    if "RecommendComputeType" in event and event["RecommendComputeType"]:
+        RecommendComputeType = event["RecommendComputeType"]
+        if RecommendComputeType is True:
+            RecommendComputeType = "cost"
+    else:
+        RecommendComputeType = False
+
     logger.info(
         "Checking for existing Image Builder WorkSpace for user, %s.", ImageBuilderUser
     )
@@ -168,6 +322,39 @@ def lambda_handler(event, context):
     for workspace in response["Workspaces"]:
         PreExistingBuilder = True
 
+    # An existing builder keeps its compute type, record the one it has
+    ComputeTypeRecommendation = False
+    if PreExistingBuilder:
+        ImageBuilderComputeType = workspace["WorkspaceProperties"].get(
+            "ComputeTypeName", ImageBuilderComputeType
+        )
+    elif RecommendComputeType:
+        try:
+            ComputeTypeRecommendation = recommend_compute_type(
+                RecommendComputeType, InstallRoutine, SkipWindowsUpdates
+            )
+            if ComputeTypeRecommendation["Recommended"]:
+                logger.info(
+                    "Using recommended compute type %s instead of %s.",
+                    ComputeTypeRecommendation["Recommended"],
+                    ImageBuilderComputeType,
+                )
+                ImageBuilderComputeType = ComputeTypeRecommendation["Recommended"]
+            else:
+                logger.info("No run history to recommend a compute type from.")
+        except Exception as e:
+            logger.error(e)
+            if is_throttling_error(e):
+                raise
+            logger.info("Unable to recommend a compute type, using %s.", ImageBuilderComputeType)
+
+    # Claim a stopped builder from the warm pool when the user has no WorkSpace
+    PooledBuilder = False
+    if not PreExistingBuilder and UseBuilderPool:
+        Pool = pool_from_environment()
+        if Pool and Pool.directory == ImageBuilderDirectory:
+            PooledBuilder = Pool.claim(ImageBuilderBundleId, ImageBuilderComputeType, BUILDER_AUTO_STOP_MINUTES)
+
     if PreExistingBuilder:
         ImageBuilderWorkSpaceId = workspace["WorkspaceId"]
         logger.info(
@@ -184,6 +371,25 @@ def lambda_handler(event, context):
 
         logger.info("Start command sent to %s.", ImageBuilderWorkSpaceId)
 
+    elif PooledBuilder:
+        ImageBuilderWorkSpaceId = PooledBuilder["WorkspaceId"]
+        ImageBuilderUser = PooledBuilder["UserName"]
+        logger.info(
+            "Claimed pooled WorkSpace %s for user %s.",
+            ImageBuilderWorkSpaceId,
+            ImageBuilderUser,
+        )
+
+        # Refill the pool in the background, the state machine starts the builder
+        try:
+            aws_client.client("lambda").invoke(
+                FunctionName=os.environ["Builder_Pool_Function"],
+                InvocationType="Event",
+            )
+        except Exception as e:
+            logger.error(e)
+            logger.info("Unable to start builder pool refill.")
+
     else:
         logger.info("Existing WorkSpace not found, provisioning one.")
         # Create workspace
@@ -198,7 +404,7 @@ def lambda_handler(event, context):
                                     "RootVolumeEncryptionEnabled": False,
                                     "WorkspaceProperties": {
                                             "RunningMode": "AUTO_STOP",
-                                            "RunningModeAutoStopTimeoutInMinutes": 180,
+                                            "RunningModeAutoStopTimeoutInMinutes": BUILDER_AUTO_STOP_MINUTES,
                                             "RootVolumeSizeGib": ImageBuilderRootVolumeSize,
                                             "UserVolumeSizeGib": ImageBuilderUserVolumeSize,
                                             "ComputeTypeName": ImageBuilderComputeType,
@@ -216,6 +422,9 @@ def lambda_handler(event, context):
             logger.info("WorkSpace creation in progress for, %s.", ImageBuilderWorkSpaceId)
         except Exception as e:
                 logger.error(e)
+                # Let the state machine retry throttled requests instead of failing the build
+                if is_throttling_error(e):
+                    raise
                 logger.info("Unable to deploy WorkSpace for image creation.")
                 ImageBuilderWorkSpaceId = "FAILED"
 
@@ -225,37 +434,49 @@ def lambda_handler(event, context):
     ImageName = ImageNamePrefix + dt_string
     BundleName = BundleNamePrefix + dt_string
 
-    # Check Status of default API Gateway endpoint
-    logger.info("Checking status of automation API endpoint, %s.", ImageBuilderAPI)
-    api_client = boto3.client("apigateway")
-    response = api_client.get_rest_api(restApiId=ImageBuilderAPI)
-    EndpointDisabled = response["disableExecuteApiEndpoint"]
-
-    # If API Gateway default endpoint is disabled, enable it.
-    if EndpointDisabled:
-        logger.info("API endpoint is disabled, enabling now.")
-        # Enable default endpoint
-        response = api_client.update_rest_api(
-            restApiId=ImageBuilderAPI,
-            patchOperations=[
+    # Expand the bundle matrix into one createWorkspaceBundle request per bundle. Without
+    # a matrix, a single bundle is created from the Bundle* parameters.
+    if BundleMatrix:
+        BundleRequests = []
+        for bundle in BundleMatrix:
+            ComputeType = bundle.get("ComputeType", BundleComputeType)
+            BundleRequests.append(
                 {
-                    "op": "replace",
-                    "path": "/disableExecuteApiEndpoint",
-                    "value": "False",
-                },
-            ],
-        )
-
-        logger.info("API Endpoint enabled, deploying API update.")
-        # Deploy API changes
-        response = api_client.create_deployment(
-            restApiId=ImageBuilderAPI,
-            stageName="prod",
-        )
-        logger.info("API deploy complete, API will be live in approx. 30 seconds.")
+                    "BundleName": BundleNamePrefix
+                    + "-"
+                    + bundle.get("NameSuffix", ComputeType)
+                    + dt_string,
+                    "BundleDescription": bundle.get("Description", BundleDescription),
+                    "ComputeType": {"Name": ComputeType},
+                    "RootStorage": {
+                        "Capacity": str(bundle.get("RootVolumeSize", BundleRootVolumeSize))
+                    },
+                    "UserStorage": {
+                        "Capacity": str(bundle.get("UserVolumeSize", BundleUserVolumeSize))
+                    },
+                }
+            )
     else:
-        logger.info("API endpoint is already enabled, no action required.")
-
+        BundleRequests = [
+            {
+                "BundleName": BundleName,
+                "BundleDescription": BundleDescription,
+                "ComputeType": {"Name": BundleComputeType},
+                "RootStorage": {"Capacity": str(BundleRootVolumeSize)},
+                "UserStorage": {"Capacity": str(BundleUserVolumeSize)},
+            }
+        ]
+
+    # Tag the rest of this invocation's log records with the execution and builder
+    bind(Execution=PipelineExecutionId, Builder=ImageBuilderWorkSpaceId)
+
+    # Take a lease on the automation API endpoint, enabling it if this is the first active pipeline
+    logger.info("Acquiring lease on automation API endpoint, %s.", ImageBuilderAPI)
+    EndpointLease = EndpointLeaseCoordinator(ImageBuilderAPI).acquire(PipelineExecutionId)
+    if EndpointLease["EndpointChanged"]:
+        logger.info("API endpoint enabled, API will be live in approx. 30 seconds.")
+
+    logger.info("AWS API usage: %s.", aws_client.counters.snapshot()["Totals"])
     return {
         "AutomationParameters": {
             "ImageBuilderUser": ImageBuilderUser,
@@ -284,9 +505,23 @@ def lambda_handler(event, context):
             "BundleRootVolumeSize": {"Capacity": BundleRootVolumeSize},
             "BundleUserVolumeSize": {"Capacity": BundleUserVolumeSize},
             "BundleTags": BundleTags,
+            "BundleRequests": BundleRequests,
+            "BundleConcurrency": BundleConcurrency,
             "SoftwareS3Bucket": SoftwareS3Bucket,
             "InstallRoutine": InstallRoutine,
             "SkipWindowsUpdates": SkipWindowsUpdates,
+            "WindowsUpdateMaxPasses": WindowsUpdateMaxPasses,
+            "AutoRebootIfPending": AutoRebootIfPending,
+            "StepRetry": StepRetry,
+            "ProfileBuilder": ProfileBuilder,
+            "ComputeTypeRecommendation": ComputeTypeRecommendation,
+            "ModuleGalleryFallback": ModuleGalleryFallback,
+            "ReplicationRegions": ReplicationRegions,
+            "FleetRollout": FleetRollout,
+            "QualityGate": QualityGate,
+            "DiskCleanup": DiskCleanup,
+            "PipelineExecutionId": PipelineExecutionId,
             "PreExistingBuilder": PreExistingBuilder,
+            "PooledBuilder": bool(PooledBuilder),
         }
     }
\ No newline at end of file
@@ -15,15 +15,21 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import logging
-import boto3
 import json
 import secrets
+from wks_automation import aws_client
+from wks_automation.aws_client import is_throttling_error
+from wks_automation.replay import traced
+from wks_automation.structured_log import logged
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
+@logged
+@traced
 def lambda_handler(event, context):
+    aws_client.counters.reset()
     logger.info("Querying for Image Builder security group in event data.")
     if "ImageBuilderSecurityGroup" in event["AutomationParameters"]:
         ImageBuilderSecurityGroup = event["AutomationParameters"][
@@ -61,7 +67,7 @@ def lambda_handler(event, context):
     ImageBuilderPassword = secrets.token_urlsafe(14)
     SSMParameterName = "/wks_automation/" + ImageBuilderHostname
     try:
-        ssm_client = boto3.client("ssm")
+        ssm_client = aws_client.client("ssm")
         response = ssm_client.put_parameter(
             Name=SSMParameterName,
             Description="Temporary local password for WorkSpaces automation pipeline.",
@@ -72,12 +78,13 @@ def lambda_handler(event, context):
         )
     except Exception as e:
         logger.error(e)
+        if is_throttling_error(e):
+            raise
         logger.info("Unable to complete password generation.")
 
     try:
         logger.info("Querying for WorkSpace network interface id using IP address.")
-        ec2_client = boto3.client("ec2")
-        ec2_resource = boto3.resource("ec2")
+        ec2_client = aws_client.client("ec2")
 
         response = ec2_client.describe_network_interfaces(
             Filters=[
@@ -96,8 +103,7 @@ def lambda_handler(event, context):
 
         # Get list of security groups already attached to ENI
         logger.info("Generating list of existing security groups on WorkSpace ENI.")
-        WorkspaceEni = ec2_resource.NetworkInterface(ImageBuilderNetworkInterface)
-        WorkspaceEniGroups = WorkspaceEni.groups
+        WorkspaceEniGroups = response["NetworkInterfaces"][0]["Groups"]
         WorkspaceEniSgIds = [eni.get("GroupId") for eni in WorkspaceEniGroups]
         logger.info(
             "Found %s existing security groups on WorkSpace ENI: %s.",
@@ -131,15 +137,21 @@ def lambda_handler(event, context):
                 len(WorkspaceEniSgIds),
                 WorkspaceEniSgIds,
             )
-            WorkspaceEni.modify_attribute(Groups=WorkspaceEniSgIds)
+            ec2_client.modify_network_interface_attribute(
+                NetworkInterfaceId=ImageBuilderNetworkInterface,
+                Groups=WorkspaceEniSgIds,
+            )
             logger.info("Completed attachment of security groups to WorkSpace ENI.")
         else:
             logger.error("Attempting to attach more that 5 security groups, aborting.")
 
     except Exception as e:
         logger.error(e)
+        if is_throttling_error(e):
+            raise
         logger.info("Unable to find network interface for Image Builder WorkSpace.")
 
+    logger.info("AWS API usage: %s.", aws_client.counters.snapshot()["Totals"])
     return {
         "statusCode": 200,
         "body": json.dumps("Security group succesfully updated!"),
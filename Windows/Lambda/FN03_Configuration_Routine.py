@@ -14,17 +14,35 @@
 # OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import base64
 import logging
-import boto3
 import winrm
 import time
 import botocore
 from os import path
 from botocore.exceptions import ClientError
+from wks_automation import aws_client
+from wks_automation.aws_client import ThrottlingError, is_throttling_error
+from wks_automation.profiling import start_collector, step_profile
+from wks_automation.readiness import is_transport_error, wait_until_ready
+from wks_automation.routine import (
+    PENDING_REBOOT_SCRIPT,
+    retry_delay,
+    retry_policy,
+    split_s3_url,
+    split_step,
+    step_hash,
+)
+from wks_automation.transfer import push_bytes
+from wks_automation.replay import traced
+from wks_automation.structured_log import logged
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Installer exit codes meaning success, with a reboot needed to finish
+REBOOT_EXIT_CODES = (1641, 3010)
+
 
 def create_presigned_url(bucket_name, object_name, expiration=600):
     """Generate a presigned URL to share an S3 object
@@ -35,7 +53,7 @@ def create_presigned_url(bucket_name, object_name, expiration=600):
     :return: Presigned URL as string. If error, returns None.
     """
 
-    s3_client = boto3.client("s3")
+    s3_client = aws_client.client("s3")
 
     # Confirm file exists in S3 and function has access
     logger.info("Checking for object %s in bucket %s.", object_name, bucket_name)
@@ -43,6 +61,12 @@ def create_presigned_url(bucket_name, object_name, expiration=600):
         s3_client.head_object(Bucket=bucket_name, Key=object_name)
         FileFound = True
         logger.info("Found S3 object, %s.", object_name)
+    except ThrottlingError:
+        # Still throttled after retries, record it rather than reporting a missing file
+        logger.error("S3 request throttled, skipping generation of pre-signed URL.")
+        FileFound = False
+        ErrorMessage = [object_name, 1, "S3 request throttled."]
+        InstallRoutineErrors.append(ErrorMessage)
     except botocore.exceptions.ClientError as error:
 		# If error, add to error list
         if error.response["Error"]["Code"]:
@@ -96,7 +120,7 @@ def download_http(file_url, session, dest="C:\\wks_automation\\"):
     result = session.run_ps("New-Item -Path " + dest + ' -ItemType "directory" -force')
 
     command = "Invoke-WebRequest -Uri " + file_url + " -OutFile " + destination
-    logger.info("Downloading source file from web using command: %s", command)
+    logger.debug("Downloading source file from web using command: %s", command)
     result = session.run_ps(command)
     logger.info("Return code %s.", result.status_code)
 
@@ -145,12 +169,57 @@ def download_s3(s3_url, session, dest="C:\\wks_automation\\"):
         # Download file to WorkSpace
         command = 'Invoke-WebRequest -Uri "' + S3SignedUrl + '" -OutFile ' + destination
 
-        logger.info("Downloading source files from S3 using command: %s", command)
+        logger.debug("Downloading source files from S3 using command: %s", command)
         result = session.run_ps(command)
 
         logger.info("Return code %s.", result.status_code)
 
 
+def push_file(destination, content, session):
+    """Writes a file to image builder WorkSpace over the WinRM connection
+
+    :param destination: string, full path of the file to write
+    :param content: string, the file content as text, as base64 prefixed with base64:,
+        or an s3://bucket/key URL to read it from
+    :param session: active pywinrm session
+    """
+
+    try:
+        if content.startswith("s3://"):
+            S3Bucket, S3FullPath = split_s3_url(content)
+            logger.info("Reading content for %s from %s.", destination, content)
+            response = aws_client.client("s3").get_object(Bucket=S3Bucket, Key=S3FullPath)
+            data = response["Body"].read()
+        elif content.startswith("base64:"):
+            data = base64.b64decode(content[len("base64:"):])
+        else:
+            data = content.encode("utf-8")
+    except Exception as e:
+        logger.error(e)
+        if is_throttling_error(e):
+            raise
+        logger.error("Unable to read content for %s.", destination)
+        ErrorMessage = [destination, 1, "Unable to read file content."]
+        InstallRoutineErrors.append(ErrorMessage)
+        return
+
+    try:
+        result = push_bytes(session, data, destination)
+    except Exception as e:
+        logger.error(e)
+        # Left to the step retry policy
+        if is_transport_error(e) or is_throttling_error(e):
+            raise
+        logger.error("Unable to push file, %s.", destination)
+        ErrorMessage = [destination, 1, "Unable to push file."]
+        InstallRoutineErrors.append(ErrorMessage)
+        return
+
+    if not result["Verified"]:
+        ErrorMessage = [destination, 1, "Pushed file failed SHA256 verification."]
+        InstallRoutineErrors.append(ErrorMessage)
+
+
 def run_command(command, session):
     """Runs command on image builder WorkSpace
 
@@ -159,12 +228,19 @@ def run_command(command, session):
     :param session: active pywinrm session
     :return: returns None
     """
-    logger.info("Running Command: %s", command)
+    logger.debug("Running Command: %s", command)
     result = session.run_cmd(command)
     logger.info("Return code %s.", result.status_code)
 
 	# If status code is not 0, add to error list
-    if result.status_code == 1619:
+    if result.status_code in REBOOT_EXIT_CODES:
+        logger.info("Command succeeded, reboot required.")
+        RebootRequested.append(command)
+    elif result.status_code == 1618:
+        logger.error("Another installation is in progress.")
+        ErrorMessage = [command, result.status_code, "Another installation is in progress."]
+        InstallRoutineErrors.append(ErrorMessage)
+    elif result.status_code == 1619:
         logger.error("File not found.")
         ErrorMessage = [command, result.status_code, "File not found."]
         InstallRoutineErrors.append(ErrorMessage)
@@ -186,12 +262,15 @@ def run_powershell(powershell, session):
     :return: returns None
     """
 
-    logger.info("Running PowerShell: %s", powershell)
+    logger.debug("Running PowerShell: %s", powershell)
     result = session.run_ps(powershell)
     logger.info("Return code: %s.", result.status_code)
 
 	# If status code is not 0, add to error list
-    if result.status_code != 0:
+    if result.status_code in REBOOT_EXIT_CODES:
+        logger.info("PowerShell command succeeded, reboot required.")
+        RebootRequested.append(powershell)
+    elif result.status_code != 0:
         logger.error("Error with PowerShell command.")
         ErrorMessage = [
             powershell,
@@ -204,6 +283,31 @@ def run_powershell(powershell, session):
     # logger.info("Error: %s.", result.std_err)
 
 
+def reboot_pending(session):
+    """Checks whether the image builder WorkSpace has a reboot pending
+
+    :param session: active pywinrm session
+    :return: boolean
+    """
+
+    result = session.run_ps(PENDING_REBOOT_SCRIPT)
+    return result.status_code == 0 and result.std_out.decode("utf-8", "ignore").strip() == "True"
+
+
+def reboot_builder(session):
+    """Restarts the image builder WorkSpace from inside Windows
+
+    :param session: active pywinrm session
+    :return: epoch time the reboot was started
+    """
+
+    logger.info("Rebooting image builder WorkSpace.")
+    RebootStarted = time.time()
+    result = session.run_cmd("shutdown.exe /r /f /t 5")
+    logger.info("Return code %s.", result.status_code)
+    return RebootStarted
+
+
 def get_filename(file_url):
     """Strips file name from a URL
 
@@ -219,12 +323,17 @@ def get_filename(file_url):
     return path.basename(scheme_removed)
 
 
+@logged
+@traced
 def lambda_handler(event, context):
     logger.info(
         "Beginning execution of WorkSpaces_Automation_Windows_Scripted_Install function."
     )
 
-    global InstallRoutineErrors
+    global InstallRoutineErrors, RebootRequested
+
+    RebootRequested = []
+    aws_client.counters.reset()
 
     # Start timer
     StartTime = time.time()
@@ -262,15 +371,53 @@ def lambda_handler(event, context):
     try:
         InstallRoutine = event["InstallRoutineRemaining"]["InstallRoutine"]
         InstallRoutineErrors = event["InstallRoutineRemaining"]["InstallRoutineErrors"]
+        RebootStarted = event["InstallRoutineRemaining"].get("RebootStarted", False)
+        Reboots = event["InstallRoutineRemaining"].get("Reboots", [])
+        StepTimings = event["InstallRoutineRemaining"].get("StepTimings", [])
+        StepRetry = event["InstallRoutineRemaining"].get("StepRetry", False)
 
         if InstallRoutine:
             logger.info("In-progress deployment routine found, continuing.")
+        elif not RebootStarted:
+            # Finished in the failed execution this one resumes, do not start it again
+            logger.info("Deployment routine already completed. Exiting function.")
+            return {
+                "InstallRoutine": False,
+                "InstallRoutineErrors": InstallRoutineErrors,
+                "RebootStarted": False,
+                "Reboots": Reboots,
+                "StepTimings": StepTimings,
+                "StepRetry": False,
+                "RetryDelaySeconds": 0,
+            }
     except Exception:
         logger.info("No in-progress deployment routine found.")
         InstallRoutine = False
+        RebootStarted = False
+        Reboots = []
+        StepTimings = []
+        StepRetry = False
 
-    # If no in-progress routine found, look for new one
-    if not InstallRoutine:
+    if "AutoRebootIfPending" in event["AutomationParameters"]:
+        AutoRebootIfPending = event["AutomationParameters"]["AutoRebootIfPending"]
+    else:
+        AutoRebootIfPending = False
+
+    if "ProfileBuilder" in event["AutomationParameters"]:
+        ProfileBuilder = event["AutomationParameters"]["ProfileBuilder"]
+    else:
+        ProfileBuilder = False
+
+    # Routine-wide retry policy for failed steps, steps can set their own
+    if "StepRetry" in event["AutomationParameters"]:
+        RoutineRetry = event["AutomationParameters"]["StepRetry"]
+    else:
+        RoutineRetry = None
+    RetryDelaySeconds = 0
+
+    # If no in-progress routine found, look for new one. A routine that ended with a
+    # reboot is still in progress, even with no steps left.
+    if not InstallRoutine and not RebootStarted:
         logger.info("Querying for new deployment routine in event data.")
         try:
             InstallRoutine = event["AutomationParameters"]["InstallRoutine"]
@@ -285,6 +432,11 @@ def lambda_handler(event, context):
                 return {
                     "InstallRoutine": False,
                     "InstallRoutineErrors": ["No routine provided."],
+                    "RebootStarted": False,
+                    "Reboots": [],
+                    "StepTimings": [],
+                    "StepRetry": False,
+                    "RetryDelaySeconds": 0,
                 }
         except Exception:
             InstallRoutine = False
@@ -294,6 +446,11 @@ def lambda_handler(event, context):
             return {
                 "InstallRoutine": False,
                 "InstallRoutineErrors": ["No routine provided."],
+                "RebootStarted": False,
+                "Reboots": [],
+                "StepTimings": [],
+                "StepRetry": False,
+                "RetryDelaySeconds": 0,
             }
 
     # Retrieve image builder temporary password from parameter store
@@ -303,12 +460,14 @@ def lambda_handler(event, context):
     try:
         ImageBuilderUser = "wks_automation"
         SSMParameterName = "/wks_automation/" + ImageBuilderHostname
-        ssm_client = boto3.client("ssm")
+        ssm_client = aws_client.client("ssm")
         response = ssm_client.get_parameter(Name=SSMParameterName, WithDecryption=True)
         ImageBuilderPassword = response["Parameter"]["Value"]
         logger.info("Retreival successful.")
     except Exception as e:
         logger.error(e)
+        if is_throttling_error(e):
+            raise
         logger.info("Unable to retreive temporary admin password from parameter store.")
 
     try:
@@ -323,6 +482,30 @@ def lambda_handler(event, context):
         logger.error(e2)
         logger.info("Unable to remotely connect to the image builder WorkSpace.")
 
+    # After a reboot step, wait for the builder to come back instead of a fixed sleep.
+    # If it is not back within a minute, return and let the Step Function call again.
+    if RebootStarted:
+        Readiness = wait_until_ready(
+            ImageBuilderIPAddress,
+            ImageBuilderUser,
+            ImageBuilderPassword,
+            booted_after=RebootStarted,
+        )
+        if not Readiness["Ready"]:
+            logger.info("Image builder WorkSpace is still restarting, will check again.")
+            return {
+                "InstallRoutine": InstallRoutine,
+                "InstallRoutineErrors": InstallRoutineErrors,
+                "RebootStarted": RebootStarted,
+                "Reboots": Reboots,
+                "StepTimings": StepTimings,
+                "StepRetry": StepRetry,
+                "RetryDelaySeconds": 0,
+            }
+        Reboots.append(round(time.time() - RebootStarted))
+        logger.info("Image builder WorkSpace restarted in %s seconds.", Reboots[-1])
+        RebootStarted = False
+
     # Create staging directory
     logger.info("Creating staging directory, c:\wks_automation\.")
     result = session.run_ps(
@@ -330,6 +513,10 @@ def lambda_handler(event, context):
     )
     logger.info("Return code %s.", result.status_code)
 
+    # Sample builder resource usage during the steps, for compute type recommendations
+    if ProfileBuilder:
+        ProfileBuilder = start_collector(session)
+
     if InstallRoutine:
         # Calculate elapsed time
         CurrentTime = time.time()
@@ -338,40 +525,143 @@ def lambda_handler(event, context):
         # Check if more than 10 minutes have passed and the routine is not empty
         while (ElapsedTime < 120) and (bool(InstallRoutine)):
             CurrentStep = InstallRoutine.pop(0)
+            Step, Options = split_step(CurrentStep)
+            Policy = retry_policy(Options, RoutineRetry)
+            StepStartTime = time.time()
+            ErrorCount = len(InstallRoutineErrors)
+
+            # Continue the retries of a step that failed in an earlier call
+            if StepRetry and StepRetry["Hash"] == step_hash(CurrentStep):
+                Retries = StepRetry["Retries"]
+                RetrySeconds = StepRetry["RetrySeconds"]
+            else:
+                Retries = 0
+                RetrySeconds = 0
+            StepRetry = False
 
-            logger.info("Running install routine step: %s.", CurrentStep[0])
+            # Commands are only logged at DEBUG, the step hash identifies them in the
+            # routine. Kept on every step, so long routines stay traceable when sampled.
+            logger.info(
+                "Running install routine step: %s %s.",
+                Step[0].upper(),
+                step_hash(CurrentStep),
+                extra={"sample": False},
+            )
 
-            if CurrentStep[0].casefold() == "download_s3":
-                if len(CurrentStep) > 2:
-                    download_s3(CurrentStep[1], session, CurrentStep[2])
+            # Connection failures and throttling may pass on a later attempt. Any other
+            # exception is recorded against the step, so completed steps are not run again.
+            Transient = False
+            try:
+                if Step[0].casefold() == "download_s3":
+                    if len(Step) > 2:
+                        download_s3(Step[1], session, Step[2])
+                    else:
+                        download_s3(Step[1], session)
+                elif Step[0].casefold() == "download_http":
+                    if len(Step) > 2:
+                        download_http(Step[1], session, Step[2])
+                    else:
+                        download_http(Step[1], session)
+                elif Step[0].casefold() == "push_file":
+                    push_file(Step[1], Step[2], session)
+                elif Step[0].casefold() == "run_powershell":
+                    run_powershell(Step[1], session)
+                elif Step[0].casefold() == "run_command":
+                    run_command(Step[1], session)
+                elif Step[0].casefold() == "reboot":
+                    RebootStarted = reboot_builder(session)
+                    break
                 else:
-                    download_s3(CurrentStep[1], session)
-            elif CurrentStep[0].casefold() == "download_http":
-                if len(CurrentStep) > 2:
-                    download_http(CurrentStep[1], session, CurrentStep[2])
+                    logger.error("ERROR: Unknown command")
+            except Exception as e:
+                logger.error(e)
+                Target = Step[1] if len(Step) > 1 else Step[0]
+                if is_transport_error(e) or is_throttling_error(e):
+                    Transient = Policy["TransportErrors"]
+                    ErrorMessage = [Target, 1, "Connection error: " + str(e)]
                 else:
-                    download_http(CurrentStep[1], session)
-            elif CurrentStep[0].casefold() == "run_powershell":
-                run_powershell(CurrentStep[1], session)
-            elif CurrentStep[0].casefold() == "run_command":
-                run_command(CurrentStep[1], session)
-            else:
-                logger.error("ERROR: Unknown command")
+                    ErrorMessage = [Target, 1, "Step failed: " + str(e)]
+                InstallRoutineErrors.append(ErrorMessage)
+
+            # Exit codes listed in the policy are transient, like another install running
+            StepErrors = InstallRoutineErrors[ErrorCount:]
+            if StepErrors and not Transient:
+                Transient = all(error[1] in Policy["ExitCodes"] for error in StepErrors)
+
+            # Run the step again after the retry delay, which the Step Function waits out
+            if Transient and Retries < Policy["MaxAttempts"]:
+                Retries += 1
+                RetryDelaySeconds = retry_delay(Policy, Retries)
+                RetrySeconds = round(RetrySeconds + time.time() - StepStartTime + RetryDelaySeconds, 1)
+                logger.info(
+                    "Transient failure, retry %s of %s in %s seconds.",
+                    Retries,
+                    Policy["MaxAttempts"],
+                    RetryDelaySeconds,
+                )
+                del InstallRoutineErrors[ErrorCount:]
+                InstallRoutine.insert(0, CurrentStep)
+                StepRetry = {
+                    "Hash": step_hash(CurrentStep),
+                    "Retries": Retries,
+                    "RetrySeconds": RetrySeconds,
+                    "LastError": StepErrors[-1],
+                }
+                break
+
+            # Record how long the step took, and what it used, for the run history.
+            # Duration is the last attempt, earlier attempts and waits are in RetrySeconds.
+            StepTiming = {
+                "Hash": step_hash(CurrentStep),
+                "Type": Step[0].upper(),
+                "Duration": round(time.time() - StepStartTime, 1),
+                "Status": "ERROR" if StepErrors else "OK",
+                "Attempts": Retries + 1,
+                "RetrySeconds": RetrySeconds,
+            }
+            if ProfileBuilder:
+                Profile = step_profile(session, StepStartTime, time.time())
+                if Profile:
+                    StepTiming["Profile"] = Profile
+            StepTimings.append(StepTiming)
+
+            # Reboot now if the step left a reboot pending, rather than installing the
+            # next steps on top of it
+            if AutoRebootIfPending and Step[0].casefold() in ("run_powershell", "run_command"):
+                if RebootRequested or reboot_pending(session):
+                    logger.info("Reboot pending after step, rebooting before the next step.")
+                    RebootStarted = reboot_builder(session)
+                    break
 
             # Calculate elapsed time
             CurrentTime = time.time()
             ElapsedTime = CurrentTime - StartTime
 
-    if bool(InstallRoutine):
+    logger.info("AWS API usage: %s.", aws_client.counters.snapshot()["Totals"])
+
+    if bool(InstallRoutine) or RebootStarted:
         logger.info(
             "Items still remain in deployment routine, returning to Step Function to continue."
         )
         return {
             "InstallRoutine": InstallRoutine,
             "InstallRoutineErrors": InstallRoutineErrors,
+            "RebootStarted": RebootStarted,
+            "Reboots": Reboots,
+            "StepTimings": StepTimings,
+            "StepRetry": StepRetry,
+            "RetryDelaySeconds": RetryDelaySeconds,
         }
     else:
         logger.info(
             "Completed deployment routine, returning to Step Function to move on."
         )
-        return {"InstallRoutine": False, "InstallRoutineErrors": InstallRoutineErrors}
+        return {
+            "InstallRoutine": False,
+            "InstallRoutineErrors": InstallRoutineErrors,
+            "RebootStarted": False,
+            "Reboots": Reboots,
+            "StepTimings": StepTimings,
+            "StepRetry": False,
+            "RetryDelaySeconds": 0,
+        }
@@ -15,17 +15,282 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import logging
-import boto3
+import json
+import os
+import time
 import winrm
+from wks_automation import aws_client
+from wks_automation.aws_client import is_throttling_error
+from wks_automation.poller import AdaptivePoller
+from wks_automation.readiness import wait_until_ready
+from wks_automation.replay import traced
+from wks_automation.routine import PENDING_REBOOT_SCRIPT
+from wks_automation.structured_log import logged
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Lists applicable updates and whether a reboot is already pending, as JSON
+SCAN_SCRIPT = """
+$Updates = @(Get-WindowsUpdate -MicrosoftUpdate | ForEach-Object {
+    [PSCustomObject]@{ KB = [string]$_.KB; Title = [string]$_.Title; Size = [int64]$_.MaxDownloadSize }
+})
+$RebootRequired = [bool](Get-WURebootStatus -Silent) -or
+    (Test-Path 'HKLM:\\SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\Component Based Servicing\\RebootPending') -or
+    [bool](Get-ItemProperty 'HKLM:\\SYSTEM\\CurrentControlSet\\Control\\Session Manager' -Name PendingFileRenameOperations -ErrorAction Ignore)
+ConvertTo-Json -Compress -Depth 3 -InputObject @{ Updates = $Updates; RebootRequired = $RebootRequired }
+"""
 
+# Expands a checksum-verified PSWindowsUpdate package from S3 into the module path. A
+# .nupkg file is a zip archive, so the NuGet provider is not needed to install it.
+STAGE_MODULE_SCRIPT = """
+$ProgressPreference = 'SilentlyContinue'
+$Dest = "$env:ProgramFiles\\WindowsPowerShell\\Modules\\PSWindowsUpdate\\{version}"
+if (Test-Path "$Dest\\PSWindowsUpdate.psd1") {{ 'CACHED'; exit 0 }}
+$Package = "$env:TEMP\\PSWindowsUpdate.{version}.zip"
+[Net.ServicePointManager]::SecurityProtocol = [Net.SecurityProtocolType]::Tls12
+Invoke-WebRequest -Uri '{url}' -OutFile $Package -UseBasicParsing
+if ((Get-FileHash $Package -Algorithm SHA256).Hash -ne '{sha256}') {{ Remove-Item $Package; 'CHECKSUM MISMATCH'; exit 2 }}
+Expand-Archive -Path $Package -DestinationPath $Dest -Force
+Remove-Item -LiteralPath $Package, "$Dest\\_rels", "$Dest\\package", "$Dest\\[Content_Types].xml" -Recurse -Force -ErrorAction Ignore
+'STAGED'
+"""
+
+# Each pass installs the updates found by the scan without rebooting, then writes its
+# results for the function to pick up. Invoke-WUJob runs it as a local scheduled task,
+# since the Windows Update API cannot download updates over a remote session. It is kept
+# on one line, without double quotes, to survive being passed as a task argument.
+PASS_RESULT = "C:\\Windows\\PSWindowsUpdate_pass.json"
+PASS_SCRIPT = (
+    "ipmo PSWindowsUpdate; "
+    "$Started = [DateTimeOffset]::UtcNow.ToUnixTimeSeconds(); "
+    "$Result = @(Install-WindowsUpdate -MicrosoftUpdate -AcceptAll -IgnoreReboot -Verbose); "
+    "$Result | Out-File C:\\Windows\\PSWindowsUpdate.log -Append; "
+    "ConvertTo-Json -Compress -InputObject @{{ Pass = {number}; Started = $Started; "
+    "Finished = [DateTimeOffset]::UtcNow.ToUnixTimeSeconds(); "
+    "Installed = @($Result | Where-Object {{ $_.Result -eq 'Installed' }}).Count; "
+    "Failed = @($Result | Where-Object {{ $_.Result -eq 'Failed' }}).Count }} | "
+    "Set-Content -Path '{result}'"
+)
+
+# Passes run until a scan finds no updates, at most this many per execution by default
+DEFAULT_MAX_PASSES = 3
+
+# A pass that has not written its results after this long is given up on
+PASS_TIMEOUT = 7200
+
+GALLERY_INSTALL_COMMAND = "Install-PackageProvider -Name NuGet -MinimumVersion 2.8.5.201 -Force;Install-Module -Name PSWindowsUpdate -Force"
+
+
+def stage_module(session, version, sha256, bucket, key):
+    """Installs the pinned PSWindowsUpdate module from S3, unless that version is
+    already on the image builder WorkSpace
+
+    :param session: pywinrm session
+    :param version: string
+    :param sha256: string, expected SHA256 hash of the package
+    :param bucket: string
+    :param key: string
+    :return: "Cached", "S3", or None if staging failed
+    """
+
+    try:
+        url = aws_client.client("s3").generate_presigned_url(
+            "get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=600
+        )
+        result = session.run_ps(
+            STAGE_MODULE_SCRIPT.format(version=version, sha256=sha256, url=url)
+        )
+        Output = result.std_out.decode("utf-8", "ignore").strip()
+        logger.info("Module staging returned code %s: %s.", result.status_code, Output)
+        if result.status_code == 0 and Output.endswith("CACHED"):
+            return "Cached"
+        if result.status_code == 0 and Output.endswith("STAGED"):
+            return "S3"
+        logger.info(result.std_err)
+    except Exception as e:
+        logger.error(e)
+    logger.info("Unable to stage PSWindowsUpdate %s from s3://%s/%s.", version, bucket, key)
+    return None
+
+
+def install_module(session, ModuleGalleryFallback):
+    """Makes the PSWindowsUpdate module available on the image builder WorkSpace
+
+    :param session: pywinrm session
+    :param ModuleGalleryFallback: boolean, use the PowerShell Gallery if staging fails
+    :return: dict with Source and Duration, Source is "Failed" if no module is available
+    """
+
+    StartTime = time.time()
+    Version = os.environ.get("PSWindowsUpdate_Version", "")
+    Sha256 = os.environ.get("PSWindowsUpdate_SHA256", "")
+
+    # Staging needs a pinned version and checksum, without them use the gallery as before
+    if Version and Sha256:
+        Bucket = os.environ["Default_S3Bucket"]
+        Key = "modules/PSWindowsUpdate." + Version + ".nupkg"
+        logger.info("Staging PSWindowsUpdate %s from s3://%s/%s.", Version, Bucket, Key)
+        Source = stage_module(session, Version, Sha256, Bucket, Key)
+        if not Source and not ModuleGalleryFallback:
+            Source = "Failed"
+    else:
+        logger.info("No pinned PSWindowsUpdate package configured.")
+        Source = None
+
+    # Install PSWindowsUpdate module https://www.powershellgallery.com/packages/PSWindowsUpdate/
+    if not Source:
+        logger.info("Installing PSWindowsUpdate PowerShell module from the PowerShell Gallery.")
+        result = session.run_ps(GALLERY_INSTALL_COMMAND)
+        Source = "Gallery" if result.status_code == 0 else "Failed"
+
+    Duration = round(time.time() - StartTime, 2)
+    logger.info("PSWindowsUpdate module source: %s, in %s seconds.", Source, Duration)
+    return {"Source": Source, "Duration": Duration}
+
+
+def scan_updates(session):
+    """Lists the Windows Updates that apply to the image builder WorkSpace
+
+    :param session: pywinrm session
+    :return: dict with Updates, UpdateCount, TotalSize and RebootRequired, or None if
+        the scan failed
+    """
+
+    logger.info("Scanning for applicable Windows Updates.")
+    try:
+        result = session.run_ps(SCAN_SCRIPT)
+        if result.status_code != 0:
+            logger.info("Windows Update scan returned code %s.", result.status_code)
+            logger.info(result.std_err)
+            return None
+        Scan = json.loads(result.std_out.decode("utf-8", "ignore"))
+    except Exception as e:
+        logger.error(e)
+        logger.info("Unable to scan for Windows Updates.")
+        return None
+
+    Scan["Status"] = "Complete"
+    Scan["Updates"] = Scan.get("Updates") or []
+    Scan["UpdateCount"] = len(Scan["Updates"])
+    Scan["TotalSize"] = sum(update["Size"] for update in Scan["Updates"])
+    for update in Scan["Updates"]:
+        logger.info("Update %s applies: %s, %s bytes.", update["KB"], update["Title"], update["Size"])
+    logger.info(
+        "Found %s applicable update(s), %s bytes, reboot pending: %s.",
+        Scan["UpdateCount"],
+        Scan["TotalSize"],
+        Scan["RebootRequired"],
+    )
+    return Scan
+
+
+def start_pass(session, ImageBuilderHostname, number):
+    """Starts an update pass on the image builder WorkSpace
+
+    :param session: pywinrm session
+    :param ImageBuilderHostname: string
+    :param number: integer, pass number
+    """
+
+    logger.info("Initiating Install-WindowsUpdate scheduled task for pass %s.", number)
+    session.run_ps("Remove-Item -Path '" + PASS_RESULT + "' -Force -ErrorAction Ignore")
+    UpdateCommand = (
+        "Invoke-WUJob -ComputerName "
+        + ImageBuilderHostname
+        + " -Script {"
+        + PASS_SCRIPT.format(number=number, result=PASS_RESULT)
+        + "} -RunNow -Confirm:$false -Verbose -ErrorAction Ignore"
+    )
+    result = session.run_ps(UpdateCommand)
+    logger.info("Return code %s.", result.status_code)
+
+
+def read_pass(session, number):
+    """Reads the results of an update pass, once it has finished
+
+    :param session: pywinrm session
+    :param number: integer, pass number
+    :return: dict with Started, Finished, Installed and Failed, or None if the pass is
+        still running
+    """
+
+    result = session.run_ps(
+        "if (Test-Path '" + PASS_RESULT + "') { Get-Content -Raw -Path '" + PASS_RESULT + "' }"
+    )
+    Output = result.std_out.decode("utf-8", "ignore").strip()
+    if result.status_code != 0 or not Output:
+        return None
+    try:
+        Result = json.loads(Output)
+    except ValueError:
+        # Still being written
+        return None
+    return Result if Result.get("Pass") == number else None
+
+
+def reboot_pending(session):
+    """Checks whether the image builder WorkSpace has a reboot pending
+
+    :param session: pywinrm session
+    :return: boolean
+    """
+
+    result = session.run_ps(PENDING_REBOOT_SCRIPT)
+    return result.status_code == 0 and result.std_out.decode("utf-8", "ignore").strip() == "True"
+
+
+def next_pass(session, ImageBuilderHostname, Scan, Passes, MaxPasses):
+    """Starts another update pass if the last scan found updates and passes remain
+
+    :param session: pywinrm session
+    :param ImageBuilderHostname: string
+    :param Scan: dict from scan_updates, or None if the scan failed
+    :param Passes: list of pass records, a record is added for a new pass
+    :param MaxPasses: integer
+    :return: tuple of status and progress, progress is None once no pass is running
+    """
+
+    if Scan is not None and not Scan["UpdateCount"]:
+        if Passes:
+            logger.info("No applicable Windows Updates remain after %s pass(es).", len(Passes))
+            return "Complete", None
+        logger.info("No applicable Windows Updates, skipping installation.")
+        return ("No Updates (Reboot Pending)" if Scan["RebootRequired"] else "No Updates"), None
+
+    # If the first scan fails, install anyway as before
+    if Scan is None and Passes:
+        return "Scan Failed", None
+
+    if len(Passes) >= MaxPasses:
+        logger.info("%s update(s) still apply after %s pass(es), stopping.", Scan["UpdateCount"], len(Passes))
+        return "Pass Limit Reached", None
+
+    Number = len(Passes) + 1
+    start_pass(session, ImageBuilderHostname, Number)
+    Passes.append(
+        {
+            "Pass": Number,
+            "UpdateCount": Scan["UpdateCount"] if Scan else None,
+            "DownloadSize": Scan["TotalSize"] if Scan else None,
+            "Updates": [update["KB"] for update in Scan["Updates"]] if Scan else [],
+            "Status": "Installing",
+            "Installed": 0,
+            "Failed": 0,
+            "InstallSeconds": 0,
+            "RebootSeconds": 0,
+        }
+    )
+    return "Installing", {"Pass": Number, "PassStarted": time.time(), "RebootStarted": False, "Delay": None}
+
+
+@logged
+@traced
 def lambda_handler(event, context):
     logger.info(
         "Beginning execution of WorkSpaces_Automation_Windows_Windows_Update function."
     )
+    aws_client.counters.reset()
 
     # Retrieve image builder hostname from event data
     logger.info(
@@ -54,12 +319,14 @@ def lambda_handler(event, context):
     try:
         ImageBuilderUser = "wks_automation"
         SSMParameterName = "/wks_automation/" + ImageBuilderHostname
-        ssm_client = boto3.client("ssm")
+        ssm_client = aws_client.client("ssm")
         response = ssm_client.get_parameter(Name=SSMParameterName, WithDecryption=True)
         ImageBuilderPassword = response["Parameter"]["Value"]
         logger.info("Retreival successful.")
     except Exception as e:
         logger.error(e)
+        if is_throttling_error(e):
+            raise
         logger.info("Unable to retreive temporary admin password from parameter store.")
 
     try:
@@ -74,26 +341,120 @@ def lambda_handler(event, context):
         logger.error(e2)
         logger.info("Unable to remotely connect to the image builder WorkSpace.")
 
-    # Install PSWindowsUpdate module https://www.powershellgallery.com/packages/PSWindowsUpdate/
-    logger.info("Loading PSWindowsUpdate PowerShell module.")
-    _result = session.run_ps(
-        "Set-ExecutionPolicy Bypass;Install-PackageProvider -Name NuGet -MinimumVersion 2.8.5.201 -Force;Install-Module -Name PSWindowsUpdate -Force"
-    )
+    if "ModuleGalleryFallback" in event["AutomationParameters"]:
+        ModuleGalleryFallback = event["AutomationParameters"]["ModuleGalleryFallback"]
+    else:
+        ModuleGalleryFallback = False
 
-    # Create Windows Update scheduled task, to remotely install updates elevated
-    logger.info("Initiating Install-WindowsUpdate scheduled task.")
-    UpdateCommand = (
-        "Invoke-WUJob -ComputerName "
-        + ImageBuilderHostname
-        + " -Script {ipmo PSWindowsUpdate; Install-WindowsUpdate -MicrosoftUpdate -AcceptAll -AutoReboot -Verbose | Out-File C:\Windows\PSWindowsUpdate.log } -RunNow -Confirm:$false -Verbose -ErrorAction Ignore"
-    )
-    _result = session.run_ps(UpdateCommand)
+    if "WindowsUpdateMaxPasses" in event["AutomationParameters"]:
+        MaxPasses = event["AutomationParameters"]["WindowsUpdateMaxPasses"]
+    else:
+        MaxPasses = DEFAULT_MAX_PASSES
+
+    # The Step Function calls again while a pass runs or the builder restarts after one
+    WindowsUpdates = event.get("WindowsUpdates") or {}
+    Progress = WindowsUpdates.get("Progress")
+    Poller = AdaptivePoller(initial=120, maximum=300)
+    NextCheckSeconds = 0
+
+    if not Progress:
+        logger.info("Loading PSWindowsUpdate PowerShell module.")
+        _result = session.run_ps("Set-ExecutionPolicy Bypass")
+        ModuleInstall = install_module(session, ModuleGalleryFallback)
+        Passes = []
+
+        # Scan first, so an already patched builder skips the install and the wait for it
+        Scan = None
+        if ModuleInstall["Source"] == "Failed":
+            logger.info("PSWindowsUpdate module is not available, skipping Windows Updates.")
+            Status = "Module Unavailable"
+        else:
+            Scan = scan_updates(session)
+            Status, Progress = next_pass(session, ImageBuilderHostname, Scan, Passes, MaxPasses)
+    else:
+        ModuleInstall = WindowsUpdates["ModuleInstall"]
+        Passes = WindowsUpdates["Passes"]
+        Scan = WindowsUpdates["Scan"] if WindowsUpdates["Scan"].get("Status") == "Complete" else None
+        Pass = Passes[-1]
+
+        if Progress["RebootStarted"]:
+            # Rescan once the builder is back, the pass may have unlocked more updates
+            Readiness = wait_until_ready(
+                ImageBuilderIPAddress,
+                ImageBuilderUser,
+                ImageBuilderPassword,
+                booted_after=Progress["RebootStarted"],
+            )
+            if Readiness["Ready"]:
+                Pass["RebootSeconds"] = round(time.time() - Progress["RebootStarted"])
+                logger.info("Image builder WorkSpace restarted in %s seconds.", Pass["RebootSeconds"])
+                Scan = scan_updates(session)
+                Status, Progress = next_pass(session, ImageBuilderHostname, Scan, Passes, MaxPasses)
+            else:
+                logger.info("Image builder WorkSpace is still restarting, will check again.")
+                Status = "Rebooting"
+                NextCheckSeconds = 30
+        else:
+            Result = read_pass(session, Progress["Pass"])
+            if Result:
+                Pass.update(
+                    {
+                        "Installed": Result["Installed"],
+                        "Failed": Result["Failed"],
+                        "InstallSeconds": Result["Finished"] - Result["Started"],
+                        "Status": "Complete",
+                    }
+                )
+                logger.info(
+                    "Pass %s installed %s update(s), %s failed, in %s seconds.",
+                    Pass["Pass"],
+                    Pass["Installed"],
+                    Pass["Failed"],
+                    Pass["InstallSeconds"],
+                )
+                if reboot_pending(session):
+                    logger.info("Rebooting image builder WorkSpace to finish pass %s.", Pass["Pass"])
+                    Progress.update({"RebootStarted": time.time(), "Delay": None})
+                    session.run_cmd("shutdown.exe /r /f /t 5")
+                    Status = "Rebooting"
+                    NextCheckSeconds = 60
+                else:
+                    Scan = scan_updates(session)
+                    Status, Progress = next_pass(session, ImageBuilderHostname, Scan, Passes, MaxPasses)
+            elif time.time() - Progress["PassStarted"] > PASS_TIMEOUT:
+                logger.info("Pass %s did not finish in %s seconds.", Pass["Pass"], PASS_TIMEOUT)
+                Pass["Status"] = "Timed Out"
+                Pass["InstallSeconds"] = round(time.time() - Progress["PassStarted"])
+                Status = "Pass Timed Out"
+                Progress = None
+            else:
+                logger.info("Pass %s is still installing.", Pass["Pass"])
+                Status = "Installing"
+
+        # Check often after a change, then back off while a pass keeps installing
+        if Status == "Installing" and Progress:
+            NextCheckSeconds = Poller.next_delay(previous=Progress["Delay"], changed=Progress["Delay"] is None)
+            Progress["Delay"] = NextCheckSeconds
+
+    if Status == "Installing" and not NextCheckSeconds:
+        NextCheckSeconds = Poller.next_delay()
+        Progress["Delay"] = NextCheckSeconds
 
-    # Return PowerShell execution policy to Windows default
-    logger.info("Resetting PowerShell ExecutionPolicy.")
-    _result = session.run_ps("Set-ExecutionPolicy RemoteSigned")
+    # Return PowerShell execution policy to Windows default once updates are done
+    if not Progress:
+        logger.info("Resetting PowerShell ExecutionPolicy.")
+        _result = session.run_ps("Set-ExecutionPolicy RemoteSigned")
 
+    logger.info("AWS API usage: %s.", aws_client.counters.snapshot()["Totals"])
     logger.info(
         "Completed WorkSpaces_Automation_Windows_Windows_Updates function, returning to Step Function."
     )
-    return {"Method": "Windows Updates Script", "Status": "Complete"}
+    return {
+        "Method": "Windows Updates Script",
+        "Status": Status,
+        "Scan": Scan if Scan is not None else {"Status": "Failed"},
+        "ModuleInstall": ModuleInstall,
+        "Passes": Passes,
+        "Progress": Progress or False,
+        "NextCheckSeconds": NextCheckSeconds,
+    }
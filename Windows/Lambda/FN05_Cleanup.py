@@ -15,14 +15,181 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import logging
-import boto3
 import winrm
+import time
+from concurrent.futures import ThreadPoolExecutor
+from wks_automation import aws_client
+from wks_automation.aws_client import is_throttling_error
+from wks_automation.endpoint_lease import EndpointLeaseCoordinator
+from wks_automation.profiling import PROFILE_TASK, STOP_SCRIPT
+from wks_automation.replay import traced
+from wks_automation.structured_log import logged
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# PowerShell used by the optional disk cleanup phase. Removes temporary files and the
+# Windows Update download cache so they are not captured into the image.
+DISK_CLEANUP_SCRIPT = (
+    "Remove-Item -Path $env:windir\\Temp\\*, $env:windir\\SoftwareDistribution\\Download\\*, "
+    "C:\\Users\\*\\AppData\\Local\\Temp\\* -Recurse -Force -ErrorAction SilentlyContinue;"
+    "Clear-RecycleBin -Force -ErrorAction SilentlyContinue"
+)
 
+
+def timed_action(name, action, *args):
+    """Runs a single cleanup action and records its duration and outcome
+
+    :param name: string, name of the action reported in the results
+    :param action: function to run
+    :param args: arguments passed to the action
+    :return: dictionary with the action name, status, duration in seconds and detail
+    """
+
+    logger.info("Starting cleanup action, %s.", name)
+    StartTime = time.time()
+    try:
+        Detail = action(*args)
+        Status = "Succeeded"
+    except Exception as e:
+        logger.error(e)
+        Detail = str(e)
+        Status = "Failed"
+
+    Duration = round(time.time() - StartTime, 2)
+    logger.info("Cleanup action %s %s in %s seconds.", name, Status.lower(), Duration)
+    return {"Action": name, "Status": Status, "Duration": Duration, "Detail": Detail}
+
+
+def run_builder_ps(session, command):
+    """Runs PowerShell on the image builder and raises on a non-zero return code
+
+    :param session: active pywinrm session
+    :param command: string
+    :return: standard output of the command as string
+    """
+
+    result = session.run_ps(command)
+    if result.status_code != 0:
+        raise RuntimeError(
+            "Return code " + str(result.status_code) + ": " + result.std_err.decode(errors="ignore")[:500]
+        )
+    return result.std_out.decode(errors="ignore").strip()
+
+
+def run_builder_cmd(session, command):
+    """Runs a command prompt command on the image builder and raises on a non-zero return code
+
+    :param session: active pywinrm session
+    :param command: string
+    :return: returns None
+    """
+
+    result = session.run_cmd(command)
+    if result.status_code != 0:
+        raise RuntimeError("Return code " + str(result.status_code) + ".")
+
+
+def get_free_space(session):
+    """Returns the free space of the C: drive on the image builder
+
+    :param session: active pywinrm session
+    :return: free bytes as integer
+    """
+
+    return int(run_builder_ps(session, "(Get-PSDrive -Name C).Free"))
+
+
+def cleanup_builder(session, DiskCleanup, ProfileBuilder=False):
+    """Runs the builder-side cleanup actions over WinRM, in order
+
+    :param session: active pywinrm session
+    :param DiskCleanup: boolean, also remove temporary files and report bytes reclaimed
+    :param ProfileBuilder (optional): boolean, the profiler task was registered, and must
+        be removed before the image is captured
+    :return: list of action results
+    """
+
+    Results = []
+
+    if DiskCleanup:
+        FreeBefore = timed_action("MeasureFreeSpace", get_free_space, session)
+        Results.append(FreeBefore)
+
+    Results.append(
+        timed_action(
+            "UnregisterUpdateTask",
+            run_builder_ps,
+            session,
+            "Get-ScheduledTask -TaskName PSWindowsUpdate -ErrorAction SilentlyContinue | Unregister-ScheduledTask -Confirm:$false; "
+            + "Remove-Item -Path 'C:\\Windows\\PSWindowsUpdate_pass.json' -Force -ErrorAction Ignore",
+        )
+    )
+    StopProfiler = timed_action("StopProfiler", run_builder_ps, session, STOP_SCRIPT)
+    Results.append(StopProfiler)
+    Results.append(
+        timed_action(
+            "RemoveStagingFolder",
+            run_builder_cmd,
+            session,
+            "rmdir /s/q C:\\wks_automation\\",
+        )
+    )
+
+    if DiskCleanup:
+        DiskCleanupResult = timed_action("DiskCleanup", run_builder_ps, session, DISK_CLEANUP_SCRIPT)
+        Results.append(DiskCleanupResult)
+        FreeAfter = timed_action("MeasureFreeSpace", get_free_space, session)
+        Results.append(FreeAfter)
+
+        if FreeBefore["Status"] == "Succeeded" and FreeAfter["Status"] == "Succeeded":
+            BytesReclaimed = max(FreeAfter["Detail"] - FreeBefore["Detail"], 0)
+            logger.info("Disk cleanup reclaimed %s bytes.", BytesReclaimed)
+            DiskCleanupResult["Detail"] = {"BytesReclaimed": BytesReclaimed}
+
+    # The profiler task runs at startup as SYSTEM, it must not be captured into the image
+    if ProfileBuilder and StopProfiler["Status"] != "Succeeded":
+        raise RuntimeError(
+            "Unable to remove the " + PROFILE_TASK + " task from the image builder: "
+            + str(StopProfiler["Detail"])
+        )
+
+    return Results
+
+
+def delete_parameter(SSMParameterName):
+    """Removes the temporary local admin password from parameter store
+
+    :param SSMParameterName: string
+    :return: returns None
+    """
+
+    ssm_client = aws_client.client("ssm")
+    ssm_client.delete_parameter(Name=SSMParameterName)
+    logger.info("Parameter successfully removed.")
+
+
+def release_api(ImageBuilderAPI, PipelineExecutionId, DisableAPI):
+    """Releases this pipeline's lease on the API endpoint
+
+    The endpoint is only disabled when DisableAPI is set and no other pipeline holds a lease.
+
+    :param ImageBuilderAPI: string, REST API id
+    :param PipelineExecutionId: string
+    :param DisableAPI: boolean
+    :return: dictionary with the active lease count and whether the endpoint changed
+    """
+
+    return EndpointLeaseCoordinator(ImageBuilderAPI).release(
+        PipelineExecutionId, disable=DisableAPI
+    )
+
+
+@logged
+@traced
 def lambda_handler(event, context):
+    aws_client.counters.reset()
+
     # Retrieve image builder hostname from event data
     logger.info(
         "Querying for image builder WorkSpace IP address and hostname in event data."
@@ -78,14 +245,18 @@ def lambda_handler(event, context):
     try:
         ImageBuilderUser = "wks_automation"
         SSMParameterName = "/wks_automation/" + ImageBuilderHostname
-        ssm_client = boto3.client("ssm")
+        ssm_client = aws_client.client("ssm")
         response = ssm_client.get_parameter(Name=SSMParameterName, WithDecryption=True)
         ImageBuilderPassword = response["Parameter"]["Value"]
         logger.info("Retreival successful.")
     except Exception as e:
         logger.error(e)
+        if is_throttling_error(e):
+            raise
         logger.info("Unable to retreive temporary admin password from parameter store.")
 
+    # Without a session every builder action fails and is reported as failed
+    session = None
     try:
         # Connect to remote image builder WorkSpace using pywinrm library
         logger.info(
@@ -97,58 +268,74 @@ def lambda_handler(event, context):
     except Exception as e2:
         logger.error(e2)
 
-    logger.info("Cleanup PSUpdate Scheduled Task.")
-    _result = session.run_ps(
-        "Unregister-ScheduledTask -TaskName PSWindowsUpdate -Confirm:$false"
-    )
-
-    logger.info("Remove installation source files.")
-    _result = session.run_cmd("rmdir /s/q C:\\wks_automation\\")
-
-    logger.info("Removing temporary local admin information from parameter store.")
-    SSMParameterName = "/wks_automation/" + ImageBuilderHostname
-    try:
-        ssm_client = boto3.client("ssm")
-        response = ssm_client.delete_parameter(Name=SSMParameterName)
-        logger.info("Parameter successfully removed.")
-    except Exception as e:
-        logger.error(e)
-        logger.info("Unable to remove parameter.")
-
-    # Retrieve DisableAPI from event data
-    logger.info("Querying for DisableAPI in event data.")
+    # Retrieve DisableAPI and DiskCleanup from event data
+    logger.info("Querying for DisableAPI and DiskCleanup in event data.")
     try:
         ImageBuilderAPI = event["AutomationParameters"]["ImageBuilderAPI"]
         DisableAPI = event["AutomationParameters"]["DisableAPI"]
-        logger.info("The API, %s, will be disabled, %s.", ImageBuilderAPI, DisableAPI)
+        logger.info(
+            "The API, %s, will be disabled once no pipelines hold a lease, %s.",
+            ImageBuilderAPI,
+            DisableAPI,
+        )
     except Exception as e:
         logger.error(e)
         logger.info("Unable to find DisableAPI in event data.")
+        ImageBuilderAPI = False
+        DisableAPI = False
 
-    if DisableAPI:
-        logger.info("Disabling API default endpoint now.")
-
-        api_client = boto3.client("apigateway")
-        # Disable default endpoint
-        response = api_client.update_rest_api(
-            restApiId=ImageBuilderAPI,
-            patchOperations=[
-                {
-                    "op": "replace",
-                    "path": "/disableExecuteApiEndpoint",
-                    "value": "True",
-                },
-            ],
-        )
+    try:
+        PipelineExecutionId = event["AutomationParameters"]["PipelineExecutionId"]
+    except Exception:
+        PipelineExecutionId = "unknown"
 
-        logger.info("API endpoint disabled, deploying API update.")
-        # Deploy API changes
-        response = api_client.create_deployment(
-            restApiId=ImageBuilderAPI,
-            stageName="prod",
-        )
-        logger.info(
-            "API deploy complete, API will be unavailable in approx. 30 seconds."
-        )
+    try:
+        DiskCleanup = event["AutomationParameters"]["DiskCleanup"]
+    except Exception:
+        DiskCleanup = False
+
+    try:
+        ProfileBuilder = event["AutomationParameters"]["ProfileBuilder"]
+    except Exception:
+        ProfileBuilder = False
+
+    # The builder-side actions share one WinRM session and run in order, while the
+    # AWS-side actions do not depend on them and run alongside.
+    logger.info("Starting cleanup actions.")
+    StartTime = time.time()
+    SSMParameterName = "/wks_automation/" + ImageBuilderHostname
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        BuilderFuture = executor.submit(cleanup_builder, session, DiskCleanup, ProfileBuilder)
+        if ProfileBuilder:
+            # A profiler task that cannot be removed raises, and the retry needs the
+            # password and the lease, so they are only removed once the builder is clean
+            BuilderFuture.result()
+        AwsFutures = [
+            executor.submit(
+                timed_action, "DeleteParameter", delete_parameter, SSMParameterName
+            )
+        ]
+        if ImageBuilderAPI:
+            AwsFutures.append(
+                executor.submit(
+                    timed_action,
+                    "ReleaseAPI",
+                    release_api,
+                    ImageBuilderAPI,
+                    PipelineExecutionId,
+                    DisableAPI,
+                )
+            )
+
+        CleanupResults = BuilderFuture.result()
+        CleanupResults.extend(future.result() for future in AwsFutures)
+
+    CleanupDuration = round(time.time() - StartTime, 2)
+    logger.info("Completed cleanup actions in %s seconds.", CleanupDuration)
+    logger.info("AWS API usage: %s.", aws_client.counters.snapshot()["Totals"])
 
-    return {"ImageDescription": ImageDescription}
+    return {
+        "ImageDescription": ImageDescription,
+        "CleanupResults": CleanupResults,
+        "CleanupDuration": CleanupDuration,
+    }
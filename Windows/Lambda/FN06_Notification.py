@@ -15,21 +15,27 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import logging
-import boto3
 import json
 import textwrap
+from wks_automation import aws_client
+from wks_automation.aws_client import is_throttling_error
+from wks_automation.replay import traced
+from wks_automation.structured_log import logged
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-workspaces_client = boto3.client("workspaces")
-sns_client = boto3.client("sns")
+workspaces_client = aws_client.client("workspaces")
+sns_client = aws_client.client("sns")
 
 
+@logged
+@traced
 def lambda_handler(event, context):
     logger.info(
         "Beginning execution of WorkSpaces_Automation_Image_Notification function."
     )
+    aws_client.counters.reset()
 
     # Retrieve SNS topic ARN from event data
     if "ImageNotificationARN" in event["AutomationParameters"]:
@@ -66,6 +72,8 @@ def lambda_handler(event, context):
 
     except Exception as e:
         logger.error(e)
+        if is_throttling_error(e):
+            raise
         logger.info("Unable to query status of image.")
 
     # Get errors from configuration routine
@@ -86,7 +94,7 @@ def lambda_handler(event, context):
         InstallRoutineErrorCount = "No routine error list found"
 
     # Get AWS account number
-    AccountId = boto3.client("sts").get_caller_identity()["Account"]
+    AccountId = aws_client.client("sts").get_caller_identity()["Account"]
 
     # Get list of all parameters sent into the Lambda function from event
     FullOutput = json.dumps(event, indent=4, separators=(",", ": "), sort_keys=False)
@@ -114,27 +122,207 @@ def lambda_handler(event, context):
         AccountId,
     )
 
-    if CreateBundle:
-        logger.info("Bundle found, generating notification content.")
+    # Results from the Windows Updates step, when it ran
+    if "WindowsUpdates" in event:
+        WindowsUpdates = event["WindowsUpdates"]
+        msg = msg + textwrap.dedent(
+            """\
+            ------------------------------------------------------------------------------
+            Windows Updates:
+            ------------------------------------------------------------------------------
+            Update Status:    {0}
+            Module Source:     {1} ({2} seconds)
+            """
+        ).format(
+            WindowsUpdates["Status"],
+            WindowsUpdates["ModuleInstall"]["Source"],
+            WindowsUpdates["ModuleInstall"]["Duration"],
+        )
+        # After install passes the last scan lists the updates still applicable
+        Passes = WindowsUpdates.get("Passes", [])
+        for Pass in Passes:
+            msg = msg + "Pass {0}:  {1} update(s), {2} MB, {3} installed, {4} failed, {5}s install, {6}s reboot ({7})\n".format(
+                Pass["Pass"],
+                "unknown" if Pass["UpdateCount"] is None else Pass["UpdateCount"],
+                round((Pass["DownloadSize"] or 0) / 1048576, 1),
+                Pass["Installed"],
+                Pass["Failed"],
+                Pass["InstallSeconds"],
+                Pass["RebootSeconds"],
+                Pass["Status"],
+            )
+        Scan = WindowsUpdates["Scan"]
+        if Scan.get("Status") == "Complete":
+            msg = msg + textwrap.dedent(
+                """\
+                {0}    {1}
+                Download Size:    {2} MB
+                """
+            ).format(
+                "Updates Left: " if Passes else "Updates Found:",
+                Scan["UpdateCount"],
+                round(Scan["TotalSize"] / 1048576, 1),
+            )
+            for update in Scan["Updates"]:
+                msg = msg + "{0}  {1}\n".format(update["KB"], update["Title"])
+        msg = msg + "\n"
+
+    # Install routine steps that only passed, or failed for good, after retries
+    StepTimings = event.get("InstallRoutineRemaining", {}).get("StepTimings", [])
+    RetriedSteps = [step for step in StepTimings if step.get("Attempts", 1) > 1]
+    if RetriedSteps:
+        msg = msg + textwrap.dedent(
+            """\
+            ------------------------------------------------------------------------------
+            Retried Steps:
+            ------------------------------------------------------------------------------
+            """
+        )
+        for step in RetriedSteps:
+            msg = msg + "{0} {1}:  {2}, {3} attempts, {4} seconds retrying\n".format(
+                step["Type"], step["Hash"], step["Status"], step["Attempts"], step["RetrySeconds"]
+            )
+        msg = msg + "\n"
+
+    # Builder compute type picked from the run history, when asked for
+    Recommendation = event["AutomationParameters"].get("ComputeTypeRecommendation")
+    if Recommendation and Recommendation["Recommended"]:
+        msg = msg + textwrap.dedent(
+            """\
+            ------------------------------------------------------------------------------
+            Builder Compute Type:
+            ------------------------------------------------------------------------------
+            Recommended:       {0} (lowest {1})
+            """
+        ).format(Recommendation["Recommended"], Recommendation["Objective"])
+        for option in Recommendation["Options"]:
+            msg = msg + "{0}:  {1} seconds, {2} builder hours, cost {3}\n".format(
+                option["ComputeType"], option["WallSeconds"], option["BuilderHours"], option["Cost"]
+            )
+        msg = msg + "\n"
+
+    # Failed execution this one was resumed from, when it was resumed
+    if "Resume" in event:
+        Resume = event["Resume"]
+        msg = msg + textwrap.dedent(
+            """\
+            ------------------------------------------------------------------------------
+            Resumed Execution:
+            ------------------------------------------------------------------------------
+            Failed Execution:  {0}
+            Failed State:        {1} ({2})
+            Resumed From:     {3} checkpoint, at {4}
+
+            """
+        ).format(
+            Resume["Execution"],
+            Resume["FailedState"],
+            Resume["Error"],
+            Resume["Checkpoint"],
+            Resume["State"],
+        )
 
-        BundleName = event["BundleStatus"]["WorkspaceBundle"]["Name"]
-        BundleId = event["BundleStatus"]["WorkspaceBundle"]["BundleId"]
-        BundleType = event["BundleStatus"]["WorkspaceBundle"]["ComputeType"]["Name"]
-        RootSize = event["BundleStatus"]["WorkspaceBundle"]["RootStorage"]["Capacity"]
-        UserSize = event["BundleStatus"]["WorkspaceBundle"]["UserStorage"]["Capacity"]
+    if CreateBundle and "BundleStatus" in event:
+        # One entry per bundle created from the bundle matrix
+        BundleStatus = event["BundleStatus"]
+        if isinstance(BundleStatus, dict):
+            BundleStatus = [BundleStatus]
+        logger.info("%s bundle(s) found, generating notification content.", len(BundleStatus))
 
         msg = msg + textwrap.dedent(
             """\
             ------------------------------------------------------------------------------
             Bundle Information:
             ------------------------------------------------------------------------------
-            Bundle Name:      {0}
-            Bundle ID:            {1}
-            Bundle Type:        {2}
-            Root Vol. Size:     {3} GB
-            User Vol. Size:     {4} GB
             """
-        ).format(BundleName, BundleId, BundleType, RootSize, UserSize)
+        )
+
+        for bundle in BundleStatus:
+            WorkspaceBundle = bundle["WorkspaceBundle"]
+            BundleName = WorkspaceBundle["Name"]
+            BundleId = WorkspaceBundle["BundleId"]
+            BundleType = WorkspaceBundle["ComputeType"]["Name"]
+            RootSize = WorkspaceBundle["RootStorage"]["Capacity"]
+            UserSize = WorkspaceBundle["UserStorage"]["Capacity"]
+
+            msg = msg + textwrap.dedent(
+                """\
+                Bundle Name:      {0}
+                Bundle ID:            {1}
+                Bundle Type:        {2}
+                Root Vol. Size:     {3} GB
+                User Vol. Size:     {4} GB
+
+                """
+            ).format(BundleName, BundleId, BundleType, RootSize, UserSize)
+
+    # Fleet rollout progress, when a rollout ran
+    if "FleetRollout" in event:
+        Progress = event["FleetRollout"]["Progress"]
+        msg = msg + textwrap.dedent(
+            """\
+            ------------------------------------------------------------------------------
+            Fleet Rollout:
+            ------------------------------------------------------------------------------
+            Rollout Status:   {0}
+            Waves:                 {1} of {2}
+            Migrated:            {3} of {4}
+            Failed:                 {5}
+            Not Started:       {6}
+            Throughput:         {7} per hour over {8} min
+            """
+        ).format(
+            Progress["Status"],
+            Progress["Wave"],
+            Progress["Waves"],
+            Progress["Succeeded"],
+            Progress["Total"],
+            Progress["Failed"],
+            Progress["Remaining"],
+            Progress["PerHour"],
+            Progress["ElapsedMinutes"],
+        )
+        if "HaltReason" in Progress:
+            msg = msg + "Halted:                {0}\n".format(Progress["HaltReason"])
+        msg = msg + "\n"
+
+    # Test WorkSpace metrics, when the quality gate ran
+    if "QualityGate" in event and "Stage" in event["QualityGate"]:
+        Gate = event["QualityGate"]
+        msg = msg + textwrap.dedent(
+            """\
+            ------------------------------------------------------------------------------
+            Image Quality Gate:
+            ------------------------------------------------------------------------------
+            Result:                 {0}
+            """
+        ).format("Passed" if Gate.get("Passed") else "Failed, bundles were not created")
+        Baseline = Gate.get("Baseline") or {}
+        for metric, value in Gate.get("Metrics", {}).items():
+            msg = msg + "{0}:  {1}  (previous image: {2})\n".format(
+                metric, value, Baseline.get(metric, "none")
+            )
+        for problem in Gate.get("Problems", []):
+            msg = msg + "Problem:              {0}\n".format(problem)
+        msg = msg + "\n"
+
+    # Image copies to other Regions, when replication ran
+    if "Replication" in event:
+        msg = msg + textwrap.dedent(
+            """\
+            ------------------------------------------------------------------------------
+            Image Replication:
+            ------------------------------------------------------------------------------
+            """
+        )
+        for region in event["Replication"]["Regions"]:
+            msg = msg + "{0}:  {1}  {2}  {3}\n".format(
+                region["Region"],
+                region.get("ImageId", "-"),
+                region["State"],
+                "{0} min".format(round(region["Duration"] / 60)) if "Duration" in region else "",
+            )
+        msg = msg + "\n"
 
     msg = msg + textwrap.dedent(
         """\
@@ -157,8 +345,12 @@ def lambda_handler(event, context):
 
     except Exception as e2:
         logger.error(e2)
+        if is_throttling_error(e2):
+            raise
         MessageID = "Error"
 
+    logger.info("AWS API usage: %s.", aws_client.counters.snapshot()["Totals"])
+
     logger.info(
         "Completed WorkSpaces_Automation_Image_Notification function, returning MessageID to Step Function."
     )
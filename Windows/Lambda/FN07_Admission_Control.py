@@ -0,0 +1,71 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import logging
+import os
+from wks_automation.admission import AdmissionController
+from wks_automation.structured_log import logged
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+@logged
+def lambda_handler(event, context):
+    logger.info(
+        "Beginning execution of WorkSpaces_Automation_Windows_Admission_Control function."
+    )
+
+    Controller = AdmissionController(
+        per_directory=int(os.environ["Max_Builds_Per_Directory"]),
+        per_account=int(os.environ["Max_Builds_Per_Account"]),
+    )
+
+    # Action is "request" from the state machine before a builder is created, "release"
+    # when a pipeline finishes or fails, and "schedule" from the periodic schedule rule.
+    Action = event.get("Action", "schedule")
+    logger.info("Admission control action: %s.", Action)
+
+    if Action == "request":
+        PipelineInput = event["Input"]
+        if "ImageBuilderDirectory" in PipelineInput:
+            ImageBuilderDirectory = PipelineInput["ImageBuilderDirectory"]
+        else:
+            ImageBuilderDirectory = os.environ["Default_DirectoryId"]
+
+        if "BuildPriority" in PipelineInput:
+            BuildPriority = PipelineInput["BuildPriority"]
+        else:
+            BuildPriority = 0
+
+        Result = Controller.request(
+            PipelineInput["PipelineExecution"]["Name"],
+            ImageBuilderDirectory,
+            event["TaskToken"],
+            BuildPriority,
+        )
+    elif Action == "release":
+        Result = Controller.release(event["PipelineExecutionId"])
+    else:
+        Result = Controller.schedule()
+
+    logger.info(
+        "Admitted %s build(s), %s queued, %s active.",
+        len(Result["Admitted"]),
+        Result["QueueDepth"],
+        Result["ActiveBuilds"],
+    )
+    return Result
@@ -0,0 +1,51 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import logging
+from wks_automation import aws_client
+from wks_automation.builder_pool import pool_from_environment
+from wks_automation.structured_log import logged
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+@logged
+def lambda_handler(event, context):
+    logger.info(
+        "Beginning execution of WorkSpaces_Automation_Windows_Builder_Pool function."
+    )
+    aws_client.counters.reset()
+
+    # Invoked on a schedule, and asynchronously by FN01 after it claims a pooled builder
+    Pool = pool_from_environment()
+    if not Pool:
+        logger.info("No builder pool configured. Exiting function.")
+        return {"Pools": []}
+
+    Report = Pool.refill()
+    for pool in Report:
+        logger.info(
+            "Pool %s has %s builder(s), %s provisioning, %s idle hours costing %s.",
+            pool["Pool"],
+            pool["Size"],
+            pool["Provisioning"],
+            pool["IdleHours"],
+            pool["IdleCost"],
+        )
+
+    logger.info("AWS API usage: %s.", aws_client.counters.snapshot()["Totals"])
+    return {"Pools": Report}
@@ -0,0 +1,267 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import logging
+import os
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from wks_automation import aws_client
+from wks_automation.aws_client import is_throttling_error
+from wks_automation.rollout import validate_rollout
+from wks_automation.routine import routine_artifacts, validate_retry, validate_routine
+from wks_automation.structured_log import logged
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Security groups allowed on a WorkSpace network interface
+MAX_ENI_SECURITY_GROUPS = 5
+
+
+def check_s3_object(bucket, key):
+    """Confirms an install routine S3 object exists and is readable
+
+    :param bucket: string
+    :param key: string
+    :return: problem string, or None if the object is reachable
+    """
+
+    try:
+        aws_client.client("s3").head_object(Bucket=bucket, Key=key)
+        logger.info("Found s3://%s/%s.", bucket, key)
+        return None
+    except Exception as e:
+        logger.error(e)
+        if is_throttling_error(e):
+            raise
+        return "Unable to read s3://" + bucket + "/" + key + ": " + str(e)
+
+
+def check_http_url(url, timeout=10):
+    """Confirms an install routine download URL answers without an error
+
+    :param url: string, http or https only
+    :param timeout: integer seconds
+    :return: problem string, or None if the URL is reachable
+    """
+
+    # Some servers refuse HEAD, so fall back to requesting the first byte
+    for method, headers in (("HEAD", {}), ("GET", {"Range": "bytes=0-0"})):
+        request = urllib.request.Request(url, method=method, headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=timeout):  # nosec B310
+                logger.info("Found %s.", url)
+                return None
+        except urllib.error.HTTPError as e:
+            Problem = "Unable to download " + url + ": HTTP " + str(e.code) + "."
+            if e.code not in (403, 405, 501):
+                break
+        except Exception as e:
+            Problem = "Unable to reach " + url + ": " + str(e)
+            break
+    logger.error(Problem)
+    return Problem
+
+
+def check_directory(ImageBuilderDirectory, ImageBuilderSecurityGroup):
+    """Confirms the directory is registered and the builder security group will fit on
+    the builder network interface alongside the directory security groups
+
+    :param ImageBuilderDirectory: string
+    :param ImageBuilderSecurityGroup: string
+    :return: list of problems
+    """
+
+    Problems = []
+    try:
+        response = aws_client.client("workspaces").describe_workspace_directories(
+            DirectoryIds=[ImageBuilderDirectory]
+        )
+        if not response["Directories"]:
+            return ["Directory " + ImageBuilderDirectory + " is not registered with WorkSpaces."]
+        Directory = response["Directories"][0]
+        if Directory.get("State") != "REGISTERED":
+            Problems.append(
+                "Directory " + ImageBuilderDirectory + " is " + str(Directory.get("State")) + "."
+            )
+
+        SecurityGroups = {Directory.get("WorkspaceSecurityGroupId")}
+        SecurityGroups.add(
+            Directory.get("WorkspaceCreationProperties", {}).get("CustomSecurityGroupId")
+        )
+        SecurityGroups.add(ImageBuilderSecurityGroup)
+        SecurityGroups.discard(None)
+        if len(SecurityGroups) > MAX_ENI_SECURITY_GROUPS:
+            Problems.append(
+                "Builder WorkSpace would need " + str(len(SecurityGroups))
+                + " security groups, the limit is " + str(MAX_ENI_SECURITY_GROUPS) + "."
+            )
+    except Exception as e:
+        logger.error(e)
+        if is_throttling_error(e):
+            raise
+        Problems.append("Unable to describe directory " + ImageBuilderDirectory + ": " + str(e))
+    return Problems
+
+
+def check_security_group(ImageBuilderSecurityGroup):
+    """Confirms the builder security group exists
+
+    :param ImageBuilderSecurityGroup: string
+    :return: list of problems
+    """
+
+    try:
+        aws_client.client("ec2").describe_security_groups(
+            GroupIds=[ImageBuilderSecurityGroup]
+        )
+        return []
+    except Exception as e:
+        logger.error(e)
+        if is_throttling_error(e):
+            raise
+        return ["Unable to find security group " + ImageBuilderSecurityGroup + ": " + str(e)]
+
+
+def check_image_quota(ImageQuota):
+    """Confirms there is room for one more custom image in the Region
+
+    :param ImageQuota: integer
+    :return: list of problems
+    """
+
+    try:
+        paginator = aws_client.client("workspaces").get_paginator(
+            "describe_workspace_images"
+        )
+        ImageCount = 0
+        for page in paginator.paginate(ImageType="OWNED"):
+            ImageCount += len(page["Images"])
+        logger.info("Found %s of %s custom images.", ImageCount, ImageQuota)
+        if ImageCount >= ImageQuota:
+            return [
+                "Custom image quota reached, " + str(ImageCount) + " of "
+                + str(ImageQuota) + " images in use."
+            ]
+        return []
+    except Exception as e:
+        logger.error(e)
+        if is_throttling_error(e):
+            raise
+        return ["Unable to count custom images: " + str(e)]
+
+
+@logged
+def lambda_handler(event, context):
+    logger.info(
+        "Beginning execution of WorkSpaces_Automation_Windows_Preflight_Validation function."
+    )
+    aws_client.counters.reset()
+    StartTime = time.time()
+
+    if "ImageBuilderDirectory" in event:
+        ImageBuilderDirectory = event["ImageBuilderDirectory"]
+    else:
+        ImageBuilderDirectory = os.environ["Default_DirectoryId"]
+
+    if "ImageBuilderSecurityGroup" in event:
+        ImageBuilderSecurityGroup = event["ImageBuilderSecurityGroup"]
+    else:
+        ImageBuilderSecurityGroup = os.environ["Default_SecurityGroup"]
+
+    if "ImageNotificationARN" in event:
+        ImageNotificationARN = event["ImageNotificationARN"]
+    else:
+        ImageNotificationARN = os.environ["Default_NotificationARN"]
+
+    # Schema problems stop artifact checks, there is no reliable list of downloads
+    Problems = []
+    InstallRoutine = event.get("InstallRoutine")
+    S3Objects, Urls = [], []
+    if InstallRoutine:
+        logger.info("Validating install routine with %s step(s).", len(InstallRoutine))
+        Problems.extend(validate_routine(InstallRoutine))
+        if not Problems:
+            S3Objects, Urls = routine_artifacts(InstallRoutine)
+    else:
+        logger.info("No install routine provided, skipping routine validation.")
+
+    if "StepRetry" in event:
+        Problems.extend(validate_retry(event["StepRetry"], "StepRetry"))
+
+    if "FleetRollout" in event:
+        Problems.extend(validate_rollout(event["FleetRollout"]))
+
+    MaxPasses = event.get("WindowsUpdateMaxPasses", 3)
+    if type(MaxPasses) is not int or not 1 <= MaxPasses <= 10:
+        Problems.append(
+            "WindowsUpdateMaxPasses must be a whole number from 1 to 10, got " + str(MaxPasses) + "."
+        )
+
+    if event.get("RecommendComputeType", False) not in (True, False, "cost", "time"):
+        Problems.append(
+            "RecommendComputeType must be true, false, \"cost\" or \"time\", got "
+            + str(event["RecommendComputeType"]) + "."
+        )
+
+    # Artifact and quota checks are independent, run them all at once
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        Checks = [executor.submit(check_s3_object, bucket, key) for bucket, key in S3Objects]
+        Checks += [executor.submit(check_http_url, url) for url in Urls]
+        Checks.append(
+            executor.submit(check_directory, ImageBuilderDirectory, ImageBuilderSecurityGroup)
+        )
+        Checks.append(executor.submit(check_security_group, ImageBuilderSecurityGroup))
+        Checks.append(
+            executor.submit(check_image_quota, int(os.environ.get("Image_Quota", 40)))
+        )
+        for check in Checks:
+            Result = check.result()
+            if isinstance(Result, list):
+                Problems.extend(Result)
+            elif Result:
+                Problems.append(Result)
+
+    Duration = round(time.time() - StartTime, 2)
+    if Problems:
+        logger.info("Pre-flight validation found %s problem(s).", len(Problems))
+        for problem in Problems:
+            logger.info(problem)
+
+        # Nothing was provisioned, so the pipeline stops here and reports every problem
+        try:
+            aws_client.client("sns").publish(
+                TopicArn=ImageNotificationARN,
+                Subject="WorkSpaces Image Automation Pre-flight Validation Failed",
+                Message="Pre-flight validation found the following problems, no image "
+                "builder was created:\n\n" + "\n".join(Problems),
+            )
+            logger.info("Notification published to SNS topic.")
+        except Exception as e:
+            logger.error(e)
+            logger.info("Unable to publish pre-flight notification to SNS topic.")
+    else:
+        logger.info("Pre-flight validation passed in %s seconds.", Duration)
+
+    logger.info("AWS API usage: %s.", aws_client.counters.snapshot()["Totals"])
+    return {
+        "Valid": not Problems,
+        "Problems": Problems,
+        "ArtifactsChecked": len(S3Objects) + len(Urls),
+        "Duration": Duration,
+    }
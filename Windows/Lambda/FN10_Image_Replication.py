@@ -0,0 +1,173 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from wks_automation import aws_client
+from wks_automation.aws_client import is_throttling_error
+from wks_automation.poller import AdaptivePoller
+from wks_automation.structured_log import logged
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Image copies normally take tens of minutes, give up on a Region after this long
+REPLICATION_TIMEOUT = 6 * 3600
+
+poller = AdaptivePoller(initial=300, maximum=1800, minimum=60)
+
+
+def copy_image(Region, SourceImage, SourceRegion, ImageTags):
+    """Starts a copy of the image in one Region
+
+    :param Region: string, destination Region
+    :param SourceImage: dictionary, image from describe_workspace_images
+    :param SourceRegion: string
+    :param ImageTags: list of tag dictionaries, or False
+    :return: dictionary of the Region's replication status
+    """
+
+    Tags = [
+        {"Key": "SourceImageId", "Value": SourceImage["ImageId"]},
+        {"Key": "SourceRegion", "Value": SourceRegion},
+    ]
+    if ImageTags:
+        Tags += [tag for tag in ImageTags if tag["Key"] not in ("SourceImageId", "SourceRegion")]
+
+    Status = {"Region": Region, "Started": round(time.time())}
+    try:
+        workspaces_client = aws_client.client("workspaces", region_name=Region)
+        CopyRequest = {
+            "Name": SourceImage["Name"],
+            "SourceImageId": SourceImage["ImageId"],
+            "SourceRegion": SourceRegion,
+            "Tags": Tags,
+        }
+        if SourceImage.get("Description"):
+            CopyRequest["Description"] = SourceImage["Description"]
+        response = workspaces_client.copy_workspace_image(**CopyRequest)
+        Status["ImageId"] = response["ImageId"]
+        Status["State"] = "PENDING"
+        logger.info("Copying %s to %s as %s.", SourceImage["ImageId"], Region, Status["ImageId"])
+    except Exception as e:
+        logger.error(e)
+        if is_throttling_error(e):
+            raise
+        logger.info("Unable to start image copy to %s.", Region)
+        Status["State"] = "ERROR"
+        Status["Error"] = str(e)
+        Status["Completed"] = round(time.time())
+        Status["Duration"] = 0
+    return Status
+
+
+def check_image(Status):
+    """Refreshes the replication status of one Region
+
+    :param Status: dictionary of the Region's replication status
+    :return: dictionary of the Region's replication status
+    """
+
+    if Status["State"] in ("AVAILABLE", "ERROR", "TIMED_OUT"):
+        return Status
+
+    Status = dict(Status)
+    try:
+        workspaces_client = aws_client.client("workspaces", region_name=Status["Region"])
+        response = workspaces_client.describe_workspace_images(ImageIds=[Status["ImageId"]])
+        Image = response["Images"][0]
+        Status["State"] = Image["State"]
+        if Image["State"] == "ERROR":
+            Status["Error"] = Image.get("ErrorMessage", "Image copy failed.")
+    except Exception as e:
+        logger.error(e)
+        if is_throttling_error(e):
+            raise
+        logger.info("Unable to query image %s in %s.", Status["ImageId"], Status["Region"])
+        return Status
+
+    Now = time.time()
+    if Status["State"] not in ("AVAILABLE", "ERROR") and Now - Status["Started"] > REPLICATION_TIMEOUT:
+        Status["State"] = "TIMED_OUT"
+    if Status["State"] in ("AVAILABLE", "ERROR", "TIMED_OUT"):
+        Status["Completed"] = round(Now)
+        Status["Duration"] = round(Now - Status["Started"])
+        logger.info(
+            "Image copy to %s finished as %s after %s seconds.",
+            Status["Region"],
+            Status["State"],
+            Status["Duration"],
+        )
+    return Status
+
+
+@logged
+def lambda_handler(event, context):
+    logger.info(
+        "Beginning execution of WorkSpaces_Automation_Windows_Image_Replication function."
+    )
+    aws_client.counters.reset()
+
+    SourceRegion = os.environ["AWS_REGION"]
+    Action = event.get("Action", "status")
+
+    if Action == "start":
+        ImageId = event["ImageId"]
+        response = aws_client.client("workspaces").describe_workspace_images(
+            ImageIds=[ImageId]
+        )
+        SourceImage = response["Images"][0]
+        Regions = [region for region in event["Regions"] if region != SourceRegion]
+        logger.info("Replicating image %s to %s.", ImageId, Regions)
+
+        with ThreadPoolExecutor(max_workers=max(len(Regions), 1)) as executor:
+            RegionStatus = list(
+                executor.map(
+                    lambda region: copy_image(
+                        region, SourceImage, SourceRegion, event.get("ImageTags")
+                    ),
+                    Regions,
+                )
+            )
+        PreviousDelay = None
+        Changed = True
+    else:
+        Previous = event["Replication"]
+        with ThreadPoolExecutor(max_workers=max(len(Previous["Regions"]), 1)) as executor:
+            RegionStatus = list(executor.map(check_image, Previous["Regions"]))
+        PreviousDelay = Previous["NextPollSeconds"]
+        Changed = [region["State"] for region in RegionStatus] != [
+            region["State"] for region in Previous["Regions"]
+        ]
+
+    Complete = all(
+        region["State"] in ("AVAILABLE", "ERROR", "TIMED_OUT") for region in RegionStatus
+    )
+    NextPollSeconds = poller.next_delay(PreviousDelay, Changed)
+    logger.info(
+        "Replication %s, next check in %s seconds.",
+        "complete" if Complete else "in progress",
+        NextPollSeconds,
+    )
+
+    logger.info("AWS API usage: %s.", aws_client.counters.snapshot()["Totals"])
+    return {
+        "Regions": RegionStatus,
+        "Complete": Complete,
+        "NextPollSeconds": NextPollSeconds,
+    }
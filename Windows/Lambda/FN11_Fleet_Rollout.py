@@ -0,0 +1,80 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import logging
+import os
+from wks_automation import aws_client
+from wks_automation.poller import AdaptivePoller
+from wks_automation.rollout import FleetRollout
+from wks_automation.structured_log import logged
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+poller = AdaptivePoller(initial=300, maximum=900, minimum=60)
+
+
+@logged
+def lambda_handler(event, context):
+    logger.info(
+        "Beginning execution of WorkSpaces_Automation_Windows_Fleet_Rollout function."
+    )
+    aws_client.counters.reset()
+
+    Settings = event["Settings"]
+    Rollout = FleetRollout(
+        batch_size=Settings["BatchSize"],
+        concurrency=Settings["Concurrency"],
+        canary_size=Settings["CanarySize"],
+        max_failure_rate=Settings["MaxFailureRate"],
+    )
+
+    # Action is "start" once the new bundles exist, then "advance" until the rollout is
+    # complete or halted
+    Action = event.get("Action", "advance")
+    if Action == "start":
+        Bundles = [bundle["WorkspaceBundle"] for bundle in event["BundleStatus"]]
+        Exclude = [event["ImageBuilderId"]] + [
+            user.strip() for user in os.environ.get("Builder_Pool_Users", "").split(",") if user.strip()
+        ]
+        State = Rollout.plan(Settings["SourceBundleId"], Bundles, Settings["WorkspaceIds"], Exclude)
+        PreviousDelay = None
+    else:
+        State = event["FleetRollout"]["Rollout"]
+        PreviousDelay = event["FleetRollout"]["NextPollSeconds"]
+
+    State, Changed = Rollout.advance(State)
+
+    Progress = Rollout.report(State)
+    logger.info(
+        "Rollout %s: wave %s of %s, %s succeeded, %s failed, %s in progress, %s remaining, %s per hour.",
+        Progress["Status"],
+        Progress["Wave"],
+        Progress["Waves"],
+        Progress["Succeeded"],
+        Progress["Failed"],
+        Progress["InFlight"],
+        Progress["Remaining"],
+        Progress["PerHour"],
+    )
+
+    logger.info("AWS API usage: %s.", aws_client.counters.snapshot()["Totals"])
+    return {
+        "Rollout": State,
+        "Progress": Progress,
+        "Complete": Progress["Status"] != "IN_PROGRESS",
+        "NextPollSeconds": poller.next_delay(PreviousDelay, Changed),
+    }
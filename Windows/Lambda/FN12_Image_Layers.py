@@ -0,0 +1,72 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import json
+import logging
+import os
+from wks_automation import aws_client
+from wks_automation.layers import LayerPlanner
+from wks_automation.structured_log import logged
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+@logged
+def lambda_handler(event, context):
+    logger.info(
+        "Beginning execution of WorkSpaces_Automation_Windows_Image_Layers function."
+    )
+    aws_client.counters.reset()
+
+    Planner = LayerPlanner()
+
+    # Action is "plan" at the start of a layered build, "register_base" after the base
+    # layer is built, and "register_children" after the child layers are built
+    Action = event["Action"]
+    logger.info("Image layer action: %s.", Action)
+
+    if Action == "plan":
+        Result = Planner.plan(event["Input"])
+    elif Action == "register_base":
+        Result = Planner.register_base(event["LayerPlan"], event["BaseBuild"]["Output"])
+    else:
+        Plan = event["LayerPlan"]
+        Report = Planner.register_children(Plan, event["ChildBuilds"])
+        Result = {
+            "BaseLayer": Plan["BaseLayer"],
+            "Base": Plan["Base"],
+            "BaseCached": Plan["BaseCached"],
+            "Children": Report,
+        }
+
+        if "ImageNotificationARN" in Plan["Shared"]:
+            ImageNotificationARN = Plan["Shared"]["ImageNotificationARN"]
+        else:
+            ImageNotificationARN = os.environ["Default_NotificationARN"]
+        try:
+            aws_client.client("sns").publish(
+                TopicArn=ImageNotificationARN,
+                Subject="WorkSpaces Layered Image Build Notification",
+                Message=json.dumps(Result, indent=4, separators=(",", ": ")),
+            )
+            logger.info("Notification published to SNS topic.")
+        except Exception as e:
+            logger.error(e)
+            logger.info("Unable to publish layered build notification to SNS topic.")
+
+    logger.info("AWS API usage: %s.", aws_client.counters.snapshot()["Totals"])
+    return Result
@@ -0,0 +1,115 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import logging
+import time
+from wks_automation import aws_client
+from wks_automation.aws_client import is_throttling_error
+from wks_automation.poller import AdaptivePoller
+from wks_automation.readiness import probe
+from wks_automation.structured_log import logged
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+ImageBuilderUser = "wks_automation"
+StagingDirectory = "C:\\wks_automation"
+
+# WKS_Builder_startup.ps1 normally creates the account within a few minutes of startup
+READINESS_TIMEOUT = 1800
+
+poller = AdaptivePoller(initial=10, maximum=60, factor=1.5, minimum=5)
+
+
+@logged
+def lambda_handler(event, context):
+    logger.info(
+        "Beginning execution of WorkSpaces_Automation_Windows_Builder_Readiness function."
+    )
+    aws_client.counters.reset()
+
+    Previous = event.get("Readiness") or {}
+    FirstCheck = Previous.get("FirstCheck", round(time.time()))
+
+    ImageBuilderIPAddress = event["ImageBuilderStatus"]["Workspaces"][0]["IpAddress"]
+    ImageBuilderHostname = event["ImageBuilderStatus"]["Workspaces"][0]["ComputerName"]
+
+    # The password is stored before the reboot, the account is created after it
+    ImageBuilderPassword = None
+    try:
+        SSMParameterName = "/wks_automation/" + ImageBuilderHostname
+        response = aws_client.client("ssm").get_parameter(
+            Name=SSMParameterName, WithDecryption=True
+        )
+        ImageBuilderPassword = response["Parameter"]["Value"]
+    except Exception as e:
+        logger.error(e)
+        if is_throttling_error(e):
+            raise
+        logger.info("Unable to retreive temporary admin password from parameter store.")
+
+    if ImageBuilderPassword is None:
+        Result = {"Ready": False, "Stage": "password", "Latency": 0}
+    else:
+        Result = probe(
+            ImageBuilderIPAddress,
+            ImageBuilderUser,
+            ImageBuilderPassword,
+            staging_dir=StagingDirectory,
+        )
+
+    Waited = round(time.time()) - FirstCheck
+    TimedOut = not Result["Ready"] and Waited >= READINESS_TIMEOUT
+    NextPollSeconds = poller.next_delay(
+        Previous.get("NextPollSeconds"),
+        Result["Stage"] != Previous.get("Stage"),
+        READINESS_TIMEOUT - Waited,
+    )
+
+    if Result["Ready"]:
+        logger.info(
+            "Image builder WorkSpace %s ready after %s seconds, probe took %s seconds.",
+            ImageBuilderHostname,
+            Waited,
+            Result["Latency"],
+        )
+    elif TimedOut:
+        logger.info(
+            "Image builder WorkSpace %s not ready after %s seconds, stopped at %s.",
+            ImageBuilderHostname,
+            Waited,
+            Result["Stage"],
+        )
+    else:
+        logger.info(
+            "Image builder WorkSpace %s not ready at %s, next check in %s seconds.",
+            ImageBuilderHostname,
+            Result["Stage"],
+            NextPollSeconds,
+        )
+
+    logger.info("AWS API usage: %s.", aws_client.counters.snapshot()["Totals"])
+    return {
+        "Ready": Result["Ready"],
+        "Stage": Result["Stage"],
+        "Latency": Result["Latency"],
+        "Attempts": Previous.get("Attempts", 0) + 1,
+        "FirstCheck": FirstCheck,
+        "Waited": Waited,
+        "TimedOut": TimedOut,
+        "NextPollSeconds": NextPollSeconds,
+    }
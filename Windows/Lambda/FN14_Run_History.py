@@ -0,0 +1,125 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import json
+import logging
+import os
+from wks_automation import aws_client
+from wks_automation.history import (
+    DEFAULT_SKIP_WINDOWS_UPDATES,
+    Planner,
+    Recommender,
+    RunHistory,
+    S3RunRecords,
+    build_record,
+    stage_durations,
+)
+from wks_automation.structured_log import logged
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Kept between invocations while the Lambda environment is warm
+HistoryPath = "/tmp/wks_automation_history.sqlite"  # nosec B108
+
+
+def execution_history(ExecutionArn):
+    """Returns the events of a Step Function execution, oldest first"""
+
+    Events = []
+    paginator = aws_client.client("stepfunctions").get_paginator("get_execution_history")
+    for page in paginator.paginate(executionArn=ExecutionArn, includeExecutionData=False):
+        Events += page["events"]
+    return Events
+
+
+@logged
+def lambda_handler(event, context):
+    logger.info(
+        "Beginning execution of WorkSpaces_Automation_Windows_Run_History function."
+    )
+    aws_client.counters.reset()
+
+    Records = S3RunRecords(os.environ["Default_S3Bucket"])
+    if not os.path.exists(HistoryPath):
+        Records.download_snapshot(HistoryPath)
+    History = RunHistory(HistoryPath)
+
+    # Action is "record" at the end of a pipeline run, "plan" to estimate a proposed
+    # build, "recommend" to pick its builder compute type, and "regressions" to check an
+    # earlier run
+    Action = event.get("Action", "record")
+    logger.info("Run history action: %s.", Action)
+
+    if Action == "record":
+        Events = execution_history(event["PipelineExecution"]["Id"])
+        Record = build_record(
+            event, stage_durations(Events), Events[0]["timestamp"].timestamp()
+        )
+        Records.put(Record)
+        History.sync(Records)
+        Regressions = History.regressions(Record["Execution"])
+        Records.upload_snapshot(HistoryPath)
+        logger.info("Recorded run %s, stages %s.", Record["Execution"], Record["Stages"])
+        Result = {"Stages": Record["Stages"], "Regressions": Regressions}
+
+        if Regressions:
+            if "ImageNotificationARN" in event["AutomationParameters"]:
+                ImageNotificationARN = event["AutomationParameters"]["ImageNotificationARN"]
+            else:
+                ImageNotificationARN = os.environ["Default_NotificationARN"]
+            try:
+                aws_client.client("sns").publish(
+                    TopicArn=ImageNotificationARN,
+                    Subject="WorkSpaces Image Build Step Regression Notification",
+                    Message=json.dumps(
+                        {"Execution": Record["Execution"], "Regressions": Regressions},
+                        indent=4,
+                        separators=(",", ": "),
+                    ),
+                )
+                logger.info("Notification published to SNS topic.")
+            except Exception as e:
+                logger.error(e)
+                logger.info("Unable to publish regression notification to SNS topic.")
+    else:
+        History.sync(Records)
+        if Action == "plan":
+            Input = event["Input"]
+            Result = Planner(History).plan(
+                Input.get("InstallRoutine", []),
+                Input.get("ImageBuilderComputeType", os.environ["Default_ComputeType"]),
+                Input.get("SkipWindowsUpdates", DEFAULT_SKIP_WINDOWS_UPDATES),
+                Input.get("ImageBuilderBundleId", os.environ["Default_BundleId"]),
+            )
+        elif Action == "recommend":
+            Input = event["Input"]
+            Result = Recommender(
+                History, json.loads(os.environ.get("Compute_Type_Costs") or "null")
+            ).recommend(
+                Input.get("InstallRoutine", []),
+                event.get("Objective", "cost"),
+                Input.get("SkipWindowsUpdates", DEFAULT_SKIP_WINDOWS_UPDATES),
+            )
+            logger.info(
+                "Recommended compute type %s for %s.", Result["Recommended"], Result["Objective"]
+            )
+        else:
+            Result = History.regressions(event["Execution"])
+
+    logger.info("AWS API usage: %s.", aws_client.counters.snapshot()["Totals"])
+    return Result
@@ -0,0 +1,268 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import json
+import logging
+import time
+import winrm
+from wks_automation import aws_client
+from wks_automation.aws_client import is_throttling_error
+from wks_automation.endpoint_lease import EndpointLeaseCoordinator
+from wks_automation.quality import MEASURE_SCRIPT, SsmBaselineStore, compare
+from wks_automation.structured_log import logged
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+ImageBuilderUser = "wks_automation"
+
+# Seconds allowed for a new custom bundle to become usable
+BUNDLE_WAIT = 60
+
+
+def lease_holder(Parameters):
+    """Lease holder id for the test WorkSpace, separate from the builder's lease"""
+
+    return Parameters["PipelineExecutionId"] + "_QualityGate"
+
+
+def launch(Parameters, Image):
+    """Creates a temporary bundle from the new image and a test WorkSpace from it
+
+    :param Parameters: dictionary, AutomationParameters
+    :param Image: dictionary, the new image from describe_workspace_images
+    :return: dictionary of quality gate state
+    """
+
+    workspaces_client = aws_client.client("workspaces")
+    Gate = {"Stage": "launch", "Launched": round(time.time()), "Problems": []}
+    try:
+        # The test WorkSpace must run the startup script, so the API has to stay up
+        EndpointLeaseCoordinator(Parameters["ImageBuilderAPI"]).acquire(lease_holder(Parameters))
+        Gate["Leased"] = True
+
+        response = workspaces_client.create_workspace_bundle(
+            BundleName=("QualityGate_" + Image["Name"])[:64],
+            BundleDescription="Temporary bundle for the image quality gate.",
+            ImageId=Image["ImageId"],
+            ComputeType={"Name": Parameters["ImageBuilderComputeType"]},
+            RootStorage={"Capacity": str(Parameters["ImageBuilderRootVolumeSize"])},
+            UserStorage={"Capacity": str(Parameters["ImageBuilderUserVolumeSize"])},
+        )
+        Gate["BundleId"] = response["WorkspaceBundle"]["BundleId"]
+        logger.info("Created quality gate bundle %s.", Gate["BundleId"])
+
+        # A test WorkSpace is only launched from a bundle that is ready
+        Deadline = time.time() + BUNDLE_WAIT
+        while True:
+            response = workspaces_client.describe_workspace_bundles(BundleIds=[Gate["BundleId"]])
+            BundleState = response["Bundles"][0].get("State", "AVAILABLE")
+            if BundleState == "AVAILABLE":
+                break
+            if BundleState == "ERROR" or time.time() >= Deadline:
+                raise RuntimeError(
+                    "Quality gate bundle " + Gate["BundleId"] + " is " + BundleState
+                    + " after " + str(BUNDLE_WAIT) + " seconds."
+                )
+            time.sleep(5)
+
+        response = workspaces_client.create_workspaces(
+            Workspaces=[
+                {
+                    "DirectoryId": Parameters["ImageBuilderDirectory"],
+                    "UserName": Parameters["QualityGate"]["User"],
+                    "BundleId": Gate["BundleId"],
+                    "WorkspaceProperties": {
+                        "RunningMode": "AUTO_STOP",
+                        "RunningModeAutoStopTimeoutInMinutes": 60,
+                        "Protocols": [Parameters["ImageBuilderProtocol"]],
+                    },
+                    "Tags": [
+                        {"Key": "Automated", "Value": "True"},
+                        {"Key": "QualityGate", "Value": Image["ImageId"]},
+                    ],
+                },
+            ]
+        )
+        if response["FailedRequests"]:
+            raise RuntimeError(response["FailedRequests"][0].get("ErrorMessage", "WorkSpace creation failed."))
+        Gate["WorkspaceId"] = response["PendingRequests"][0]["WorkspaceId"]
+        logger.info("Test WorkSpace creation in progress for %s.", Gate["WorkspaceId"])
+    except Exception as e:
+        logger.error(e)
+        if is_throttling_error(e):
+            raise
+        logger.info("Unable to launch quality gate test WorkSpace.")
+        Gate["Stage"] = "failed"
+        Gate["Problems"].append("Unable to launch test WorkSpace: " + str(e))
+    return Gate
+
+
+def reboot(Gate):
+    """Reboots the test WorkSpace, the restart is the boot that is measured
+
+    :param Gate: dictionary of quality gate state
+    :return: dictionary of quality gate state
+    """
+
+    aws_client.client("workspaces").reboot_workspaces(
+        RebootWorkspaceRequests=[{"WorkspaceId": Gate["WorkspaceId"]}]
+    )
+    Gate["Stage"] = "reboot"
+    Gate["RebootRequested"] = round(time.time())
+    logger.info("Rebooted test WorkSpace %s.", Gate["WorkspaceId"])
+    return Gate
+
+
+def measure(Gate, Status, Readiness, Parameters):
+    """Collects the image metrics from the test WorkSpace and compares them with the
+    baseline of the previous image
+
+    :return: dictionary of quality gate state
+    """
+
+    Gate["Stage"] = "measure"
+    if not Readiness.get("Ready"):
+        Gate["Problems"].append(
+            "Test WorkSpace was not ready for WinRM, last check failed at " + str(Readiness.get("Stage")) + "."
+        )
+        return Gate
+
+    TestWorkspace = Status["Workspaces"][0]
+    Gate["ComputerName"] = TestWorkspace["ComputerName"]
+    ReadySeconds = round(time.time() - Gate["RebootRequested"])
+    try:
+        response = aws_client.client("ssm").get_parameter(
+            Name="/wks_automation/" + TestWorkspace["ComputerName"], WithDecryption=True
+        )
+        session = winrm.Session(
+            TestWorkspace["IpAddress"],
+            auth=(ImageBuilderUser, response["Parameter"]["Value"]),
+            read_timeout_sec=660,
+            operation_timeout_sec=640,
+        )
+        result = session.run_ps(MEASURE_SCRIPT)
+        Raw = json.loads(result.std_out.decode("utf-8", "ignore").strip())
+    except Exception as e:
+        logger.error(e)
+        if is_throttling_error(e):
+            raise
+        Gate["Problems"].append("Unable to measure test WorkSpace: " + str(e))
+        return Gate
+
+    # Without the boot performance event, time the reboot from outside
+    Gate["Metrics"] = {
+        "BootSeconds": round(Raw["BootMs"] / 1000, 1) if Raw.get("BootMs") else ReadySeconds,
+        "LogonSeconds": round(Raw["LogonMs"] / 1000, 1),
+        "StartupApps": Raw["StartupApps"],
+        "DiskUsedGB": Raw["DiskUsedGB"],
+    }
+    Gate["ReadySeconds"] = ReadySeconds
+    logger.info("Test WorkSpace metrics: %s.", Gate["Metrics"])
+
+    Store = SsmBaselineStore()
+    BaselineName = Parameters["QualityGate"].get("BaselineName") or Parameters["ImageNamePrefix"]
+    Baseline = Store.get(BaselineName)
+    Gate["Baseline"] = Baseline["Metrics"] if Baseline else None
+    Gate["Problems"] += compare(Gate["Metrics"], Gate["Baseline"], Parameters["QualityGate"])
+    Gate["Passed"] = not Gate["Problems"]
+
+    # Only an image that passes becomes the baseline for the next one
+    if Gate["Passed"]:
+        Store.put(
+            BaselineName,
+            {"ImageId": Parameters["ImageId"], "Metrics": Gate["Metrics"], "Updated": round(time.time())},
+        )
+    return Gate
+
+
+def cleanup(Gate, Parameters):
+    """Terminates the test WorkSpace, releases the API lease, and deletes the temporary
+    bundle once the WorkSpace is gone
+
+    :return: dictionary of quality gate state, with CleanedUp set when done
+    """
+
+    workspaces_client = aws_client.client("workspaces")
+    Gate.setdefault("Passed", False)
+    Gate["CleanedUp"] = False
+
+    if Gate.get("WorkspaceId") and not Gate.get("Terminated"):
+        workspaces_client.terminate_workspaces(
+            TerminateWorkspaceRequests=[{"WorkspaceId": Gate["WorkspaceId"]}]
+        )
+        Gate["Terminated"] = round(time.time())
+        logger.info("Terminating test WorkSpace %s.", Gate["WorkspaceId"])
+        if Gate.get("ComputerName"):
+            try:
+                aws_client.client("ssm").delete_parameter(Name="/wks_automation/" + Gate["ComputerName"])
+            except Exception as e:
+                logger.error(e)
+                if is_throttling_error(e):
+                    raise
+
+    # The lease is taken before the bundle and WorkSpace, release it even if they failed
+    if Gate.get("Leased") and not Gate.get("LeaseReleased"):
+        EndpointLeaseCoordinator(Parameters["ImageBuilderAPI"]).release(
+            lease_holder(Parameters), disable=Parameters["DisableAPI"]
+        )
+        Gate["LeaseReleased"] = True
+
+    if Gate.get("WorkspaceId"):
+        response = workspaces_client.describe_workspaces(WorkspaceIds=[Gate["WorkspaceId"]])
+        if response["Workspaces"] and response["Workspaces"][0]["State"] != "TERMINATED":
+            logger.info("Test WorkSpace is %s, waiting.", response["Workspaces"][0]["State"])
+            return Gate
+
+    if Gate.get("BundleId"):
+        try:
+            workspaces_client.delete_workspace_bundle(BundleId=Gate["BundleId"])
+            logger.info("Deleted quality gate bundle %s.", Gate["BundleId"])
+        except Exception as e:
+            logger.error(e)
+            if is_throttling_error(e):
+                raise
+            logger.info("Unable to delete quality gate bundle %s.", Gate["BundleId"])
+    Gate["CleanedUp"] = True
+    return Gate
+
+
+@logged
+def lambda_handler(event, context):
+    logger.info(
+        "Beginning execution of WorkSpaces_Automation_Windows_Quality_Gate function."
+    )
+    aws_client.counters.reset()
+
+    Parameters = dict(event["AutomationParameters"], ImageId=event["Image"]["ImageId"])
+
+    # Action is "launch" after the image is created, then "reboot" once the test
+    # WorkSpace is available, "measure" once it is ready, and "cleanup" until it is gone
+    Action = event["Action"]
+    logger.info("Quality gate action: %s.", Action)
+
+    if Action == "launch":
+        Gate = launch(Parameters, event["Image"])
+    elif Action == "reboot":
+        Gate = reboot(event["QualityGate"])
+    elif Action == "measure":
+        Gate = measure(event["QualityGate"], event["TestStatus"], event["Readiness"], Parameters)
+    else:
+        Gate = cleanup(event["QualityGate"], Parameters)
+
+    logger.info("AWS API usage: %s.", aws_client.counters.snapshot()["Totals"])
+    return Gate
@@ -0,0 +1,72 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import json
+import logging
+import os
+from wks_automation import aws_client
+from wks_automation.retention import DEFAULT_RETENTION, ArtifactRetention, retention_from_environment
+from wks_automation.structured_log import logged
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+@logged
+def lambda_handler(event, context):
+    logger.info(
+        "Beginning execution of WorkSpaces_Automation_Windows_Retention function."
+    )
+    aws_client.counters.reset()
+
+    # Invoked on a schedule with the stack settings. A manual invoke can override any
+    # of them, for example {"DryRun": false} or {"Prefixes": ["WKS-Win10"]}.
+    Settings = retention_from_environment()
+    Settings.update({key: value for key, value in event.items() if key in DEFAULT_RETENTION})
+    if not Settings["Prefixes"]:
+        logger.info("No retention prefixes configured. Exiting function.")
+        return {"DryRun": Settings["DryRun"], "Plan": None, "Results": None}
+
+    Retention = ArtifactRetention(Settings, protected_bundles=[os.environ["Default_BundleId"]])
+    Plan = Retention.plan()
+    Results = Retention.prune(Plan)
+    for kind in ("Images", "Bundles"):
+        logger.info(
+            "%s: keeping %s, %s %s.",
+            kind,
+            len(Plan[kind]["Keep"]),
+            "would delete" if Settings["DryRun"] else "deleting",
+            len(Plan[kind]["Delete"]),
+        )
+
+    if Plan["Images"]["Delete"] or Plan["Bundles"]["Delete"]:
+        try:
+            aws_client.client("sns").publish(
+                TopicArn=os.environ["Default_NotificationARN"],
+                Subject="WorkSpaces Image Retention Report" + (" (Dry Run)" if Settings["DryRun"] else ""),
+                Message=json.dumps(
+                    {"Settings": Settings, "Plan": Plan, "Results": Results},
+                    indent=4,
+                    separators=(",", ": "),
+                ),
+            )
+            logger.info("Notification published to SNS topic.")
+        except Exception as e:
+            logger.error(e)
+            logger.info("Unable to publish retention report to SNS topic.")
+
+    logger.info("AWS API usage: %s.", aws_client.counters.snapshot()["Totals"])
+    return {"DryRun": Settings["DryRun"], "Plan": Plan, "Results": Results}
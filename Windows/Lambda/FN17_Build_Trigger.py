@@ -0,0 +1,66 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import logging
+import os
+from wks_automation import aws_client
+from wks_automation.structured_log import logged
+from wks_automation.triggers import BUILDS_PREFIX, BuildTrigger, S3TriggerStore, s3_changes
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+@logged
+def lambda_handler(event, context):
+    logger.info(
+        "Beginning execution of WorkSpaces_Automation_Windows_Build_Trigger function."
+    )
+    aws_client.counters.reset()
+
+    Bucket = os.environ["Default_S3Bucket"]
+    Trigger = BuildTrigger(
+        S3TriggerStore(Bucket),
+        state_machine_arn=os.environ["State_Machine_Arn"],
+        debounce_minutes=os.environ.get("Trigger_Debounce_Minutes", "15"),
+        max_wait_minutes=os.environ.get("Trigger_Max_Wait_Minutes", "120"),
+    )
+
+    # Invoked by S3 object events, by the schedule rules with "flush" to start the due
+    # builds and "check_urls" to look for changed downloads, or manually with "reindex"
+    Action = event.get("Action", "changes")
+    if Action == "flush":
+        Result = Trigger.flush()
+        logger.info("Started %s build(s), %s still pending.", len(Result["Started"]), len(Result["Waiting"]))
+    elif Action == "check_urls":
+        Result = {"ChangedUrls": Trigger.check_urls()}
+    elif Action == "reindex":
+        Index = Trigger.reindex()
+        Result = {"Objects": len(Index["Objects"]), "Urls": len(Index["Urls"])}
+    else:
+        Changes = s3_changes(event)
+        Definitions = [change for change in Changes if change["Object"].startswith(Bucket + "/" + BUILDS_PREFIX)]
+        Artifacts = [change["Object"] for change in Changes if change not in Definitions and not change["Deleted"]]
+
+        # A changed build definition only updates the index, it does not start a build
+        if Definitions:
+            logger.info("Build definitions changed, rebuilding the artifact index.")
+            Trigger.reindex()
+        Result = {"Pending": Trigger.record(Artifacts) if Artifacts else []}
+
+    logger.info("AWS API usage: %s.", aws_client.counters.snapshot()["Totals"])
+    return Result
@@ -0,0 +1,56 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Shared fixtures for the wks_automation tests. AWS clients are ThrottlingStubClient
+instances wrapped in RateLimitedClient, so no call leaves the test process."""
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+from wks_automation import aws_client  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def reset_aws_client(monkeypatch):
+    """Gives every test its own token buckets and counters, and no throttle backoff"""
+
+    monkeypatch.setattr(aws_client, "_buckets", {})
+    monkeypatch.setattr(aws_client, "THROTTLE_BACKOFF_CAP", 0.0)
+    aws_client.counters.reset()
+    yield
+    aws_client.counters.reset()
+
+
+@pytest.fixture
+def stub_client():
+    """Returns a function creating a rate limited client over ThrottlingStubClient
+
+    :param service: string, boto3 service name
+    :param responses (optional): dictionary of method name to response or function
+    :param throttle_first (optional): number of calls to each method that are throttled
+    :return: RateLimitedClient, with the stub as its _client
+    """
+
+    def create(service, responses=None, throttle_first=0, throttle_rate=0.0):
+        Stub = aws_client.ThrottlingStubClient(responses, throttle_first, throttle_rate, seed=1)
+        return aws_client.RateLimitedClient(Stub, service, rates={service: 1000.0})
+
+    return create
@@ -0,0 +1,167 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import threading
+import time
+import pytest
+from botocore.exceptions import ClientError
+from wks_automation.admission import ACCOUNT_POOL, AdmissionController, LocalSlotStore
+
+
+class FakeStepFunctions:
+    """Records the task tokens resumed through the stubbed send_task_success. Tokens in
+    gone belong to executions that were stopped and fail to resume."""
+
+    def __init__(self, gone=()):
+        self.resumed = []
+        self.gone = set(gone)
+        self.lock = threading.Lock()
+
+    def send_task_success(self, taskToken, output):
+        if taskToken in self.gone:
+            raise ClientError(
+                {"Error": {"Code": "TaskTimedOut", "Message": "Task Timed Out"}},
+                "SendTaskSuccess",
+            )
+        with self.lock:
+            self.resumed.append(taskToken)
+        return {}
+
+
+@pytest.fixture
+def stepfunctions():
+    return FakeStepFunctions()
+
+
+@pytest.fixture
+def metrics():
+    return []
+
+
+@pytest.fixture
+def controller(stub_client, stepfunctions, metrics):
+    def create(per_directory=1, per_account=2, store=None):
+        return AdmissionController(
+            per_directory,
+            per_account,
+            store or LocalSlotStore(),
+            stub_client("stepfunctions", {"send_task_success": stepfunctions.send_task_success}),
+            stub_client("cloudwatch", {"put_metric_data": lambda **kwargs: metrics.append(kwargs)}),
+        )
+
+    return create
+
+
+def queue(store, holder, directory, priority, enqueued):
+    store.enqueue(
+        holder,
+        {"Directory": directory, "Priority": priority, "Enqueued": enqueued, "TaskToken": holder + "-token"},
+    )
+
+
+def test_admits_by_priority_then_wait_time(controller, stepfunctions):
+    Controller = controller(per_directory=4, per_account=1)
+    Now = time.time()
+    queue(Controller.store, "late-low", "d-1", 0, Now - 10)
+    queue(Controller.store, "early-low", "d-1", 0, Now - 20)
+    queue(Controller.store, "high", "d-1", 5, Now)
+
+    Order = []
+    Result = Controller.schedule()
+    while Result["Admitted"]:
+        Order += [admitted["Holder"] for admitted in Result["Admitted"]]
+        Result = Controller.release(Order[-1])
+
+    assert Order == ["high", "early-low", "late-low"]
+    assert stepfunctions.resumed == ["high-token", "early-low-token", "late-low-token"]
+
+
+def test_full_directory_gives_account_slot_to_another_directory(controller, stepfunctions):
+    Controller = controller(per_directory=1, per_account=2)
+    Now = time.time()
+    queue(Controller.store, "first", "d-1", 0, Now - 30)
+    queue(Controller.store, "second", "d-1", 0, Now - 20)
+    queue(Controller.store, "other", "d-2", 0, Now - 10)
+
+    Result = Controller.schedule()
+    assert [admitted["Holder"] for admitted in Result["Admitted"]] == ["first", "other"]
+    assert Result["QueueDepth"] == 1
+    assert Result["ActiveBuilds"] == 2
+    assert set(Controller.store.queue()) == {"second"}
+
+    Result = Controller.release("first")
+    assert [admitted["Holder"] for admitted in Result["Admitted"]] == ["second"]
+    assert Result["QueueDepth"] == 0
+
+
+def test_account_limit_leaves_requests_queued(controller, metrics):
+    Controller = controller(per_directory=5, per_account=1)
+    Controller.request("run-1", "d-1", "run-1-token")
+    Result = Controller.request("run-2", "d-2", "run-2-token")
+
+    assert Result["Admitted"] == []
+    assert Result["QueueDepth"] == 1
+    assert Result["ActiveBuilds"] == 1
+    Published = {metric["MetricName"]: metric["Value"] for metric in metrics[-1]["MetricData"]}
+    assert Published == {"QueueDepth": 1, "ActiveBuilds": 1}
+
+
+def test_gone_execution_hands_its_slots_back(controller, stepfunctions):
+    stepfunctions.gone.add("stopped-token")
+    Controller = controller(per_directory=1, per_account=1)
+    Now = time.time()
+    queue(Controller.store, "stopped", "d-1", 0, Now - 20)
+    queue(Controller.store, "waiting", "d-1", 0, Now - 10)
+
+    Result = Controller.schedule()
+    assert [admitted["Holder"] for admitted in Result["Admitted"]] == ["waiting"]
+    assert Result["QueueDepth"] == 0
+    assert {value["Holder"] for value in Controller.store.slots().values()} == {"waiting"}
+
+
+def test_expired_slots_are_freed(controller):
+    Controller = controller(per_directory=1, per_account=1)
+    Controller.store.claim(ACCOUNT_POOL, 0, {"Holder": "abandoned", "Expires": time.time() - 1})
+    Controller.store.claim("d-1", 0, {"Holder": "abandoned", "Expires": time.time() - 1})
+
+    Result = Controller.request("run-1", "d-1", "run-1-token")
+    assert [admitted["Holder"] for admitted in Result["Admitted"]] == ["run-1"]
+
+
+def test_concurrent_schedulers_never_exceed_limits(controller, stepfunctions):
+    Store = LocalSlotStore()
+    Holders = ["run-" + str(index) for index in range(12)]
+    Start = threading.Barrier(len(Holders))
+
+    def pipeline(holder, directory):
+        Start.wait()
+        controller(per_directory=2, per_account=3, store=Store).request(holder, directory, holder + "-token")
+
+    Threads = [
+        threading.Thread(target=pipeline, args=(holder, "d-" + str(index % 2)))
+        for index, holder in enumerate(Holders)
+    ]
+    for thread in Threads:
+        thread.start()
+    for thread in Threads:
+        thread.join()
+
+    Slots = Store.slots()
+    assert len([key for key in Slots if key[0] == ACCOUNT_POOL]) == 3
+    assert all(index < 2 for pool, index in Slots if pool != ACCOUNT_POOL)
+    assert len(stepfunctions.resumed) == len(set(stepfunctions.resumed)) == 3
+    assert len(Store.queue()) == len(Holders) - 3
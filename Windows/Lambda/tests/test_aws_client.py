@@ -0,0 +1,165 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+from wks_automation import aws_client
+from wks_automation.aws_client import RateLimitedClient, ThrottlingError, ThrottlingStubClient
+
+
+def operation_counts(key):
+    return aws_client.counters.snapshot()["Operations"][key]
+
+
+def test_throttled_call_is_retried(stub_client):
+    Client = stub_client("workspaces", {"describe_workspaces": {"Workspaces": []}}, throttle_first=2)
+
+    assert Client.describe_workspaces() == {"Workspaces": []}
+    Counts = operation_counts("workspaces.describe_workspaces")
+    assert (Counts["Calls"], Counts["Throttles"], Counts["Retries"], Counts["Errors"]) == (3, 2, 2, 0)
+
+
+def test_call_still_throttled_raises_throttling_error(stub_client):
+    Client = stub_client("workspaces", throttle_first=10)
+
+    with pytest.raises(ThrottlingError):
+        Client.describe_workspaces()
+    Counts = operation_counts("workspaces.describe_workspaces")
+    assert (Counts["Calls"], Counts["Throttles"], Counts["Errors"]) == (3, 3, 1)
+
+
+def test_other_errors_are_not_retried(stub_client):
+    def missing(**kwargs):
+        raise ClientError({"Error": {"Code": "ResourceNotFoundException"}}, "DescribeWorkspaces")
+
+    Client = stub_client("workspaces", {"describe_workspaces": missing})
+
+    with pytest.raises(ClientError):
+        Client.describe_workspaces()
+    Counts = operation_counts("workspaces.describe_workspaces")
+    assert (Counts["Calls"], Counts["Throttles"], Counts["Errors"]) == (1, 0, 1)
+
+
+def test_api_arguments_named_like_wrapper_arguments_are_passed_on(stub_client):
+    Client = stub_client("stepfunctions", {"start_execution": lambda **kwargs: kwargs})
+
+    assert Client.start_execution(stateMachineArn="arn", name="build-1", method="ignored") == {
+        "stateMachineArn": "arn",
+        "name": "build-1",
+        "method": "ignored",
+    }
+
+
+def test_paginator_pages_go_through_the_wrapper(stub_client):
+    Pages = {
+        None: {"Images": [{"ImageId": "wsi-1"}], "NextToken": "2"},
+        "2": {"Images": [{"ImageId": "wsi-2"}]},
+    }
+    Client = stub_client(
+        "workspaces",
+        {"describe_workspace_images": lambda **kwargs: Pages[kwargs.get("NextToken")]},
+        throttle_first=1,
+    )
+
+    Images = []
+    for page in Client.get_paginator("describe_workspace_images").paginate(ImageType="OWNED"):
+        Images += page["Images"]
+
+    assert [image["ImageId"] for image in Images] == ["wsi-1", "wsi-2"]
+    Counts = operation_counts("workspaces.describe_workspace_images")
+    assert (Counts["Calls"], Counts["Throttles"]) == (3, 1)
+
+
+def test_botocore_paginators_request_each_page_through_method():
+    """RateLimitedClient replaces the private Paginator._method of botocore, this fails if
+    the installed botocore stops requesting pages through it"""
+
+    Boto = boto3.client("workspaces", region_name="us-east-1", aws_access_key_id="test", aws_secret_access_key="test")
+    Client = RateLimitedClient(Boto, "workspaces", rates={"workspaces": 1000.0})
+    with Stubber(Boto) as stubber:
+        stubber.add_client_error("describe_workspace_images", service_error_code="ThrottlingException")
+        stubber.add_response(
+            "describe_workspace_images", {"Images": [{"ImageId": "wsi-1"}], "NextToken": "2"}, {"ImageType": "OWNED"}
+        )
+        stubber.add_response(
+            "describe_workspace_images", {"Images": [{"ImageId": "wsi-2"}]}, {"ImageType": "OWNED", "NextToken": "2"}
+        )
+
+        Paginator = Client.get_paginator("describe_workspace_images")
+        Images = [image["ImageId"] for page in Paginator.paginate(ImageType="OWNED") for image in page["Images"]]
+        stubber.assert_no_pending_responses()
+
+    assert Images == ["wsi-1", "wsi-2"]
+    Counts = operation_counts("workspaces.describe_workspace_images")
+    assert (Counts["Calls"], Counts["Retries"], Counts["Errors"]) == (3, 1, 0)
+
+
+class PagesOnlyClient(ThrottlingStubClient):
+    """Stub client whose paginators only expose paginate"""
+
+    def get_paginator(self, operation):
+        Stub = aws_client.StubPaginator(getattr(self, operation))
+
+        class Paginator:
+            def paginate(self, **kwargs):
+                return Stub.paginate(**kwargs)
+
+        return Paginator()
+
+
+def test_paginator_without_method_limits_each_page_as_it_is_yielded():
+    Pages = {
+        None: {"Images": [{"ImageId": "wsi-1"}], "NextToken": "2"},
+        "2": {"Images": [{"ImageId": "wsi-2"}]},
+    }
+    Stub = PagesOnlyClient({"describe_workspace_images": lambda **kwargs: Pages[kwargs.get("NextToken")]})
+    Client = RateLimitedClient(Stub, "workspaces", rates={"workspaces": 1000.0})
+
+    Paginator = Client.get_paginator("describe_workspace_images")
+    Images = [image["ImageId"] for page in Paginator.paginate(ImageType="OWNED") for image in page["Images"]]
+
+    assert isinstance(Paginator, aws_client.RateLimitedPaginator)
+    assert Images == ["wsi-1", "wsi-2"]
+    assert operation_counts("workspaces.describe_workspace_images")["Calls"] == 2
+
+
+def test_paginator_without_method_raises_throttling_error():
+    Stub = PagesOnlyClient({"describe_workspace_images": {"Images": []}}, throttle_first=1)
+    Client = RateLimitedClient(Stub, "workspaces", rates={"workspaces": 1000.0})
+
+    with pytest.raises(ThrottlingError):
+        list(Client.get_paginator("describe_workspace_images").paginate())
+    Counts = operation_counts("workspaces.describe_workspace_images")
+    assert (Counts["Calls"], Counts["Throttles"], Counts["Errors"]) == (1, 1, 1)
+
+
+def test_calls_wait_for_the_token_bucket():
+    Client = RateLimitedClient(ThrottlingStubClient(), "ssm", rates={"ssm": 50.0})
+
+    for _ in range(aws_client.BUCKET_CAPACITY + 5):
+        Client.get_parameter(Name="/wks_automation/test")
+    assert operation_counts("ssm.get_parameter")["WaitTime"] >= 0.05
+
+
+def test_buckets_are_kept_per_region():
+    East = aws_client.get_bucket("workspaces", "create_workspace_image", region="us-east-1")
+    West = aws_client.get_bucket("workspaces", "create_workspace_image", region="us-west-2")
+
+    assert East is not West
+    assert East is aws_client.get_bucket("workspaces", "create_workspace_image", region="us-east-1")
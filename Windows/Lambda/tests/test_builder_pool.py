@@ -0,0 +1,215 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import threading
+import time
+import pytest
+from wks_automation.builder_pool import BuilderPool, LocalPoolStore, spec_key
+
+BUNDLE = "wsb-base"
+COMPUTE = "POWER"
+POOL = spec_key(BUNDLE, COMPUTE)
+
+
+class FakeWorkSpaces:
+    """Holds WorkSpace states behind the stubbed WorkSpaces calls"""
+
+    def __init__(self):
+        self.workspaces = {}
+        self.created = []
+        self.stopped = []
+        self.stop_batches = []
+        self.terminated = []
+        self.properties = {}
+        self.on_stop = None
+
+    def responses(self):
+        return {
+            "describe_workspaces": self.describe_workspaces,
+            "create_workspaces": self.create_workspaces,
+            "stop_workspaces": self.stop_workspaces,
+            "terminate_workspaces": self.terminate_workspaces,
+            "modify_workspace_properties": self.modify_workspace_properties,
+        }
+
+    def describe_workspaces(self, WorkspaceIds=None, DirectoryId=None):
+        if WorkspaceIds is not None:
+            assert len(WorkspaceIds) <= 25
+            Ids = [workspace_id for workspace_id in WorkspaceIds if workspace_id in self.workspaces]
+        else:
+            Ids = list(self.workspaces)
+        return {"Workspaces": [dict(self.workspaces[workspace_id], WorkspaceId=workspace_id) for workspace_id in Ids]}
+
+    def create_workspaces(self, Workspaces):
+        Pending = []
+        for request in Workspaces:
+            WorkspaceId = "ws-new-" + str(len(self.created))
+            self.created.append(request)
+            self.workspaces[WorkspaceId] = {"State": "PENDING", "UserName": request["UserName"]}
+            Pending.append({"WorkspaceId": WorkspaceId, "UserName": request["UserName"]})
+        return {"PendingRequests": Pending, "FailedRequests": []}
+
+    def stop_workspaces(self, StopWorkspaceRequests):
+        assert len(StopWorkspaceRequests) <= 25
+        self.stop_batches.append(len(StopWorkspaceRequests))
+        for request in StopWorkspaceRequests:
+            self.stopped.append(request["WorkspaceId"])
+            self.workspaces[request["WorkspaceId"]]["State"] = "STOPPING"
+        return {"FailedRequests": []}
+
+    def terminate_workspaces(self, TerminateWorkspaceRequests):
+        for request in TerminateWorkspaceRequests:
+            self.terminated.append(request["WorkspaceId"])
+            self.workspaces[request["WorkspaceId"]]["State"] = "TERMINATING"
+        return {"FailedRequests": []}
+
+    def modify_workspace_properties(self, WorkspaceId, WorkspaceProperties):
+        self.properties[WorkspaceId] = WorkspaceProperties
+        return {}
+
+
+@pytest.fixture
+def workspaces():
+    return FakeWorkSpaces()
+
+
+@pytest.fixture
+def metrics():
+    return []
+
+
+@pytest.fixture
+def pool(stub_client, workspaces, metrics):
+    return BuilderPool(
+        "d-1",
+        [{"BundleId": BUNDLE, "ComputeType": COMPUTE, "Size": 3}],
+        ["pool1", "pool2", "pool3", "pool4"],
+        LocalPoolStore(),
+        stub_client("workspaces", workspaces.responses()),
+        stub_client("cloudwatch", {"put_metric_data": lambda **kwargs: metrics.append(kwargs)}),
+    )
+
+
+def add_member(pool, workspaces, workspace_id, state, user):
+    workspaces.workspaces[workspace_id] = {"State": state, "UserName": user}
+    pool.store.add(POOL, workspace_id, {"UserName": user, "Added": time.time()})
+
+
+def test_claims_the_builder_fastest_to_use(pool, workspaces, metrics):
+    add_member(pool, workspaces, "ws-pending", "PENDING", "pool1")
+    add_member(pool, workspaces, "ws-stopped", "STOPPED", "pool2")
+    add_member(pool, workspaces, "ws-error", "ERROR", "pool3")
+
+    Claimed = pool.claim(BUNDLE, COMPUTE)
+    assert (Claimed["WorkspaceId"], Claimed["UserName"], Claimed["State"]) == ("ws-stopped", "pool2", "STOPPED")
+    assert workspaces.properties == {
+        "ws-stopped": {"RunningMode": "AUTO_STOP", "RunningModeAutoStopTimeoutInMinutes": 180}
+    }
+    assert set(pool.store.members(POOL)) == {"ws-pending", "ws-error"}
+    assert metrics[-1]["MetricData"][0]["MetricName"] == "PoolHit"
+
+
+def test_claim_describes_every_member(pool, workspaces):
+    for index in range(30):
+        add_member(pool, workspaces, "ws-" + str(index), "PENDING", "pool" + str(index))
+    workspaces.workspaces["ws-28"]["State"] = "AVAILABLE"
+
+    assert pool.claim(BUNDLE, COMPUTE)["WorkspaceId"] == "ws-28"
+
+
+def test_claim_misses_without_claimable_builders(pool, workspaces, metrics):
+    add_member(pool, workspaces, "ws-error", "ERROR", "pool1")
+
+    assert pool.claim(BUNDLE, COMPUTE) is None
+    assert pool.claim("wsb-other", COMPUTE) is None
+    assert metrics[-1]["MetricData"][0]["MetricName"] == "PoolMiss"
+
+
+def test_concurrent_claims_never_share_a_builder(pool, workspaces):
+    for index in range(3):
+        add_member(pool, workspaces, "ws-" + str(index), "STOPPED", "pool" + str(index))
+    Claims = []
+    Start = threading.Barrier(5)
+
+    def pipeline():
+        Start.wait()
+        Claims.append(pool.claim(BUNDLE, COMPUTE))
+
+    Threads = [threading.Thread(target=pipeline) for _ in range(5)]
+    for thread in Threads:
+        thread.start()
+    for thread in Threads:
+        thread.join()
+
+    Claimed = [claim["WorkspaceId"] for claim in Claims if claim]
+    assert sorted(Claimed) == ["ws-0", "ws-1", "ws-2"]
+    assert pool.store.members(POOL) == {}
+
+
+def test_refill_drops_stops_and_provisions(pool, workspaces):
+    add_member(pool, workspaces, "ws-running", "AVAILABLE", "pool1")
+    add_member(pool, workspaces, "ws-terminated", "TERMINATED", "pool2")
+    # pool3 already has a WorkSpace outside the pool, so it cannot be used
+    workspaces.workspaces["ws-user"] = {"State": "AVAILABLE", "UserName": "POOL3"}
+
+    Report = pool.refill()
+
+    assert workspaces.stopped == ["ws-running"]
+    assert [request["UserName"] for request in workspaces.created] == ["pool2", "pool4"]
+    assert set(pool.store.members(POOL)) == {"ws-running", "ws-new-0", "ws-new-1"}
+    assert (Report[0]["Size"], Report[0]["Provisioning"]) == (1, 2)
+
+
+def test_refill_terminates_failed_builders_and_keeps_transient_ones(pool, workspaces):
+    add_member(pool, workspaces, "ws-error", "ERROR", "pool1")
+    add_member(pool, workspaces, "ws-rebooting", "REBOOTING", "pool2")
+    add_member(pool, workspaces, "ws-stopped", "STOPPED", "pool3")
+
+    Report = pool.refill()
+
+    assert workspaces.terminated == ["ws-error"]
+    assert set(pool.store.members(POOL)) == {"ws-rebooting", "ws-stopped", "ws-new-0"}
+    # pool1 is busy until its builder is terminated, so only pool4 is free
+    assert [request["UserName"] for request in workspaces.created] == ["pool4"]
+    assert (Report[0]["Size"], Report[0]["Provisioning"]) == (2, 1)
+    assert pool.claim(BUNDLE, COMPUTE)["WorkspaceId"] == "ws-stopped"
+
+
+def test_refill_does_not_stop_a_builder_claimed_meanwhile(pool, workspaces, monkeypatch):
+    add_member(pool, workspaces, "ws-claimed", "AVAILABLE", "pool1")
+    add_member(pool, workspaces, "ws-running", "AVAILABLE", "pool2")
+    Describe = pool._describe_states
+
+    def describe_then_claim(workspace_ids):
+        States = Describe(workspace_ids)
+        pool.store.remove(POOL, "ws-claimed")
+        return States
+
+    monkeypatch.setattr(pool, "_describe_states", describe_then_claim)
+    pool.refill()
+
+    assert workspaces.stopped == ["ws-running"]
+
+
+def test_refill_stops_running_builders_in_batches(pool, workspaces):
+    pool.specs[0]["Size"] = 30
+    for index in range(30):
+        add_member(pool, workspaces, "ws-" + str(index), "AVAILABLE", "user" + str(index))
+
+    pool.refill()
+
+    assert workspaces.stop_batches == [25, 5]
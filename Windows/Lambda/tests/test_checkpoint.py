@@ -0,0 +1,117 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import json
+from datetime import datetime, timezone
+from wks_automation.checkpoint import find_checkpoint
+
+
+def exited(name, output):
+    return {"type": "TaskStateExited", "stateExitedEventDetails": {"name": name, "output": json.dumps(output)}}
+
+
+def history(*events):
+    """Returns the events of a failed execution newest first, as get_execution_history
+    does with reverseOrder, from the state exits given oldest first"""
+
+    Events = list(events) + [{"type": "ExecutionFailed"}]
+    return [
+        dict(event, timestamp=datetime(2024, 1, 1, 12, 0, index, tzinfo=timezone.utc))
+        for index, event in reversed(list(enumerate(Events)))
+    ]
+
+
+BUILDER = {"AutomationParameters": {"ImageBuilderWorkSpaceId": "ws-1"}}
+
+
+def image(state):
+    return dict(BUILDER, ImageStatus={"Images": [{"ImageId": "wsi-1", "State": state}]})
+
+
+def test_newest_checkpoint_is_used():
+    Checkpoint = find_checkpoint(
+        history(
+            exited("Create Builder WorkSpace", BUILDER),
+            exited("Run Deployment Routine", dict(BUILDER, Routine="done")),
+            exited("Check Builder Status (Create)", BUILDER),
+        )
+    )
+
+    assert (Checkpoint["Checkpoint"], Checkpoint["State"]) == ("Routine", "Check Builder Status (Create)")
+    assert Checkpoint["Output"]["Routine"] == "done"
+    assert Checkpoint["ImageFailed"] is False
+    assert Checkpoint["Timestamp"] == datetime(2024, 1, 1, 12, 0, 1, tzinfo=timezone.utc)
+
+
+def test_available_image_resumes_after_the_image():
+    Checkpoint = find_checkpoint(
+        history(
+            exited("Cleanup Temp Creds & API", BUILDER),
+            exited("Check Image Status (Post-Wait)", image("AVAILABLE")),
+        )
+    )
+
+    assert (Checkpoint["Checkpoint"], Checkpoint["State"]) == ("Image Available", "Delete Builder?")
+
+
+def test_pending_image_resumes_waiting_for_the_image():
+    Checkpoint = find_checkpoint(history(exited("Create Workspace Image (Tagged)", image("PENDING"))))
+
+    assert (Checkpoint["Checkpoint"], Checkpoint["State"]) == ("Image", "Check Image Status (Post-Create)")
+
+
+def test_failed_image_resumes_from_the_cleanup_before_it():
+    Checkpoint = find_checkpoint(
+        history(
+            exited("Cleanup Temp Creds & API", BUILDER),
+            exited("Create Workspace Image (No Tags)", image("PENDING")),
+            exited("Check Image Status (Post-Wait)", image("ERROR")),
+        )
+    )
+
+    assert (Checkpoint["Checkpoint"], Checkpoint["State"]) == ("Cleanup", "Check Builder Status (Resume)")
+    assert Checkpoint["ImageFailed"] is True
+
+
+def test_restored_image_that_failed_again_goes_back_to_the_cleanup():
+    Restored = dict(image("PENDING"), Resume={"Checkpoint": "Image", "State": "Check Image Status (Post-Wait)"})
+    Checkpoint = find_checkpoint(
+        history(
+            exited("Restore Checkpoint", Restored),
+            exited("Check Image Status (Post-Wait)", image("ERROR")),
+        )
+    )
+
+    assert (Checkpoint["Checkpoint"], Checkpoint["State"]) == ("Cleanup", "Check Builder Status (Resume)")
+
+
+def test_restored_checkpoint_is_kept_when_resumed_run_fails_again():
+    Restored = dict(BUILDER, Resume={"Checkpoint": "Routine", "State": "Check Builder Status (Create)"})
+    Checkpoint = find_checkpoint(
+        history(
+            exited("Restore Checkpoint", Restored),
+            exited("Check Builder Status (Create)", BUILDER),
+        )
+    )
+
+    assert (Checkpoint["Checkpoint"], Checkpoint["State"]) == ("Routine", "Check Builder Status (Create)")
+
+
+def test_no_checkpoint_before_the_builder():
+    assert find_checkpoint(history(exited("Preflight Validation", {}))) is None
+    Failed = {"AutomationParameters": {"ImageBuilderWorkSpaceId": "FAILED"}}
+    assert find_checkpoint(history(exited("Create Builder WorkSpace", Failed))) is None
@@ -0,0 +1,140 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import threading
+import time
+import pytest
+from wks_automation.endpoint_lease import EndpointLeaseCoordinator, LocalLeaseStore
+
+API_ID = "abc123"
+
+
+class FakeApi:
+    """Holds the endpoint state behind the stubbed get_rest_api and update_rest_api
+
+    Functions registered with after run once the numbered call of a method has done its
+    work, before it returns, to interleave another pipeline between a read and a write.
+    """
+
+    def __init__(self, enabled=False):
+        self.disabled = not enabled
+        self.calls = {}
+        self.hooks = {}
+
+    def after(self, method, call, function):
+        self.hooks[(method, call)] = function
+
+    def _done(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        Hook = self.hooks.pop((method, self.calls[method]), None)
+        if Hook:
+            Hook()
+
+    def responses(self):
+        return {
+            "get_rest_api": self.get_rest_api,
+            "update_rest_api": self.update_rest_api,
+            "create_deployment": {"id": "deployment"},
+        }
+
+    def get_rest_api(self, restApiId):
+        response = {"id": restApiId, "disableExecuteApiEndpoint": self.disabled}
+        self._done("get_rest_api")
+        return response
+
+    def update_rest_api(self, restApiId, patchOperations):
+        self.disabled = patchOperations[0]["value"] == "True"
+        self._done("update_rest_api")
+        return {"id": restApiId}
+
+
+@pytest.fixture
+def api():
+    return FakeApi()
+
+
+@pytest.fixture
+def coordinator(api, stub_client):
+    Client = stub_client("apigateway", api.responses())
+    return EndpointLeaseCoordinator(API_ID, LocalLeaseStore(), Client)
+
+
+def test_first_acquire_enables_and_last_release_disables(api, coordinator):
+    assert coordinator.acquire("run-1") == {"ActiveLeases": 1, "EndpointChanged": True}
+    assert coordinator.acquire("run-2") == {"ActiveLeases": 2, "EndpointChanged": False}
+    assert not api.disabled
+
+    assert coordinator.release("run-1") == {"ActiveLeases": 1, "EndpointChanged": False}
+    assert not api.disabled
+    assert coordinator.release("run-2") == {"ActiveLeases": 0, "EndpointChanged": True}
+    assert api.disabled
+    assert api.calls["update_rest_api"] == 2
+
+
+def test_release_without_disable_leaves_endpoint_enabled(api, coordinator):
+    coordinator.acquire("run-1")
+    assert coordinator.release("run-1", disable=False)["EndpointChanged"] is False
+    assert not api.disabled
+
+
+def test_expired_leases_are_removed(api, coordinator):
+    coordinator.store.put(API_ID, "abandoned", time.time() - 1)
+    coordinator.acquire("run-1")
+    assert coordinator.store.list(API_ID).keys() == {"run-1"}
+
+    coordinator.release("run-1")
+    assert api.disabled
+
+
+def test_lease_taken_while_disabling_reenables(api, coordinator):
+    coordinator.acquire("run-1")
+    api.after("update_rest_api", 2, lambda: coordinator.acquire("run-2"))
+
+    coordinator.release("run-1")
+    assert not api.disabled
+    assert coordinator.store.list(API_ID).keys() == {"run-2"}
+
+
+def test_lease_released_before_reenabling_disables_again(api, coordinator):
+    coordinator.acquire("run-1")
+    # run-2 takes its lease while run-1 disables the endpoint, and releases it after
+    # run-1 has read the endpoint state to re-enable it
+    api.after("update_rest_api", 2, lambda: coordinator.store.put(API_ID, "run-2", time.time() + 60))
+    api.after("get_rest_api", 3, lambda: coordinator.release("run-2"))
+
+    coordinator.release("run-1")
+    assert api.disabled
+    assert coordinator.store.list(API_ID) == {}
+
+
+def test_concurrent_pipelines_leave_endpoint_matching_leases(api, coordinator):
+    Holders = ["run-" + str(index) for index in range(8)]
+    Start = threading.Barrier(len(Holders))
+
+    def pipeline(holder):
+        Start.wait()
+        coordinator.acquire(holder)
+        coordinator.release(holder)
+
+    Threads = [threading.Thread(target=pipeline, args=(holder,)) for holder in Holders]
+    for thread in Threads:
+        thread.start()
+    for thread in Threads:
+        thread.join()
+
+    assert coordinator.store.list(API_ID) == {}
+    assert api.disabled
@@ -0,0 +1,140 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+from datetime import datetime, timedelta, timezone
+import pytest
+from wks_automation.history import LocalRunRecords, Planner, RunHistory, percentile, stage_durations
+from wks_automation.routine import step_hash
+
+INSTALL = ["RUN_POWERSHELL", "Install-Excel"]
+CONFIGURE = ["RUN_POWERSHELL", "Set-Policies"]
+
+
+def timing(step, seconds):
+    """Returns a StepTimings entry as the configuration routine records it"""
+
+    return {
+        "Hash": step_hash(step),
+        "Type": step[0].upper(),
+        "Duration": seconds,
+        "Status": "OK",
+        "Attempts": 1,
+        "RetrySeconds": 0,
+    }
+
+
+def run(execution, started, compute_type, bundle_id, install_seconds, stages=None):
+    return {
+        "Execution": execution,
+        "Started": started,
+        "ComputeType": compute_type,
+        "BundleId": bundle_id,
+        "Stages": stages or {"Provision": 600, "Routine": install_seconds + 30, "Windows Updates": 900, "Image": 1800},
+        "Steps": [timing(INSTALL, install_seconds), timing(CONFIGURE, 30)],
+        "Reboots": [120],
+    }
+
+
+@pytest.fixture
+def records():
+    Records = LocalRunRecords()
+    Records.put(run("power-1", 1, "POWER", "wsb-a", 100))
+    Records.put(run("power-2", 2, "POWER", "wsb-a", 110))
+    Records.put(run("power-3", 3, "POWER", "wsb-b", 300))
+    Records.put(run("standard-1", 4, "STANDARD", "wsb-a", 400))
+    return Records
+
+
+@pytest.fixture
+def history(records):
+    History = RunHistory()
+    History.sync(records)
+    return History
+
+
+def test_sync_imports_only_new_records(records, history):
+    assert history.run_count() == 4
+    records.put(run("power-4", 5, "POWER", "wsb-a", 120))
+
+    assert history.sync(records) == 1
+    assert history.sync(records) == 0
+    assert history.run_count() == 5
+
+
+def test_step_estimates_use_runs_on_the_same_compute_type_and_bundle(history):
+    Hash = step_hash(INSTALL)
+
+    assert history.step_seconds(Hash, compute_type="POWER", bundle_id="wsb-a") == [100, 110]
+    assert history.step_seconds(Hash, compute_type="POWER", bundle_id="wsb-c") == [100, 110, 300]
+    assert history.step_seconds(Hash, compute_type="POWERPRO") == [100, 110, 300, 400]
+    assert history.step_seconds(Hash, exclude="power-1", compute_type="POWER", bundle_id="wsb-a") == [110]
+
+
+def test_regressions_compare_runs_on_the_same_compute_type(records, history):
+    records.put(run("power-4", 5, "POWER", "wsb-a", 105))
+    records.put(run("power-slow", 6, "POWER", "wsb-a", 400))
+    history.sync(records)
+
+    Regressions = history.regressions("power-slow")
+    assert [(regression["Hash"], regression["Seconds"]) for regression in Regressions] == [(step_hash(INSTALL), 400)]
+    assert Regressions[0]["BaselineP50"] == 105.0
+    # The STANDARD run is as slow, but has no earlier STANDARD runs to compare with
+    assert history.regressions("standard-1") == []
+
+
+def test_planner_estimates_known_and_unknown_steps(history):
+    Plan = Planner(history).plan(
+        [INSTALL, ["REBOOT"], ["RUN_POWERSHELL", "Install-New"], ["DOWNLOAD_HTTP", "https://example.com/a.msi"]],
+        compute_type="POWER",
+        bundle_id="wsb-a",
+    )
+
+    assert [(step["Basis"], step["P50"]) for step in Plan["Steps"]] == [
+        ("step", 105.0),
+        ("reboots", 120.0),
+        ("type", 65.0),
+        ("none", 0),
+    ]
+    assert Plan["UnknownSteps"] == 1
+    assert Plan["Stages"]["Routine"]["P50"] == 290.0
+    # Windows Updates are skipped by default, as in the pipeline
+    assert "Windows Updates" not in Plan["Stages"]
+    assert Plan["WallP50"] == 600 + 290 + 1800
+    assert Plan["BuilderHoursP50"] == round((600 + 290 + 1800) / 3600, 2)
+
+    Plan = Planner(history).plan([INSTALL], "POWER", skip_windows_updates=False, bundle_id="wsb-a")
+    assert Plan["WallP50"] == 600 + 105 + 900 + 1800
+
+
+def test_stage_durations_and_percentiles():
+    Start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    def event(kind, name, seconds):
+        return {"timestamp": Start + timedelta(seconds=seconds), kind: {"name": name}}
+
+    Events = [
+        event("stateEnteredEventDetails", "Create Builder WorkSpace", 0),
+        event("stateExitedEventDetails", "Create Builder WorkSpace", 90),
+        event("stateEnteredEventDetails", "Run Deployment Routine", 90),
+        event("stateExitedEventDetails", "Run Deployment Routine", 390),
+        event("stateEnteredEventDetails", "Notify", 390),
+        event("stateExitedEventDetails", "Notify", 392),
+    ]
+
+    assert stage_durations(Events) == {"Provision": 90, "Routine": 300, "Other": 2}
+    assert percentile([10, 20, 30, 40], 50) == 25
+    assert percentile([], 95) is None
@@ -0,0 +1,151 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import time
+import pytest
+from wks_automation.layers import LayerPlanner, LocalLayerCache, fingerprint
+
+
+class FakeWorkSpaces:
+    """Holds the image states and bundles behind the stubbed WorkSpaces calls"""
+
+    def __init__(self):
+        self.images = {}
+        self.bundles = set()
+
+    def responses(self):
+        return {
+            "describe_workspace_images": self.describe_workspace_images,
+            "describe_workspace_bundles": self.describe_workspace_bundles,
+        }
+
+    def describe_workspace_images(self, ImageIds):
+        Ids = [image_id for image_id in ImageIds if image_id in self.images]
+        return {"Images": [{"ImageId": image_id, "State": self.images[image_id]} for image_id in Ids]}
+
+    def describe_workspace_bundles(self, BundleIds):
+        return {"Bundles": [{"BundleId": bundle_id} for bundle_id in BundleIds if bundle_id in self.bundles]}
+
+    def build(self, image_id, bundle_id=None):
+        self.images[image_id] = "AVAILABLE"
+        Output = {"ImageStatus": {"Images": [{"ImageId": image_id, "State": "AVAILABLE"}]}}
+        if bundle_id:
+            self.bundles.add(bundle_id)
+            Output["BundleStatus"] = [{"WorkspaceBundle": {"BundleId": bundle_id}}]
+        return Output
+
+
+@pytest.fixture(autouse=True)
+def environment(monkeypatch):
+    monkeypatch.setenv("Default_ImagePrefix", "WKS_Automation")
+    monkeypatch.setenv("Default_BundlePrefix", "WKS_Automation")
+    monkeypatch.setenv("Default_WorkSpaceUser", "wks_automation")
+
+
+@pytest.fixture
+def workspaces():
+    return FakeWorkSpaces()
+
+
+@pytest.fixture
+def planner(stub_client, workspaces):
+    return LayerPlanner(LocalLayerCache(), stub_client("workspaces", workspaces.responses()))
+
+
+def layered_event(**parameters):
+    Event = {
+        "ImageNamePrefix": "Finance",
+        "InstallRoutine": [],
+        "Layers": {
+            "BaseRoutine": [["POWERSHELL", "Install-Base"]],
+            "ChildConcurrency": 2,
+            "Children": [
+                {
+                    "ImageNamePrefix": "Finance_Excel",
+                    "InstallRoutine": [["POWERSHELL", "Install-Excel"]],
+                    "ImageBuilderUser": "builder1",
+                },
+                {
+                    "ImageNamePrefix": "Finance_Tools",
+                    "InstallRoutine": [["POWERSHELL", "Install-Tools"]],
+                    "ImageBuilderUser": "builder2",
+                },
+            ],
+        },
+        "PipelineExecution": "layered-run",
+    }
+    Event.update(parameters)
+    return Event
+
+
+def test_fingerprint_ignores_naming_parameters():
+    Parameters = {"InstallRoutine": [["POWERSHELL", "Install-Base"]], "ImageNamePrefix": "Finance"}
+
+    assert fingerprint(Parameters) == fingerprint(dict(Parameters, ImageNamePrefix="Sales", BuildPriority=5))
+    assert fingerprint(Parameters) != fingerprint(dict(Parameters, InstallRoutine=[]))
+    assert fingerprint(Parameters) != fingerprint(Parameters, parent="base")
+
+
+def test_base_is_built_then_cached(planner, workspaces):
+    Plan = planner.plan(layered_event())
+    assert Plan["BaseCached"] is False
+    assert Plan["BaseInput"]["ImageNamePrefix"] == "Finance_Base"
+    assert "Layers" not in Plan["BaseInput"] and "PipelineExecution" not in Plan["BaseInput"]
+
+    Plan = planner.register_base(Plan, workspaces.build("wsi-base", "wsb-base"))
+    assert len(Plan["ChildInputs"]) == 2
+    assert all(child["ImageBuilderBundleId"] == "wsb-base" for child in Plan["ChildInputs"])
+
+    Again = planner.plan(layered_event(ImageNamePrefix="Renamed"))
+    assert Again["BaseCached"] is True
+    assert Again["BaseLayer"] == Plan["BaseLayer"]
+    assert Again["Base"]["BundleId"] == "wsb-base"
+
+
+def test_unchanged_children_are_cache_hits(planner, workspaces):
+    Plan = planner.register_base(planner.plan(layered_event()), workspaces.build("wsi-base", "wsb-base"))
+    Report = planner.register_children(
+        Plan,
+        [{"Output": workspaces.build("wsi-excel")}, {"Error": "States.TaskFailed", "Cause": "Routine failed."}],
+    )
+    assert [child["Status"] for child in Report] == ["BUILT", "FAILED"]
+
+    Again = planner.plan(layered_event())
+    assert [child["ImageId"] for child in Again["CachedChildren"]] == ["wsi-excel"]
+    assert [child["ImageNamePrefix"] for child in Again["ChildInputs"]] == ["Finance_Tools"]
+
+
+def test_base_is_rebuilt_when_stale_or_gone(planner, workspaces):
+    Plan = planner.register_base(planner.plan(layered_event()), workspaces.build("wsi-base", "wsb-base"))
+
+    workspaces.bundles.discard("wsb-base")
+    assert planner.plan(layered_event())["BaseCached"] is False
+
+    workspaces.bundles.add("wsb-base")
+    planner.cache.put(Plan["BaseLayer"], dict(Plan["Base"], Created=time.time() - 40 * 86400))
+    assert planner.plan(layered_event())["BaseCached"] is False
+    Layers = dict(layered_event()["Layers"], BaseMaxAgeDays=60)
+    assert planner.plan(layered_event(Layers=Layers))["BaseCached"] is True
+
+
+def test_children_sharing_a_builder_user_run_one_at_a_time(planner, workspaces):
+    Layers = layered_event()["Layers"]
+    Children = [dict(child, ImageBuilderUser="Builder") for child in Layers["Children"]]
+    Event = layered_event(Layers=dict(Layers, Children=Children))
+
+    Plan = planner.register_base(planner.plan(Event), workspaces.build("wsi-base", "wsb-base"))
+    assert Plan["ChildConcurrency"] == 1
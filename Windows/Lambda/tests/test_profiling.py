@@ -0,0 +1,119 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+import pytest
+from wks_automation.profiling import COMPUTE_TYPES, SAMPLE_INTERVAL, cpu_scaled_seconds, step_profile, summarize
+
+SAMPLES = [
+    "1700000000,50.0,2147483648,1048576,2097152",
+    "1700000005,100.0,4294967296,3145728,0",
+]
+
+
+class Result:
+    def __init__(self, status_code, std_out=b""):
+        self.status_code = status_code
+        self.std_out = std_out
+
+
+def profile(cpu_avg, cpu_max, memory_gb):
+    return {"Samples": 10, "CpuAvg": cpu_avg, "CpuMax": cpu_max, "MemoryGBMax": memory_gb}
+
+
+def test_summarize_averages_and_peaks():
+    assert summarize(SAMPLES) == {
+        "Samples": 2,
+        "CpuAvg": 75.0,
+        "CpuMax": 100.0,
+        "MemoryGBMax": 4.0,
+        "DiskMBpsAvg": 2.0,
+        "NetworkMBpsAvg": 1.0,
+    }
+
+
+def test_summarize_skips_lines_that_are_not_samples():
+    Lines = ["", "Get-Counter : The specified object was not found.", "a,b,c,d,e", "1,2,3"] + [
+        line + "\r" for line in SAMPLES
+    ]
+
+    assert summarize(Lines)["Samples"] == 2
+    assert summarize([]) == {"Samples": 0}
+    assert summarize(["not,a,sample,at,all"]) == {"Samples": 0}
+
+
+def test_step_profile_reads_the_samples_of_the_step_window():
+    Scripts = []
+
+    class Session:
+        def run_ps(self, script):
+            Scripts.append(script)
+            return Result(0, "\r\n".join(SAMPLES).encode("utf-8"))
+
+    assert step_profile(Session(), 1700000000.7, 1700000004.2)["Samples"] == 2
+    # The sample covering the end of the step is written up to one interval later
+    assert "-ge 1700000000 -and $Time -le " + str(1700000004 + SAMPLE_INTERVAL) in Scripts[0]
+
+
+def test_step_profile_returns_none_when_samples_cannot_be_read():
+    class Session:
+        def run_ps(self, script):
+            return Result(1)
+
+    class Broken:
+        def run_ps(self, script):
+            raise ConnectionError("Connection reset.")
+
+    assert step_profile(Session(), 0, 10) is None
+    assert step_profile(Broken(), 0, 10) is None
+
+
+@pytest.mark.parametrize(
+    "target, expected",
+    [
+        # The busy 80% of the time halves on twice the vCPUs, and doubles on half
+        ("POWERPRO", 60.0),
+        ("STANDARD", 180.0),
+        ("POWER", 100.0),
+    ],
+)
+def test_cpu_scaled_seconds_scales_cpu_bound_steps_with_the_vcpus(target, expected):
+    Estimate, Fits = cpu_scaled_seconds(100, profile(80.0, 100.0, 3.0), "POWER", target)
+
+    assert Estimate == pytest.approx(expected)
+    assert Fits
+
+
+def test_cpu_scaled_seconds_only_slows_steps_that_did_not_use_every_vcpu():
+    # 20% of 4 vCPUs is under one vCPU, so neither more nor fewer vCPUs change it
+    assert cpu_scaled_seconds(100, profile(20.0, 50.0, 1.0), "POWER", "VALUE")[0] == pytest.approx(100)
+    assert cpu_scaled_seconds(100, profile(20.0, 50.0, 1.0), "POWER", "POWERPRO")[0] == pytest.approx(100)
+    # 60% of 8 vCPUs is about 5 vCPUs of work for the 1 vCPU of VALUE
+    assert cpu_scaled_seconds(100, profile(60.0, 80.0, 1.0), "POWERPRO", "VALUE")[0] == pytest.approx(
+        100 * (0.4 + 0.6 * 4.8)
+    )
+
+
+def test_cpu_scaled_seconds_penalizes_steps_that_do_not_fit_in_memory():
+    Estimate, Fits = cpu_scaled_seconds(100, profile(0.0, 10.0, 6.0), "POWER", "STANDARD")
+
+    assert not Fits
+    assert Estimate == pytest.approx(150)
+    # Memory must leave headroom, 3.6 of the 4 GiB of STANDARD
+    assert COMPUTE_TYPES["STANDARD"]["MemoryGB"] == 4
+    assert cpu_scaled_seconds(100, profile(0.0, 10.0, 3.6), "POWER", "STANDARD")[1]
+    assert not cpu_scaled_seconds(100, profile(0.0, 10.0, 3.7), "POWER", "STANDARD")[1]
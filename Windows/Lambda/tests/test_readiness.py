@@ -0,0 +1,203 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+import contextlib
+import pytest
+import requests
+from wks_automation import readiness
+from wks_automation.readiness import UPTIME_SCRIPT, WINRM_PORT, is_transport_error, probe, wait_until_ready
+
+
+class Clock:
+    """Stands in for the time module, sleeping only moves the clock forward"""
+
+    def __init__(self, now=100000.0):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class Result:
+    def __init__(self, status_code, std_out=b"", std_err=b""):
+        self.status_code = status_code
+        self.std_out = std_out
+        self.std_err = std_err
+
+
+class FakeBuilder:
+    """Answers the socket and WinRM checks like an image builder WorkSpace"""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.port_open = True
+        self.password = "password"
+        self.booted = clock.now - 600
+        self.staging_status = 0
+        self.connections = []
+        self.scripts = []
+
+    def create_connection(self, address, timeout):
+        self.connections.append((address, timeout))
+        if not self.port_open:
+            raise ConnectionRefusedError("Connection refused.")
+        return contextlib.nullcontext()
+
+    def session(self, host, auth, read_timeout_sec, operation_timeout_sec):
+        if auth[1] != self.password:
+            raise requests.exceptions.ConnectionError("401 Unauthorized.")
+        return self
+
+    def run_ps(self, script):
+        self.scripts.append(script)
+        if script == UPTIME_SCRIPT:
+            return Result(0, str(int(self.clock.now - self.booted)).encode("ascii") + b"\r\n")
+        if self.staging_status:
+            return Result(self.staging_status, std_err=b"Access denied.")
+        return Result(0, b"True\r\n")
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    Fake = Clock()
+    monkeypatch.setattr(readiness, "time", Fake)
+    return Fake
+
+
+@pytest.fixture
+def builder(clock, monkeypatch):
+    Builder = FakeBuilder(clock)
+    monkeypatch.setattr(readiness.socket, "create_connection", Builder.create_connection)
+    monkeypatch.setattr(readiness.winrm, "Session", Builder.session)
+    return Builder
+
+
+def test_probe_is_ready_after_every_check_passes(builder):
+    Result = probe("10.0.0.10", "wks_automation", "password", staging_dir="C:\\wks_automation")
+
+    assert Result == {"Ready": True, "Stage": "ready", "Uptime": 600, "Latency": 0}
+    assert builder.connections == [(("10.0.0.10", WINRM_PORT), 10)]
+    assert builder.scripts[0] == UPTIME_SCRIPT and "C:\\wks_automation" in builder.scripts[1]
+
+
+def test_probe_stops_at_the_first_failed_check(builder, clock):
+    builder.port_open = False
+    assert probe("10.0.0.10", "wks_automation", "password")["Stage"] == "port"
+    assert builder.scripts == []
+
+    builder.port_open = True
+    Result = probe("10.0.0.10", "wks_automation", "wrong")
+    assert (Result["Ready"], Result["Stage"]) == (False, "auth")
+
+    # Still up since before the reboot was started, so the reboot has not happened
+    Result = probe("10.0.0.10", "wks_automation", "password", booted_after=clock.now - 60)
+    assert (Result["Ready"], Result["Stage"], Result["Uptime"]) == (False, "reboot", 600)
+
+    builder.booted = clock.now - 30
+    builder.staging_status = 1
+    Result = probe("10.0.0.10", "wks_automation", "password", booted_after=clock.now - 60, staging_dir="C:\\wks")
+    assert (Result["Ready"], Result["Stage"]) == (False, "staging")
+
+    builder.staging_status = 0
+    Result = probe("10.0.0.10", "wks_automation", "password", booted_after=clock.now - 60, staging_dir="C:\\wks")
+    assert (Result["Ready"], Result["Stage"]) == (True, "ready")
+
+
+def test_probe_fails_auth_when_the_uptime_script_fails(builder, monkeypatch):
+    monkeypatch.setattr(builder, "run_ps", lambda script: Result(1, std_err=b"Access denied."))
+
+    assert probe("10.0.0.10", "wks_automation", "password")["Stage"] == "auth"
+
+
+def test_wait_until_ready_returns_once_ready(builder, clock, monkeypatch):
+    builder.port_open = False
+    Connect = builder.create_connection
+
+    def create_connection(address, timeout):
+        # The port opens on the third attempt
+        if len(builder.connections) == 2:
+            builder.port_open = True
+        return Connect(address, timeout)
+
+    monkeypatch.setattr(readiness.socket, "create_connection", create_connection)
+
+    Result = wait_until_ready("10.0.0.10", "wks_automation", "password")
+
+    assert Result["Ready"]
+    assert clock.sleeps == [2, 4]
+
+
+def test_wait_until_ready_gives_up_within_the_budget(builder, clock):
+    builder.port_open = False
+    Start = clock.now
+
+    Result = wait_until_ready("10.0.0.10", "wks_automation", "password")
+
+    assert (Result["Ready"], Result["Stage"]) == (False, "port")
+    # The interval doubles up to 30 seconds, and the last wait ends on the 60 second budget
+    assert clock.sleeps == [2, 4, 8, 16, 30]
+    assert clock.now - Start == 60
+    assert len(builder.connections) == 6
+
+
+def test_wait_until_ready_counts_slow_probes_against_the_budget(builder, clock, monkeypatch):
+    builder.port_open = False
+    Connect = builder.create_connection
+    Start = clock.now
+
+    def create_connection(address, timeout):
+        # An unreachable builder takes the whole connect timeout to fail
+        clock.now += timeout
+        return Connect(address, timeout)
+
+    monkeypatch.setattr(readiness.socket, "create_connection", create_connection)
+
+    Result = wait_until_ready("10.0.0.10", "wks_automation", "password")
+
+    assert not Result["Ready"]
+    assert clock.sleeps == [2, 4, 8]
+    assert clock.now - Start == 54
+
+
+def test_wait_until_ready_waits_for_the_reboot(builder, clock):
+    RebootStarted = clock.now - 5
+
+    def reboot(seconds):
+        Clock.sleep(clock, seconds)
+        # The builder comes back up 10 seconds into the wait
+        if clock.now - RebootStarted >= 15 and builder.booted < RebootStarted:
+            builder.booted = clock.now - 1
+
+    clock.sleep = reboot
+
+    Result = wait_until_ready("10.0.0.10", "wks_automation", "password", booted_after=RebootStarted)
+
+    assert Result["Ready"]
+    assert clock.sleeps == [2, 4, 8]
+
+
+def test_is_transport_error():
+    assert is_transport_error(requests.exceptions.ConnectionError())
+    assert is_transport_error(requests.exceptions.ReadTimeout())
+    assert is_transport_error(readiness.WinRMTransportError("http", 500, "Bad gateway."))
+    assert not is_transport_error(RuntimeError("Step failed."))
@@ -0,0 +1,181 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+from datetime import datetime, timedelta, timezone
+import pytest
+from botocore.exceptions import ClientError
+from wks_automation.layers import LocalLayerCache
+from wks_automation.retention import ArtifactRetention, series_of
+
+NOW = datetime.now(timezone.utc)
+
+
+def name(prefix, days):
+    return prefix + "-" + (NOW - timedelta(days=days)).strftime("%Y-%m-%d-%H-%M")
+
+
+class FakeWorkSpaces:
+    """Holds images, bundles, WorkSpaces and tags behind the stubbed WorkSpaces calls"""
+
+    def __init__(self):
+        self.images = []
+        self.bundles = []
+        self.workspaces = []
+        self.tags = {}
+        self.failing = set()
+        self.deleted = []
+
+    def image(self, image_id, days, state="AVAILABLE", prefix="Finance"):
+        self.images.append(
+            {"ImageId": image_id, "Name": name(prefix, days), "State": state, "Created": NOW - timedelta(days=days)}
+        )
+
+    def bundle(self, bundle_id, image_id, days, prefix="Finance_Bundle"):
+        self.bundles.append(
+            {
+                "BundleId": bundle_id,
+                "Name": name(prefix, days),
+                "ImageId": image_id,
+                "CreationTime": NOW - timedelta(days=days),
+            }
+        )
+
+    def responses(self):
+        return {
+            "describe_workspace_images": lambda **kwargs: self.page(self.images, "Images", kwargs),
+            "describe_workspace_bundles": lambda **kwargs: self.page(self.bundles, "Bundles", kwargs),
+            "describe_workspaces": lambda **kwargs: self.page(self.workspaces, "Workspaces", kwargs),
+            "describe_tags": lambda ResourceId: {"TagList": self.tags.get(ResourceId, [])},
+            "delete_workspace_bundle": lambda BundleId: self.delete(BundleId),
+            "delete_workspace_image": lambda ImageId: self.delete(ImageId),
+        }
+
+    def page(self, items, key, kwargs):
+        """Returns two items per page, so every list is read over several pages"""
+
+        Start = int(kwargs.get("NextToken", 0))
+        Page = {key: items[Start:Start + 2]}
+        if Start + 2 < len(items):
+            Page["NextToken"] = str(Start + 2)
+        return Page
+
+    def delete(self, resource_id):
+        if resource_id in self.failing:
+            raise ClientError({"Error": {"Code": "ResourceAssociatedException"}}, "Delete")
+        self.deleted.append(resource_id)
+        return {}
+
+
+@pytest.fixture
+def workspaces():
+    Fake = FakeWorkSpaces()
+    Fake.image("wsi-new", 1)
+    Fake.image("wsi-bundled", 40)
+    Fake.image("wsi-layer", 50)
+    Fake.image("wsi-old", 60, state="ERROR")
+    Fake.image("wsi-pending", 70, state="PENDING")
+    Fake.image("wsi-other", 90, prefix="Sales")
+    Fake.images.append({"ImageId": "wsi-manual", "Name": "Manual image", "State": "AVAILABLE", "Created": NOW})
+    Fake.bundle("wsb-new", "wsi-new", 1)
+    Fake.bundle("wsb-used", "wsi-bundled", 40)
+    Fake.bundle("wsb-old", "wsi-old", 60)
+    Fake.bundle("wsb-default", "wsi-new", 80)
+    Fake.workspaces.append({"WorkspaceId": "ws-1", "BundleId": "wsb-used"})
+    return Fake
+
+
+@pytest.fixture
+def retention(stub_client, workspaces):
+    def create(**settings):
+        Cache = LocalLayerCache()
+        Cache.put("layer", {"ImageId": "wsi-layer", "Created": 0})
+        return ArtifactRetention(
+            dict({"Prefixes": ["Finance"], "KeepNewest": 1, "MaxAgeDays": 30}, **settings),
+            protected_bundles=["wsb-default"],
+            layer_cache=Cache,
+            workspaces_client=stub_client("workspaces", workspaces.responses()),
+        )
+
+    return create
+
+
+def reasons(entries):
+    return {entry["Id"]: entry.get("Reason") for entry in entries}
+
+
+def test_series_of_pipeline_names():
+    assert series_of("Finance_Bundle-2024-05-01-10-30", ["Finance"]) == "Finance_Bundle"
+    assert series_of("Finance_Bundle-2024-05-01-10-30", ["Sales"]) is None
+    assert series_of("Finance image", ["Finance"]) is None
+
+
+def test_plan_keeps_newest_recent_and_used_artifacts(retention):
+    Plan = retention().plan()
+
+    assert reasons(Plan["Images"]["Keep"]) == {
+        "wsi-new": "Newest 1",
+        "wsi-bundled": "Used by bundle wsb-used",
+        "wsi-layer": "Cached image layer",
+        "wsi-pending": "Image is PENDING",
+    }
+    assert [(entry["Id"], entry["Bundles"]) for entry in Plan["Images"]["Delete"]] == [("wsi-old", ["wsb-old"])]
+    assert reasons(Plan["Bundles"]["Keep"]) == {
+        "wsb-new": "Newest 1",
+        "wsb-used": "Used by WorkSpace ws-1",
+        "wsb-default": "Default builder bundle",
+    }
+    assert [entry["Id"] for entry in Plan["Bundles"]["Delete"]] == ["wsb-old"]
+
+
+def test_age_window_keeps_recent_artifacts(retention):
+    Plan = retention(MaxAgeDays=65).plan()
+
+    assert reasons(Plan["Images"]["Keep"])["wsi-old"] == "Within 65 days"
+    assert Plan["Images"]["Delete"] == []
+
+
+def test_only_tagged_artifacts_are_deleted(retention, workspaces):
+    workspaces.tags["wsb-old"] = [{"Key": "Retention", "Value": "pipeline"}]
+
+    Plan = retention(Tags={"Retention": "pipeline"}).plan()
+    assert [entry["Id"] for entry in Plan["Bundles"]["Delete"]] == ["wsb-old"]
+    assert reasons(Plan["Images"]["Keep"])["wsi-old"] == "Missing retention tags"
+
+
+def test_dry_run_deletes_nothing(retention, workspaces):
+    Retention = retention(DryRun=True)
+
+    assert Retention.prune(Retention.plan()) == {"Images": [], "Bundles": []}
+    assert workspaces.deleted == []
+
+
+def test_prune_deletes_bundles_before_their_images(retention, workspaces):
+    Retention = retention(DryRun=False)
+
+    Results = Retention.prune(Retention.plan())
+    assert workspaces.deleted == ["wsb-old", "wsi-old"]
+    assert [result["Status"] for result in Results["Images"] + Results["Bundles"]] == ["Deleted", "Deleted"]
+
+
+def test_image_is_kept_when_its_bundle_is_not_deleted(retention, workspaces):
+    workspaces.failing.add("wsb-old")
+    Retention = retention(DryRun=False)
+
+    Results = Retention.prune(Retention.plan())
+    assert [(result["Id"], result["Status"]) for result in Results["Bundles"]] == [("wsb-old", "Failed")]
+    assert [(result["Id"], result["Status"]) for result in Results["Images"]] == [("wsi-old", "Skipped")]
+    assert workspaces.deleted == []
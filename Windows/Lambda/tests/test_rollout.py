@@ -0,0 +1,266 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+import time
+import pytest
+from wks_automation import rollout
+from wks_automation.rollout import FleetRollout, plan_waves, validate_rollout
+
+
+class FakeWorkSpaces:
+    """Holds the migrated WorkSpace states behind the stubbed WorkSpaces calls"""
+
+    def __init__(self):
+        self.states = {}
+        self.migrated = []
+
+    def responses(self):
+        return {
+            "describe_workspaces": self.describe_workspaces,
+            "migrate_workspace": self.migrate_workspace,
+        }
+
+    def describe_workspaces(self, WorkspaceIds):
+        assert len(WorkspaceIds) <= 25
+        return {
+            "Workspaces": [
+                {"WorkspaceId": workspace_id, "State": self.states[workspace_id]}
+                for workspace_id in WorkspaceIds
+                if workspace_id in self.states
+            ]
+        }
+
+    def migrate_workspace(self, SourceWorkspaceId, BundleId):
+        TargetId = "ws-target-" + SourceWorkspaceId
+        self.migrated.append(SourceWorkspaceId)
+        self.states[TargetId] = "PENDING"
+        return {"SourceWorkspaceId": SourceWorkspaceId, "TargetWorkspaceId": TargetId}
+
+    def finish(self, state, sources=None):
+        """Moves the migrated WorkSpaces, or only those of the given sources, to a state"""
+
+        for source in sources or self.migrated:
+            self.states["ws-target-" + source] = state
+
+
+@pytest.fixture
+def workspaces():
+    return FakeWorkSpaces()
+
+
+@pytest.fixture
+def metrics():
+    return []
+
+
+@pytest.fixture
+def create(stub_client, workspaces, metrics):
+    """Returns a function creating a FleetRollout over the fake WorkSpaces"""
+
+    def put_metric_data(Namespace, MetricData):
+        metrics.append((Namespace, MetricData))
+        return {}
+
+    def create(**settings):
+        return FleetRollout(
+            workspaces_client=stub_client("workspaces", workspaces.responses()),
+            cloudwatch_client=stub_client("cloudwatch", {"put_metric_data": put_metric_data}),
+            **settings,
+        )
+
+    return create
+
+
+def new_rollout(waves):
+    """Returns a rollout as FleetRollout.plan creates it, for the given waves of ids"""
+
+    return {
+        "Status": "IN_PROGRESS",
+        "Started": round(time.time()),
+        "Waves": [[{"WorkspaceId": workspace_id, "BundleId": "wsb-new"} for workspace_id in wave] for wave in waves],
+        "Wave": 0,
+        "Launched": 0,
+        "InFlight": [],
+        "Succeeded": 0,
+        "WaveFailed": 0,
+        "Failed": [],
+    }
+
+
+def test_plan_waves_puts_canary_first_then_batches():
+    Waves = plan_waves(list(range(12)), 2, 4)
+
+    assert Waves == [[0, 1], [2, 3, 4, 5], [6, 7, 8, 9], [10, 11]]
+
+
+def test_plan_waves_without_canary_and_with_nothing_to_migrate():
+    assert plan_waves(list(range(5)), 0, 2) == [[0, 1], [2, 3], [4]]
+    assert plan_waves([0, 1], 5, 2) == [[0, 1]]
+    assert plan_waves([], 5, 2) == []
+
+
+def test_advance_halts_on_canary_failures(create, workspaces):
+    Rollout = create(canary_size=2, batch_size=2, max_failure_rate=0.1)
+    State = new_rollout([["ws-1", "ws-2"], ["ws-3", "ws-4"]])
+
+    State, Changed = Rollout.advance(State)
+    assert Changed and workspaces.migrated == ["ws-1", "ws-2"]
+
+    workspaces.finish("AVAILABLE", ["ws-1"])
+    workspaces.finish("ERROR", ["ws-2"])
+    State, Changed = Rollout.advance(State)
+
+    assert Changed
+    assert State["Status"] == "HALTED"
+    assert State["HaltReason"] == "1 of 2 migrations failed in canary wave 1."
+    assert State["Failed"] == [{"WorkspaceId": "ws-2", "Error": "Migrated WorkSpace is ERROR."}]
+    # A halted rollout starts nothing more
+    assert Rollout.advance(State) == (State, False)
+    assert workspaces.migrated == ["ws-1", "ws-2"]
+
+
+def test_advance_moves_through_the_waves_to_complete(create, workspaces):
+    Rollout = create(canary_size=1, batch_size=2)
+    State = new_rollout([["ws-1"], ["ws-2", "ws-3"]])
+
+    State, _ = Rollout.advance(State)
+    assert workspaces.migrated == ["ws-1"]
+
+    # The next wave waits for the canary to finish
+    State, Changed = Rollout.advance(State)
+    assert not Changed and State["Wave"] == 0
+
+    workspaces.finish("AVAILABLE")
+    State, Changed = Rollout.advance(State)
+    assert Changed and State["Wave"] == 1 and State["Succeeded"] == 1
+    assert workspaces.migrated == ["ws-1", "ws-2", "ws-3"]
+
+    workspaces.finish("STOPPED")
+    State, Changed = Rollout.advance(State)
+    assert Changed
+    assert State["Status"] == "COMPLETE"
+    assert State["Succeeded"] == 3 and State["Failed"] == [] and State["InFlight"] == []
+
+
+def test_advance_keeps_migrations_under_the_concurrency_cap(create, workspaces):
+    Rollout = create(canary_size=0, batch_size=5, concurrency=2)
+    State = new_rollout([["ws-1", "ws-2", "ws-3", "ws-4", "ws-5"]])
+
+    State, _ = Rollout.advance(State)
+    assert workspaces.migrated == ["ws-1", "ws-2"]
+    assert len(State["InFlight"]) == 2 and State["Launched"] == 2
+
+    # Nothing finished, so no slot is free
+    State, Changed = Rollout.advance(State)
+    assert not Changed and len(workspaces.migrated) == 2
+
+    workspaces.finish("AVAILABLE", ["ws-1"])
+    State, Changed = Rollout.advance(State)
+    assert Changed
+    assert workspaces.migrated == ["ws-1", "ws-2", "ws-3"]
+    assert len(State["InFlight"]) == 2
+
+
+def test_advance_counts_failed_launches_against_the_wave(create, workspaces):
+    Rollout = create(canary_size=0, batch_size=4, max_failure_rate=0.5)
+    State = new_rollout([["ws-1", "ws-2", "ws-3", "ws-4"]])
+    Migrate = workspaces.migrate_workspace
+
+    def migrate_workspace(SourceWorkspaceId, BundleId):
+        if SourceWorkspaceId == "ws-2":
+            raise ValueError("Invalid bundle.")
+        return Migrate(SourceWorkspaceId, BundleId)
+
+    Rollout.workspaces_client._client.responses["migrate_workspace"] = migrate_workspace
+
+    State, _ = Rollout.advance(State)
+
+    assert State["Status"] == "IN_PROGRESS"
+    assert State["Failed"] == [{"WorkspaceId": "ws-2", "Error": "Invalid bundle."}]
+    assert len(State["InFlight"]) == 3
+
+
+def test_report_summarizes_progress_and_publishes_metrics(create, metrics, monkeypatch):
+    Rollout = create()
+    State = new_rollout([["ws-1", "ws-2"], ["ws-3", "ws-4", "ws-5"]])
+    State.update(
+        Started=1000,
+        Wave=1,
+        Succeeded=2,
+        InFlight=[{"WorkspaceId": "ws-3", "TargetWorkspaceId": "ws-target-ws-3", "Started": 1000}],
+        Failed=[{"WorkspaceId": "ws-4", "Error": "Migrated WorkSpace is ERROR."}],
+    )
+    monkeypatch.setattr(rollout.time, "time", lambda: 1000 + 1800)
+
+    Report = Rollout.report(State)
+
+    assert Report == {
+        "Status": "IN_PROGRESS",
+        "Total": 5,
+        "Succeeded": 2,
+        "Failed": 1,
+        "InFlight": 1,
+        "Wave": 2,
+        "Waves": 2,
+        "ElapsedMinutes": 30,
+        "PerHour": 4.0,
+        "Remaining": 1,
+    }
+    assert metrics[0][0] == "WKS_Automation"
+    assert {metric["MetricName"]: metric["Value"] for metric in metrics[0][1]} == {
+        "RolloutSucceeded": 2,
+        "RolloutFailed": 1,
+        "RolloutInFlight": 1,
+        "RolloutThroughput": 4.0,
+    }
+
+
+def test_report_carries_the_halt_reason_and_survives_metric_errors(create, stub_client):
+    Rollout = create()
+    Rollout.cloudwatch_client = stub_client("cloudwatch", {"put_metric_data": lambda **kwargs: 1 / 0})
+    State = new_rollout([["ws-1"]])
+    State.update(Status="HALTED", HaltReason="1 of 1 migrations failed in canary wave 1.", Wave=1)
+
+    Report = Rollout.report(State)
+
+    assert Report["HaltReason"] == "1 of 1 migrations failed in canary wave 1."
+    assert Report["Wave"] == 1 and Report["Remaining"] == 1
+
+
+def test_validate_rollout():
+    assert validate_rollout(False) == []
+    assert validate_rollout({"SourceBundleId": "wsb-old", "BatchSize": 10, "MaxFailureRate": 0.2}) == []
+    assert validate_rollout(True) == ["FleetRollout must be an object or false."]
+    assert validate_rollout("wsb-old") == ["FleetRollout must be an object or false."]
+    assert validate_rollout(
+        {
+            "SourceBundleId": 1,
+            "Batch": 5,
+            "Concurrency": 0,
+            "CanarySize": True,
+            "MaxFailureRate": 2,
+            "WorkspaceIds": "ws-1",
+        }
+    ) == [
+        "FleetRollout: unknown field Batch.",
+        "FleetRollout: SourceBundleId must be a bundle id.",
+        "FleetRollout: WorkspaceIds must be a list of WorkSpace ids.",
+        "FleetRollout: Concurrency must be a whole number of 1 or more.",
+        "FleetRollout: CanarySize must be a whole number of 0 or more.",
+        "FleetRollout: MaxFailureRate must be a number from 0 to 1.",
+    ]
@@ -0,0 +1,224 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+import pytest
+import requests
+import FN03_Configuration_Routine as FN03
+from wks_automation.routine import (
+    DEFAULT_STEP_RETRY,
+    retry_delay,
+    retry_policy,
+    split_step,
+    step_hash,
+    validate_retry,
+)
+
+INSTALL = ["RUN_COMMAND", "msiexec /i C:\\wks_automation\\app.msi /qn"]
+
+
+def test_default_step_retry_is_a_valid_policy():
+    assert validate_retry(DEFAULT_STEP_RETRY) == []
+    assert DEFAULT_STEP_RETRY["ExitCodes"] == [1618]
+    assert DEFAULT_STEP_RETRY["TransportErrors"] is True
+
+
+def test_validate_retry_reports_each_problem():
+    assert validate_retry(False) == []
+    assert validate_retry({"MaxAttempts": 0}) == []
+    assert validate_retry(True, "StepRetry") == ["StepRetry must be an object or false."]
+    assert validate_retry(
+        {
+            "Attempts": 3,
+            "MaxAttempts": -1,
+            "IntervalSeconds": 1.5,
+            "MaxDelaySeconds": True,
+            "BackoffRate": 0.5,
+            "ExitCodes": [1618, "3010"],
+            "TransportErrors": "yes",
+        },
+        "StepRetry",
+    ) == [
+        "StepRetry: unknown field Attempts.",
+        "StepRetry: MaxAttempts must be a whole number of 0 or more.",
+        "StepRetry: IntervalSeconds must be a whole number of 0 or more.",
+        "StepRetry: MaxDelaySeconds must be a whole number of 0 or more.",
+        "StepRetry: BackoffRate must be a number of 1 or more.",
+        "StepRetry: ExitCodes must be a list of exit codes.",
+        "StepRetry: TransportErrors must be true or false.",
+    ]
+
+
+def test_split_step_separates_settings_and_keeps_the_hash():
+    Settings = {"Retry": {"MaxAttempts": 5}}
+
+    assert split_step(INSTALL + [Settings]) == (INSTALL, Settings)
+    assert split_step(INSTALL) == (INSTALL, {})
+    assert split_step(["REBOOT"]) == (["REBOOT"], {})
+    assert step_hash(INSTALL + [Settings]) == step_hash(INSTALL)
+
+
+def test_retry_policy_applies_the_step_over_the_routine_over_the_defaults():
+    assert retry_policy({}) == DEFAULT_STEP_RETRY
+    Policy = retry_policy({"Retry": {"IntervalSeconds": 5}}, {"MaxAttempts": 4, "IntervalSeconds": 60})
+    assert Policy == dict(DEFAULT_STEP_RETRY, MaxAttempts=4, IntervalSeconds=5)
+    # False turns retries off at either level, and a step can turn them back on
+    assert retry_policy({}, False)["MaxAttempts"] == 0
+    assert retry_policy({"Retry": False}, {"MaxAttempts": 4})["MaxAttempts"] == 0
+    assert retry_policy({"Retry": {"MaxAttempts": 1}}, False)["MaxAttempts"] == 1
+
+
+def test_retry_delay_backs_off_up_to_the_maximum():
+    Policy = dict(DEFAULT_STEP_RETRY, IntervalSeconds=30, BackoffRate=2.0, MaxDelaySeconds=100)
+
+    assert [retry_delay(Policy, retries) for retries in (1, 2, 3, 4)] == [30, 60, 100, 100]
+    assert retry_delay(dict(Policy, BackoffRate=1), 3) == 30
+
+
+class Result:
+    def __init__(self, status_code, std_out=b""):
+        self.status_code = status_code
+        self.std_out = std_out
+        self.std_err = b""
+
+
+class FakeSession:
+    """Replays queued outcomes for the commands a routine runs. An outcome is an exit
+    code or an exception to raise."""
+
+    def __init__(self):
+        self.outcomes = {}
+        self.commands = []
+
+    def run_cmd(self, command):
+        self.commands.append(command)
+        Outcomes = self.outcomes.get(command)
+        Outcome = Outcomes.pop(0) if Outcomes else 0
+        if isinstance(Outcome, Exception):
+            raise Outcome
+        return Result(Outcome)
+
+    def run_ps(self, script):
+        return Result(0)
+
+
+@pytest.fixture
+def session(stub_client, monkeypatch):
+    Session = FakeSession()
+    SSM = stub_client("ssm", {"get_parameter": {"Parameter": {"Value": "password"}}})
+    monkeypatch.setattr(FN03.aws_client, "client", lambda service: SSM)
+    monkeypatch.setattr(FN03.winrm, "Session", lambda host, auth: Session)
+    return Session
+
+
+def event(routine, step_retry=None, remaining=None):
+    """Returns the Configuration Routine input for a routine, or its continuation"""
+
+    Event = {
+        "ImageBuilderStatus": {"Workspaces": [{"IpAddress": "10.0.0.10", "ComputerName": "WSAMZN-TEST"}]},
+        "AutomationParameters": {"InstallRoutine": routine},
+    }
+    if step_retry is not None:
+        Event["AutomationParameters"]["StepRetry"] = step_retry
+    if remaining is not None:
+        Event["InstallRoutineRemaining"] = remaining
+    return Event
+
+
+def test_exit_code_1618_is_retried_until_the_attempt_limit(session):
+    session.outcomes[INSTALL[1]] = [1618, 1618, 1618]
+
+    Output = FN03.lambda_handler(event([list(INSTALL)]), None)
+    assert Output["InstallRoutine"] == [INSTALL]
+    assert Output["InstallRoutineErrors"] == []
+    assert Output["RetryDelaySeconds"] == 30
+    assert Output["StepRetry"]["Hash"] == step_hash(INSTALL) and Output["StepRetry"]["Retries"] == 1
+    assert Output["StepRetry"]["LastError"] == [INSTALL[1], 1618, "Another installation is in progress."]
+
+    Output = FN03.lambda_handler(event([list(INSTALL)], remaining=Output), None)
+    assert Output["RetryDelaySeconds"] == 60 and Output["StepRetry"]["Retries"] == 2
+    assert Output["StepRetry"]["RetrySeconds"] >= 90
+
+    # MaxAttempts is 2 retries, so the third failure is recorded against the step
+    Output = FN03.lambda_handler(event([list(INSTALL)], remaining=Output), None)
+    assert Output["InstallRoutine"] is False and Output["StepRetry"] is False
+    assert Output["RetryDelaySeconds"] == 0
+    assert Output["InstallRoutineErrors"] == [[INSTALL[1], 1618, "Another installation is in progress."]]
+    assert Output["StepTimings"][0]["Status"] == "ERROR"
+    assert Output["StepTimings"][0]["Attempts"] == 3
+    assert Output["StepTimings"][0]["RetrySeconds"] >= 90
+    assert session.commands == [INSTALL[1]] * 3
+
+
+def test_a_retried_step_that_succeeds_records_its_attempts(session):
+    session.outcomes[INSTALL[1]] = [1618, 0]
+
+    Output = FN03.lambda_handler(event([list(INSTALL)]), None)
+    Output = FN03.lambda_handler(event([list(INSTALL)], remaining=Output), None)
+
+    assert Output["InstallRoutine"] is False and Output["InstallRoutineErrors"] == []
+    assert Output["StepTimings"][0]["Status"] == "OK"
+    assert Output["StepTimings"][0]["Attempts"] == 2
+
+
+def test_other_exit_codes_are_not_retried(session):
+    session.outcomes[INSTALL[1]] = [1619]
+
+    Output = FN03.lambda_handler(event([list(INSTALL)]), None)
+
+    assert Output["InstallRoutine"] is False
+    assert Output["InstallRoutineErrors"] == [[INSTALL[1], 1619, "File not found."]]
+    assert Output["StepTimings"][0]["Attempts"] == 1
+
+
+def test_transport_errors_are_retried_with_the_routine_policy(session):
+    session.outcomes[INSTALL[1]] = [requests.exceptions.ConnectionError("Connection reset.")]
+
+    Output = FN03.lambda_handler(event([list(INSTALL)], {"IntervalSeconds": 10, "BackoffRate": 3}), None)
+
+    assert Output["RetryDelaySeconds"] == 10
+    assert Output["StepRetry"]["LastError"] == [INSTALL[1], 1, "Connection error: Connection reset."]
+
+
+def test_transport_errors_are_recorded_when_the_policy_excludes_them(session):
+    session.outcomes[INSTALL[1]] = [requests.exceptions.ConnectionError("Connection reset.")]
+
+    Output = FN03.lambda_handler(event([list(INSTALL)], {"TransportErrors": False}), None)
+
+    assert Output["InstallRoutine"] is False
+    assert Output["InstallRoutineErrors"] == [[INSTALL[1], 1, "Connection error: Connection reset."]]
+
+
+def test_a_step_retry_setting_overrides_the_routine(session):
+    session.outcomes[INSTALL[1]] = [1618]
+    Step = INSTALL + [{"Retry": False}]
+
+    Output = FN03.lambda_handler(event([Step], {"MaxAttempts": 5}), None)
+
+    assert Output["InstallRoutine"] is False
+    assert Output["InstallRoutineErrors"] == [[INSTALL[1], 1618, "Another installation is in progress."]]
+
+
+def test_retry_delay_follows_the_step_policy_and_its_maximum(session):
+    session.outcomes[INSTALL[1]] = [1618, 1618]
+    Step = INSTALL + [{"Retry": {"MaxAttempts": 3, "IntervalSeconds": 100, "MaxDelaySeconds": 150}}]
+
+    Output = FN03.lambda_handler(event([list(Step)]), None)
+    assert Output["RetryDelaySeconds"] == 100
+    Output = FN03.lambda_handler(event([list(Step)], remaining=Output), None)
+    assert Output["RetryDelaySeconds"] == 150
+    assert Output["InstallRoutine"] == [Step]
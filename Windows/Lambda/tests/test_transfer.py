@@ -0,0 +1,206 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+import base64
+import gzip
+import hashlib
+import io
+import re
+import pytest
+import requests
+import FN03_Configuration_Routine as FN03
+from wks_automation import transfer
+from wks_automation.transfer import CHUNK_SIZE, push_bytes
+
+
+class FakeProtocol:
+    """Records the commands run over WinRM and replays the staging and restore on a
+    dictionary of files"""
+
+    def __init__(self):
+        self.files = {}
+        self.commands = []
+        self.shells = []
+        self.closed = []
+        self.chunk_status = {}
+        self.tamper = False
+
+    def open_shell(self):
+        self.shells.append("shell-" + str(len(self.shells)))
+        return self.shells[-1]
+
+    def close_shell(self, shell_id):
+        self.closed.append(shell_id)
+
+    def run_command(self, shell_id, command, arguments):
+        self.commands.append((shell_id, command, arguments))
+        return len(self.commands) - 1
+
+    def cleanup_command(self, shell_id, command_id):
+        pass
+
+    def get_command_output(self, shell_id, command_id):
+        shell_id, command, arguments = self.commands[command_id]
+        if command == "cmd":
+            return self.echo(shell_id, arguments)
+        return self.restore(arguments)
+
+    def echo(self, shell_id, arguments):
+        _, _, chunk, redirection, staging = arguments
+        number = sum(1 for shell, command, _ in self.commands if shell == shell_id and command == "cmd") - 1
+        if self.chunk_status.get(number, 0):
+            return b"", b"The system cannot find the path specified.\r\n", self.chunk_status[number]
+        # echo writes the chunk with a trailing space and a line break
+        text = chunk + " \r\n"
+        self.files[staging] = text if redirection == ">" else self.files.get(staging, "") + text
+        return b"", b"", 0
+
+    def restore(self, arguments):
+        script = base64.b64decode(arguments[-1]).decode("utf-16-le")
+        staging = re.search(r"\$Staging = '(.*)'", script).group(1)
+        destination = re.search(r"\$Destination = '(.*)'", script).group(1)
+        if staging not in self.files:
+            return b"", b"Cannot find path.\r\n", 1
+        data = gzip.decompress(base64.b64decode("".join(self.files.pop(staging).split())))
+        if self.tamper:
+            data += b"!"
+        self.files[destination] = data
+        return hashlib.sha256(data).hexdigest().encode("ascii") + b"\r\n", b"", 0
+
+
+class FakeSession:
+    def __init__(self, protocol):
+        self.protocol = protocol
+
+
+@pytest.fixture
+def protocol():
+    return FakeProtocol()
+
+
+@pytest.fixture
+def session(protocol):
+    return FakeSession(protocol)
+
+
+def test_push_bytes_writes_and_verifies_a_small_file(protocol, session):
+    Result = push_bytes(session, b"Hello, builder.", "C:\\Temp\\hello.txt")
+
+    assert Result["Verified"] and Result["Chunks"] == 1 and Result["Size"] == 15
+    assert protocol.files == {"C:\\Temp\\hello.txt": b"Hello, builder."}
+    assert [command for _, command, _ in protocol.commands] == ["cmd", "powershell"]
+    # Every command runs in the one shell, which is closed afterwards
+    assert {shell_id for shell_id, _, _ in protocol.commands} == {"shell-0"}
+    assert protocol.closed == ["shell-0"]
+
+
+def test_push_bytes_splits_into_chunks_and_appends_after_the_first(protocol, session, monkeypatch):
+    monkeypatch.setattr(transfer, "CHUNK_SIZE", 64)
+    Data = bytes(range(256)) * 8
+
+    Result = push_bytes(session, Data, "C:\\Temp\\data.bin", staging_dir="C:\\Staging\\")
+
+    Echoes = [arguments for _, command, arguments in protocol.commands if command == "cmd"]
+    assert Result["Verified"]
+    assert Result["Chunks"] == len(Echoes) == -(-Result["Compressed"] // 64) > 1
+    assert [arguments[3] for arguments in Echoes] == [">"] + [">>"] * (len(Echoes) - 1)
+    assert all(len(arguments[2]) <= 64 for arguments in Echoes)
+    assert {arguments[4] for arguments in Echoes} == {
+        "C:\\Staging\\push_" + hashlib.sha256(Data).hexdigest().upper()[:16] + ".b64"
+    }
+    assert protocol.files == {"C:\\Temp\\data.bin": Data}
+
+
+def test_push_bytes_chunks_fit_on_a_cmd_command_line():
+    assert CHUNK_SIZE + len("cmd /c echo  >> C:\\wks_automation\\push_0123456789ABCDEF.b64") < 8191
+
+
+def test_push_bytes_reports_a_sha256_mismatch(protocol, session):
+    protocol.tamper = True
+
+    Result = push_bytes(session, b"Hello, builder.", "C:\\Temp\\hello.txt")
+
+    assert not Result["Verified"]
+    assert protocol.closed == ["shell-0"]
+
+
+def test_push_bytes_raises_when_a_chunk_fails(protocol, session, monkeypatch):
+    monkeypatch.setattr(transfer, "CHUNK_SIZE", 16)
+    protocol.chunk_status = {1: 1}
+
+    with pytest.raises(RuntimeError, match="cannot find the path"):
+        push_bytes(session, b"x" * 1000 + bytes(range(256)), "C:\\Temp\\data.bin")
+
+    # Nothing after the failed chunk runs, and the shell is still closed
+    assert len(protocol.commands) == 2
+    assert protocol.closed == ["shell-0"]
+
+
+@pytest.fixture
+def errors(monkeypatch):
+    Errors = []
+    monkeypatch.setattr(FN03, "InstallRoutineErrors", Errors, raising=False)
+    return Errors
+
+
+def test_push_file_step_writes_text_and_base64_content(protocol, session, errors):
+    FN03.push_file("C:\\Temp\\text.txt", "line one\nline two", session)
+    FN03.push_file("C:\\Temp\\binary.bin", "base64:" + base64.b64encode(b"\x00\x01\x02").decode("ascii"), session)
+
+    assert errors == []
+    assert protocol.files == {"C:\\Temp\\text.txt": b"line one\nline two", "C:\\Temp\\binary.bin": b"\x00\x01\x02"}
+
+
+def test_push_file_step_reads_s3_content(protocol, session, errors, stub_client, monkeypatch):
+    Requests = []
+
+    def get_object(Bucket, Key):
+        Requests.append((Bucket, Key))
+        return {"Body": io.BytesIO(b"from s3")}
+
+    S3 = stub_client("s3", {"get_object": get_object})
+    monkeypatch.setattr(FN03.aws_client, "client", lambda service: S3)
+
+    FN03.push_file("C:\\Temp\\s3.txt", "s3://bucket/folder/file.txt", session)
+
+    assert Requests == [("bucket", "folder/file.txt")]
+    assert errors == [] and protocol.files == {"C:\\Temp\\s3.txt": b"from s3"}
+
+
+def test_push_file_step_records_failures(protocol, session, errors):
+    protocol.tamper = True
+    FN03.push_file("C:\\Temp\\tampered.txt", "content", session)
+    protocol.tamper = False
+    protocol.chunk_status = {0: 1}
+    FN03.push_file("C:\\Temp\\failed.txt", "content", session)
+
+    assert errors == [
+        ["C:\\Temp\\tampered.txt", 1, "Pushed file failed SHA256 verification."],
+        ["C:\\Temp\\failed.txt", 1, "Unable to push file."],
+    ]
+
+
+def test_push_file_step_leaves_transport_errors_to_the_retry_policy(protocol, session, errors, monkeypatch):
+    def open_shell():
+        raise requests.exceptions.ConnectionError("Connection refused.")
+
+    monkeypatch.setattr(protocol, "open_shell", open_shell)
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        FN03.push_file("C:\\Temp\\text.txt", "content", session)
+    assert errors == []
@@ -0,0 +1,173 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import pytest
+from botocore.exceptions import ClientError
+from wks_automation import triggers
+from wks_automation.aws_client import ThrottlingError
+from wks_automation.triggers import BUILDS_PREFIX, PENDING_KEY, BuildTrigger, LocalTriggerStore, s3_changes
+
+STATE_MACHINE_ARN = "arn:aws:states:us-east-1:111122223333:stateMachine:WKS_Automation"
+TOOLS_URL = "https://downloads.example.com/tools.msi"
+
+# 2023-11-14 22:13:20 UTC
+START = 1700000000
+
+DEFINITIONS = {
+    "finance": {
+        "InstallRoutine": [
+            ["DOWNLOAD_S3", "s3://installers/excel/setup.exe"],
+            ["DOWNLOAD_HTTP", TOOLS_URL],
+        ],
+    },
+    "sales": {
+        "Layers": {
+            "BaseRoutine": [["DOWNLOAD_S3", "s3://installers/base/agent.msi"]],
+            "Children": [{"InstallRoutine": [["DOWNLOAD_S3", "s3://installers/excel/setup.exe"]]}],
+        },
+    },
+}
+
+
+class FakeStepFunctions:
+    """Records the executions started through the stubbed start_execution. Once one
+    execution has started, later starts raise error if it is set."""
+
+    def __init__(self):
+        self.started = []
+        self.error = None
+
+    def start_execution(self, stateMachineArn, name, input):
+        if self.error and self.started:
+            raise self.error
+        self.started.append(name)
+        return {"executionArn": execution_arn(name)}
+
+
+def execution_arn(name):
+    return STATE_MACHINE_ARN.replace(":stateMachine:", ":execution:") + ":" + name
+
+
+@pytest.fixture
+def stepfunctions():
+    return FakeStepFunctions()
+
+
+@pytest.fixture
+def trigger(stub_client, stepfunctions):
+    return BuildTrigger(
+        LocalTriggerStore(DEFINITIONS),
+        STATE_MACHINE_ARN,
+        debounce_minutes=15,
+        max_wait_minutes=120,
+        sfn_client=stub_client("stepfunctions", {"start_execution": stepfunctions.start_execution}),
+    )
+
+
+def test_index_covers_layered_builds(trigger):
+    Index = trigger.reindex()
+
+    assert Index["Objects"] == {
+        "installers/base/agent.msi": ["sales"],
+        "installers/excel/setup.exe": ["finance", "sales"],
+    }
+    assert Index["Urls"] == {TOOLS_URL: ["finance"]}
+
+
+def test_s3_changes_from_events():
+    EventBridge = {
+        "source": "aws.s3",
+        "detail-type": "Object Created",
+        "detail": {"bucket": {"name": "installers"}, "object": {"key": "excel/setup.exe"}},
+    }
+    Notification = {
+        "Records": [
+            {
+                "eventSource": "aws:s3",
+                "eventName": "ObjectRemoved:Delete",
+                "s3": {"bucket": {"name": "installers"}, "object": {"key": "excel/new+setup.exe"}},
+            }
+        ]
+    }
+
+    assert s3_changes(EventBridge) == [{"Object": "installers/excel/setup.exe", "Deleted": False}]
+    assert s3_changes(Notification) == [{"Object": "installers/excel/new setup.exe", "Deleted": True}]
+
+
+def test_changes_together_start_each_build_once(trigger, stepfunctions):
+    assert trigger.record(["installers/excel/setup.exe"], now=START) == ["finance", "sales"]
+    assert trigger.record(["installers/base/agent.msi", "installers/unused.zip"], now=START + 600) == ["sales"]
+
+    assert trigger.flush(now=START + 900) == {
+        "Started": {"finance": execution_arn("finance-20231114222820")},
+        "Waiting": ["sales"],
+    }
+    assert trigger.flush(now=START + 1499)["Started"] == {}
+
+    assert trigger.flush(now=START + 1500) == {
+        "Started": {"sales": execution_arn("sales-20231114223820")},
+        "Waiting": [],
+    }
+    assert stepfunctions.started == ["finance-20231114222820", "sales-20231114223820"]
+    assert trigger.flush(now=START + 3600) == {"Started": {}, "Waiting": []}
+
+
+def test_changes_that_keep_arriving_start_after_max_wait(trigger):
+    for minute in range(0, 120, 10):
+        trigger.record(["installers/base/agent.msi"], now=START + minute * 60)
+        assert trigger.flush(now=START + minute * 60 + 60)["Started"] == {}
+
+    assert list(trigger.flush(now=START + 120 * 60)["Started"]) == ["sales"]
+
+
+def test_removed_definition_is_dropped(trigger):
+    trigger.record(["installers/excel/setup.exe"], now=START)
+    del trigger.store.objects[BUILDS_PREFIX + "finance.json"]
+
+    assert trigger.flush(now=START + 900) == {
+        "Started": {"sales": execution_arn("sales-20231114222820")},
+        "Waiting": [],
+    }
+
+
+def test_failed_start_leaves_the_rest_pending(trigger, stepfunctions):
+    stepfunctions.error = ClientError({"Error": {"Code": "StateMachineDoesNotExist"}}, "StartExecution")
+    trigger.record(["installers/excel/setup.exe"], now=START)
+
+    assert trigger.flush(now=START + 900) == {
+        "Started": {"finance": execution_arn("finance-20231114222820")},
+        "Waiting": ["sales"],
+    }
+
+
+def test_throttled_start_is_raised_and_stays_pending(trigger, stepfunctions):
+    stepfunctions.error = ClientError({"Error": {"Code": "ThrottlingException"}}, "StartExecution")
+    trigger.record(["installers/excel/setup.exe"], now=START)
+
+    with pytest.raises(ThrottlingError):
+        trigger.flush(now=START + 900)
+    assert list(trigger.store.load(PENDING_KEY, {})) == ["sales"]
+
+
+def test_url_changes_are_detected_after_the_first_check(trigger, monkeypatch):
+    Versions = iter([{"ETag": '"1"'}, {"ETag": '"1"'}, {"ETag": '"2"'}])
+    monkeypatch.setattr(triggers, "http_validators", lambda url: next(Versions))
+
+    assert trigger.check_urls(now=START) == []
+    assert trigger.check_urls(now=START + 60) == []
+    assert trigger.check_urls(now=START + 120) == [TOOLS_URL]
+    assert list(trigger.store.load(PENDING_KEY, {})) == ["finance"]
@@ -0,0 +1,322 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import json
+import logging
+import threading
+import time
+from botocore.exceptions import ClientError
+from wks_automation import aws_client
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Parameter store paths holding build slots and queued build requests
+SLOT_PARAMETER_PATH = "/wks_automation/slots/"
+QUEUE_PARAMETER_PATH = "/wks_automation/queue/"
+
+# Pool name used for the account-wide concurrency limit
+ACCOUNT_POOL = "account"
+
+# Pool holding one slot per admitted request, so concurrent schedulers admit it only once
+ADMISSION_POOL = "admitted"
+
+# Slots older than this are treated as abandoned by an execution that never released them
+DEFAULT_SLOT_TTL = 86400
+
+METRIC_NAMESPACE = "WKS_Automation"
+
+
+class SsmSlotStore:
+    """Stores build slots and queued requests as parameters in parameter store
+
+    Slots are fixed parameter names per pool, claimed with Overwrite=False so two
+    schedulers can never hand out the same slot.
+    """
+
+    def __init__(self, ssm_client=None):
+        self.ssm_client = ssm_client or aws_client.client("ssm")
+
+    def _list(self, path):
+        Parameters = {}
+        paginator = self.ssm_client.get_paginator("get_parameters_by_path")
+        for page in paginator.paginate(Path=path, Recursive=True):
+            for parameter in page["Parameters"]:
+                Parameters[parameter["Name"]] = json.loads(parameter["Value"])
+        return Parameters
+
+    def _delete(self, name):
+        try:
+            self.ssm_client.delete_parameter(Name=name)
+        except ClientError as error:
+            if error.response["Error"]["Code"] != "ParameterNotFound":
+                raise
+
+    def claim(self, pool, index, value):
+        """Claims a slot, returning False if it is already taken
+
+        :param pool: string, directory id, ACCOUNT_POOL or an ADMISSION_POOL entry
+        :param index: integer, slot number within the pool
+        :param value: dictionary stored with the slot
+        """
+
+        try:
+            self.ssm_client.put_parameter(
+                Name=SLOT_PARAMETER_PATH + pool + "/" + str(index),
+                Description="WorkSpaces automation pipeline build slot.",
+                Value=json.dumps(value),
+                Type="String",
+                Overwrite=False,
+                Tier="Standard",
+            )
+            return True
+        except ClientError as error:
+            if error.response["Error"]["Code"] == "ParameterAlreadyExists":
+                return False
+            raise
+
+    def free(self, pool, index):
+        self._delete(SLOT_PARAMETER_PATH + pool + "/" + str(index))
+
+    def slots(self):
+        """Returns all claimed slots as a dictionary of (pool, index) to slot value"""
+
+        Slots = {}
+        for name, value in self._list(SLOT_PARAMETER_PATH).items():
+            pool, index = name[len(SLOT_PARAMETER_PATH):].rsplit("/", 1)
+            Slots[(pool, int(index))] = value
+        return Slots
+
+    def enqueue(self, holder, entry):
+        self.ssm_client.put_parameter(
+            Name=QUEUE_PARAMETER_PATH + holder,
+            Description="WorkSpaces automation pipeline queued build request.",
+            Value=json.dumps(entry),
+            Type="String",
+            Overwrite=True,
+            Tier="Standard",
+        )
+
+    def dequeue(self, holder):
+        self._delete(QUEUE_PARAMETER_PATH + holder)
+
+    def queue(self):
+        """Returns all queued requests as a dictionary of holder to entry"""
+
+        return {
+            name[len(QUEUE_PARAMETER_PATH):]: value
+            for name, value in self._list(QUEUE_PARAMETER_PATH).items()
+        }
+
+
+class LocalSlotStore:
+    """In-memory stand-in for SsmSlotStore, for local runs and tests"""
+
+    def __init__(self):
+        self.slot_values = {}
+        self.queue_entries = {}
+        self.lock = threading.Lock()
+
+    def claim(self, pool, index, value):
+        with self.lock:
+            if (pool, index) in self.slot_values:
+                return False
+            self.slot_values[(pool, index)] = value
+            return True
+
+    def free(self, pool, index):
+        with self.lock:
+            self.slot_values.pop((pool, index), None)
+
+    def slots(self):
+        with self.lock:
+            return dict(self.slot_values)
+
+    def enqueue(self, holder, entry):
+        with self.lock:
+            self.queue_entries[holder] = entry
+
+    def dequeue(self, holder):
+        with self.lock:
+            self.queue_entries.pop(holder, None)
+
+    def queue(self):
+        with self.lock:
+            return dict(self.queue_entries)
+
+
+class AdmissionController:
+    """Admits queued image builds under per-directory and per-account concurrency limits
+
+    Requests are queued with a Step Functions task token. The scheduler admits the
+    highest priority, longest waiting requests whenever slots are free, by claiming one
+    account slot and one directory slot and resuming the execution with SendTaskSuccess.
+    """
+
+    def __init__(
+        self,
+        per_directory,
+        per_account,
+        store=None,
+        sfn_client=None,
+        cloudwatch_client=None,
+        ttl=DEFAULT_SLOT_TTL,
+    ):
+        self.per_directory = per_directory
+        self.per_account = per_account
+        self.store = store or SsmSlotStore()
+        self.sfn_client = sfn_client or aws_client.client("stepfunctions")
+        self.cloudwatch_client = cloudwatch_client or aws_client.client("cloudwatch")
+        self.ttl = ttl
+
+    def request(self, holder, directory, task_token, priority=0):
+        """Queues a build request and runs the scheduler
+
+        :param holder: string, pipeline execution name
+        :param directory: string, WorkSpaces directory id the build runs in
+        :param task_token: string, Step Functions task token to resume the execution
+        :param priority: integer, higher priorities are admitted first
+        :return: dictionary of scheduling results
+        """
+
+        logger.info("Queueing build request %s for directory %s at priority %s.", holder, directory, priority)
+        self.store.enqueue(
+            holder,
+            {
+                "Directory": directory,
+                "Priority": int(priority),
+                "Enqueued": time.time(),
+                "TaskToken": task_token,
+            },
+        )
+        return self.schedule()
+
+    def release(self, holder):
+        """Frees the slots and queue entry held by an execution and runs the scheduler
+
+        :param holder: string, pipeline execution name
+        :return: dictionary of scheduling results
+        """
+
+        for (pool, index), value in self.store.slots().items():
+            if value["Holder"] == holder:
+                logger.info("Releasing build slot %s/%s held by %s.", pool, index, holder)
+                self.store.free(pool, index)
+        self.store.dequeue(holder)
+        return self.schedule()
+
+    def _claim(self, pool, size, holder, Taken):
+        Value = {"Holder": holder, "Expires": time.time() + self.ttl}
+        for index in range(size):
+            if (pool, index) not in Taken and self.store.claim(pool, index, Value):
+                Taken[(pool, index)] = Value
+                return index
+        return None
+
+    def schedule(self):
+        """Admits queued requests while slots are free
+
+        :return: dictionary with the executions admitted, queue depth and active builds
+        """
+
+        Now = time.time()
+        Taken = {}
+        for (pool, index), value in self.store.slots().items():
+            if value["Expires"] < Now:
+                logger.info("Freeing expired build slot %s/%s held by %s.", pool, index, value["Holder"])
+                self.store.free(pool, index)
+            else:
+                Taken[(pool, index)] = value
+
+        Queue = sorted(
+            self.store.queue().items(),
+            key=lambda item: (-item[1]["Priority"], item[1]["Enqueued"]),
+        )
+
+        # Requests leave the queue when admitted, or when their execution is gone
+        Admitted = []
+        Dequeued = 0
+        for holder, entry in Queue:
+            AccountSlot = self._claim(ACCOUNT_POOL, self.per_account, holder, Taken)
+            if AccountSlot is None:
+                logger.info("Account build limit of %s reached, leaving requests queued.", self.per_account)
+                break
+
+            DirectorySlot = self._claim(entry["Directory"], self.per_directory, holder, Taken)
+            if DirectorySlot is None:
+                # Directory is full, give the account slot to a request for another directory
+                self.store.free(ACCOUNT_POOL, AccountSlot)
+                del Taken[(ACCOUNT_POOL, AccountSlot)]
+                continue
+
+            # Another scheduler may have admitted this request since the queue was read
+            Slots = [(ACCOUNT_POOL, AccountSlot), (entry["Directory"], DirectorySlot)]
+            if self._claim(ADMISSION_POOL + "/" + holder, 1, holder, Taken) is None:
+                logger.info("Build %s was already admitted, releasing the slots claimed for it.", holder)
+                for key in Slots:
+                    self.store.free(*key)
+                    del Taken[key]
+                Dequeued += 1
+                continue
+            Slots.append((ADMISSION_POOL + "/" + holder, 0))
+
+            WaitTime = round(Now - entry["Enqueued"], 2)
+            try:
+                self.sfn_client.send_task_success(
+                    taskToken=entry["TaskToken"],
+                    output=json.dumps(
+                        {"Admitted": True, "WaitTime": WaitTime, "Priority": entry["Priority"]}
+                    ),
+                )
+                logger.info("Admitted build %s after waiting %s seconds.", holder, WaitTime)
+                Admitted.append({"Holder": holder, "WaitTime": WaitTime})
+            except ClientError as error:
+                # Execution is gone (stopped or timed out), hand its slots back
+                logger.error(error)
+                logger.info("Unable to resume %s, releasing its build slots.", holder)
+                for key in Slots:
+                    self.store.free(*key)
+                    del Taken[key]
+            self.store.dequeue(holder)
+            Dequeued += 1
+
+        Result = {
+            "Admitted": Admitted,
+            "QueueDepth": len(Queue) - Dequeued,
+            "ActiveBuilds": len([key for key in Taken if key[0] == ACCOUNT_POOL]),
+        }
+        self.publish_metrics(Result)
+        return Result
+
+    def publish_metrics(self, Result):
+        """Publishes queue depth, active builds and admission wait times to CloudWatch
+
+        :param Result: dictionary returned by schedule
+        """
+
+        MetricData = [
+            {"MetricName": "QueueDepth", "Value": Result["QueueDepth"], "Unit": "Count"},
+            {"MetricName": "ActiveBuilds", "Value": Result["ActiveBuilds"], "Unit": "Count"},
+        ]
+        MetricData.extend(
+            {"MetricName": "AdmissionWaitTime", "Value": admitted["WaitTime"], "Unit": "Seconds"}
+            for admitted in Result["Admitted"]
+        )
+        try:
+            self.cloudwatch_client.put_metric_data(Namespace=METRIC_NAMESPACE, MetricData=MetricData)
+        except Exception as e:
+            logger.error(e)
+            logger.info("Unable to publish admission metrics.")
@@ -0,0 +1,416 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import functools
+import logging
+import random
+import threading
+import time
+import boto3
+from botocore import xform_name
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Error codes AWS services return when a request is throttled
+THROTTLING_ERROR_CODES = {
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottledException",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+    "ProvisionedThroughputExceededException",
+    "TransactionInProgressException",
+    "RequestThrottled",
+    "SlowDown",
+    "PriorRequestNotComplete",
+    "EC2ThrottledException",
+}
+
+# Sustained requests per second allowed per API operation, by service. Bursts up to
+# BUCKET_CAPACITY requests are allowed before calls are delayed.
+DEFAULT_RATES = {
+    "workspaces": 2.0,
+    "ec2": 10.0,
+    "ssm": 5.0,
+    "apigateway": 1.0,
+    "s3": 50.0,
+    "sns": 10.0,
+    "sts": 10.0,
+    "stepfunctions": 5.0,
+    "cloudwatch": 10.0,
+}
+DEFAULT_RATE = 5.0
+BUCKET_CAPACITY = 5
+
+# botocore retries after the first attempt (adaptive mode), and further full jitter retries by the
+# wrapper once botocore gives up on a throttled call
+SDK_MAX_ATTEMPTS = 5
+THROTTLE_RETRIES = 2
+THROTTLE_BACKOFF_BASE = 1.0
+THROTTLE_BACKOFF_CAP = 20.0
+
+# Client methods that do not send a request and are passed through unthrottled
+PASSTHROUGH_ATTRIBUTES = {
+    "meta",
+    "exceptions",
+    "can_paginate",
+    "get_waiter",
+    "generate_presigned_url",
+    "generate_presigned_post",
+}
+
+
+class ThrottlingError(Exception):
+    """Raised when a call is still throttled after all retries
+
+    Step Functions sees this as the ThrottlingError error name, so states can retry it.
+    """
+
+
+def is_throttling_error(error):
+    """Returns True if the exception is a throttling error from an AWS service
+
+    :param error: exception
+    :return: boolean
+    """
+
+    if isinstance(error, ThrottlingError):
+        return True
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES
+    return False
+
+
+class TokenBucket:
+    """Thread-safe token bucket, refilled at a fixed rate up to its capacity"""
+
+    def __init__(self, rate, capacity=BUCKET_CAPACITY):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Takes one token, sleeping until one is available
+
+        :return: seconds spent waiting
+        """
+
+        Waited = 0.0
+        while True:
+            with self.lock:
+                Now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (Now - self.updated) * self.rate)
+                self.updated = Now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return Waited
+                Delay = (1 - self.tokens) / self.rate
+            time.sleep(Delay)
+            Waited += Delay
+
+
+class ApiCounters:
+    """Counts calls, retries, throttles and rate limit waits per API operation"""
+
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def add(self, key, name, value=1):
+        with self.lock:
+            Counts = self.counts.setdefault(
+                key, {"Calls": 0, "Retries": 0, "Throttles": 0, "Errors": 0, "WaitTime": 0.0}
+            )
+            Counts[name] += value
+
+    def snapshot(self):
+        """Returns a copy of the counters, with totals across all operations"""
+
+        with self.lock:
+            Operations = {key: dict(value) for key, value in self.counts.items()}
+        Totals = {"Calls": 0, "Retries": 0, "Throttles": 0, "Errors": 0, "WaitTime": 0.0}
+        for value in Operations.values():
+            for name in Totals:
+                Totals[name] += value[name]
+        Totals["WaitTime"] = round(Totals["WaitTime"], 3)
+        return {"Totals": Totals, "Operations": Operations}
+
+    def reset(self):
+        with self.lock:
+            self.counts = {}
+
+
+# Buckets and counters are shared by every client in the Lambda execution environment
+_buckets = {}
+_buckets_lock = threading.Lock()
+counters = ApiCounters()
+
+
+def get_bucket(service, operation, rates=None, region=None):
+    """Returns the shared token bucket for an API operation in a Region
+
+    API rate limits apply per Region, so clients for different Regions do not share
+    a bucket.
+
+    :param service: string, boto3 service name
+    :param operation: string, client method name
+    :param rates (optional): dictionary of service name to requests per second
+    :param region (optional): string, Region of the client
+    :return: TokenBucket
+    """
+
+    Key = service + "." + operation
+    if region:
+        Key = Key + "@" + region
+    with _buckets_lock:
+        if Key not in _buckets:
+            Rate = (rates or DEFAULT_RATES).get(service, DEFAULT_RATE)
+            _buckets[Key] = TokenBucket(Rate)
+        return _buckets[Key]
+
+
+# Creates the underlying clients, and optionally wraps every client attribute. Both are
+# replaced by the wks_automation.replay recorder and replayer.
+client_factory = boto3.client
+tap = None
+
+
+class RateLimitedClient:
+    """Wraps a boto3 client with per-API token buckets, throttle retries and counters
+
+    Any object with boto3-style methods can be wrapped, which allows the wrapper to be
+    exercised against ThrottlingStubClient without calling AWS.
+    """
+
+    def __init__(self, client, service, rates=None, throttle_retries=THROTTLE_RETRIES):
+        self._client = client
+        self._service = service
+        self._rates = rates
+        self._throttle_retries = throttle_retries
+
+        # Count throttled attempts that botocore retries internally. The hook sees every
+        # attempt, including the last, so _call only counts throttles without it.
+        meta = getattr(client, "meta", None)
+        self._region = getattr(meta, "region_name", None)
+        self._hooked = meta is not None
+        if meta is not None:
+            ServiceId = meta.service_model.service_id.hyphenize()
+            meta.events.register_first("needs-retry." + ServiceId, self._on_needs_retry)
+
+    def _on_needs_retry(self, response=None, operation=None, **kwargs):
+        if response is not None and operation is not None:
+            Code = response[1].get("Error", {}).get("Code")
+            if Code in THROTTLING_ERROR_CODES:
+                counters.add(self._service + "." + xform_name(operation.name), "Throttles")
+        return None
+
+    def __getattr__(self, name):
+        if name == "get_paginator":
+            return self._get_paginator
+        attribute = getattr(self._client, name)
+        if tap is not None:
+            attribute = tap(self._service, name, attribute)
+        if name in PASSTHROUGH_ATTRIBUTES or name.startswith("_") or not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            return self._call(name, attribute, *args, **kwargs)
+
+        return call
+
+    def _get_paginator(self, operation):
+        """Returns the client's paginator, with each page request sent through the token
+        bucket, throttle retries and counters of the operation
+
+        botocore has no public hook for page requests. Paginator.paginate hands the
+        paginator's _method, the client method, to the PageIterator, which calls it once
+        per page, so replacing _method lets a throttled page be retried without starting
+        the pagination again. tests/test_aws_client.py checks this against the installed
+        botocore. A paginator without _method has its pages rate limited and counted as
+        they are yielded instead, leaving throttled pages to botocore's own retries, and
+        its pages are not recorded by wks_automation.replay.
+        """
+
+        paginator = self._client.get_paginator(operation)
+        method = getattr(paginator, "_method", None)
+        if not callable(method):
+            logger.warning("%s.%s paginator has no _method, limiting pages as yielded.", self._service, operation)
+            return RateLimitedPaginator(self, operation, paginator)
+        if tap is not None:
+            method = tap(self._service, "paginate." + operation, method)
+        paginator._method = functools.partial(self._call, operation, method)
+        return paginator
+
+    def _pages(self, operation, pages):
+        """Yields the pages of a paginator, waiting for the token bucket before each one
+
+        :param operation: string, client method name
+        :param pages: iterable of pages
+        """
+
+        Key = self._service + "." + operation
+        Bucket = get_bucket(self._service, operation, self._rates, self._region)
+        iterator = iter(pages)
+        while True:
+            # The wait is taken before knowing whether another page follows
+            counters.add(Key, "WaitTime", Bucket.acquire())
+            try:
+                page = next(iterator)
+            except StopIteration:
+                return
+            except ClientError as error:
+                counters.add(Key, "Calls")
+                counters.add(Key, "Errors")
+                if is_throttling_error(error):
+                    if not self._hooked:
+                        counters.add(Key, "Throttles")
+                    raise ThrottlingError(Key + " throttled: " + str(error)) from error
+                raise
+            counters.add(Key, "Calls")
+            if isinstance(page, dict):
+                counters.add(Key, "Retries", page.get("ResponseMetadata", {}).get("RetryAttempts", 0))
+            yield page
+
+    def _call(self, name, method, /, *args, **kwargs):
+        # Positional only, API arguments such as start_execution's name are passed on
+        Key = self._service + "." + name
+        Bucket = get_bucket(self._service, name, self._rates, self._region)
+        Attempt = 0
+        while True:
+            counters.add(Key, "WaitTime", Bucket.acquire())
+            counters.add(Key, "Calls")
+            try:
+                response = method(*args, **kwargs)
+            except ClientError as error:
+                counters.add(Key, "Retries", error.response.get("ResponseMetadata", {}).get("RetryAttempts", 0))
+                if not is_throttling_error(error):
+                    counters.add(Key, "Errors")
+                    raise
+                if not self._hooked:
+                    counters.add(Key, "Throttles")
+                if Attempt >= self._throttle_retries:
+                    counters.add(Key, "Errors")
+                    logger.error("%s throttled after %s retries.", Key, Attempt)
+                    raise ThrottlingError(Key + " throttled: " + str(error)) from error
+                Attempt += 1
+                counters.add(Key, "Retries")
+                Delay = random.uniform(0, min(THROTTLE_BACKOFF_CAP, THROTTLE_BACKOFF_BASE * 2 ** Attempt))
+                logger.info("%s throttled, retrying in %.2f seconds.", Key, Delay)
+                time.sleep(Delay)
+                continue
+
+            if isinstance(response, dict):
+                counters.add(Key, "Retries", response.get("ResponseMetadata", {}).get("RetryAttempts", 0))
+            return response
+
+
+class RateLimitedPaginator:
+    """Wraps a paginator whose page requests cannot be reached, rate limiting each page
+    as it is yielded"""
+
+    def __init__(self, client, operation, paginator):
+        self._client = client
+        self._operation = operation
+        self._paginator = paginator
+
+    def __getattr__(self, name):
+        return getattr(self._paginator, name)
+
+    def paginate(self, **kwargs):
+        return self._client._pages(self._operation, self._paginator.paginate(**kwargs))
+
+
+def client(service, rates=None, max_attempts=SDK_MAX_ATTEMPTS, **kwargs):
+    """Creates a boto3 client using adaptive retry mode, wrapped in RateLimitedClient
+
+    :param service: string, boto3 service name
+    :param rates (optional): dictionary of service name to requests per second
+    :param max_attempts (optional): botocore retries per call, after the first attempt
+    :return: RateLimitedClient
+    """
+
+    Retries = Config(retries={"mode": "adaptive", "max_attempts": max_attempts})
+    if "config" in kwargs:
+        Retries = kwargs.pop("config").merge(Retries)
+    return RateLimitedClient(client_factory(service, config=Retries, **kwargs), service, rates)
+
+
+class ThrottlingStubClient:
+    """Local stand-in for a boto3 client that injects throttling errors
+
+    :param responses: dictionary of method name to response, or to a function called
+        with the request arguments
+    :param throttle_first: number of calls to each method that are throttled first
+    :param throttle_rate: probability any later call is throttled
+    """
+
+    # No botocore metadata, so RateLimitedClient does not register retry hooks
+    meta = None
+
+    def __init__(self, responses=None, throttle_first=0, throttle_rate=0.0, seed=None):
+        self.responses = responses or {}
+        self.throttle_first = throttle_first
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            with self.lock:
+                Count = self.calls.get(name, 0)
+                self.calls[name] = Count + 1
+                Throttled = Count < self.throttle_first or self.random.random() < self.throttle_rate
+            if Throttled:
+                raise ClientError(
+                    {
+                        "Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"},
+                        "ResponseMetadata": {"RetryAttempts": 0},
+                    },
+                    name,
+                )
+            response = self.responses.get(name, {})
+            return response(*args, **kwargs) if callable(response) else response
+
+        return call
+
+    def get_paginator(self, operation):
+        return StubPaginator(getattr(self, operation))
+
+
+class StubPaginator:
+    """Pages through a ThrottlingStubClient method, following NextToken like a botocore
+    paginator. Each page is requested through _method."""
+
+    def __init__(self, method):
+        self._method = method
+
+    def paginate(self, **kwargs):
+        while True:
+            page = self._method(**kwargs)
+            yield page
+            if not page.get("NextToken"):
+                return
+            kwargs = dict(kwargs, NextToken=page["NextToken"])
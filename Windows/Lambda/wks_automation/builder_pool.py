@@ -0,0 +1,392 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import json
+import logging
+import os
+import threading
+import time
+from botocore.exceptions import ClientError
+from wks_automation import aws_client
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Parameter store path holding one parameter per pooled builder WorkSpace
+POOL_PARAMETER_PATH = "/wks_automation/pool/"
+
+# Pooled builders that are still running after being provisioned are stopped by the
+# refill, this timeout only applies if a refill does not run
+POOL_AUTO_STOP_MINUTES = 60
+
+# AutoStop timeout a claimed builder is given, the same as builders created by the pipeline
+BUILDER_AUTO_STOP_MINUTES = 180
+
+# WorkSpaces states a pooled builder can be claimed in, fastest to use first
+CLAIMABLE_STATES = ["AVAILABLE", "STOPPED", "PENDING", "STARTING", "STOPPING"]
+
+# States a pooled builder returns from by itself, it stays in the pool but is not claimed
+TRANSIENT_STATES = ["REBOOTING", "REBUILDING", "RESTORING", "MAINTENANCE", "ADMIN_MAINTENANCE", "UPDATING"]
+
+# States a pooled builder does not recover from, it is terminated so its user is freed
+FAILED_STATES = ["ERROR", "UNHEALTHY", "IMPAIRED", "SUSPENDED"]
+
+METRIC_NAMESPACE = "WKS_Automation"
+
+
+def spec_key(bundle_id, compute_type):
+    """Returns the pool name for a base bundle and compute type
+
+    :param bundle_id: string
+    :param compute_type: string
+    :return: string
+    """
+
+    return bundle_id + "_" + compute_type
+
+
+def pool_from_environment():
+    """Creates a BuilderPool from the Builder_Pool_* environment variables
+
+    :return: BuilderPool, or None if no pool is configured
+    """
+
+    Specs = [spec for spec in json.loads(os.environ.get("Builder_Pool_Config", "[]")) if int(spec["Size"]) > 0]
+    Users = [user.strip() for user in os.environ.get("Builder_Pool_Users", "").split(",") if user.strip()]
+    if not Specs or not Users:
+        return None
+
+    return BuilderPool(
+        os.environ["Default_DirectoryId"],
+        Specs,
+        Users,
+        idle_cost_per_hour=float(os.environ.get("Builder_Pool_Idle_Cost", 0)),
+    )
+
+
+class SsmPoolStore:
+    """Stores pooled builders as parameters in parameter store
+
+    A builder is claimed by deleting its parameter. Only one caller can delete a
+    parameter, so two pipelines never claim the same builder.
+    """
+
+    def __init__(self, ssm_client=None):
+        self.ssm_client = ssm_client or aws_client.client("ssm")
+
+    def add(self, pool, workspace_id, record):
+        self.ssm_client.put_parameter(
+            Name=POOL_PARAMETER_PATH + pool + "/" + workspace_id,
+            Description="WorkSpaces automation pipeline pooled builder.",
+            Value=json.dumps(record),
+            Type="String",
+            Overwrite=True,
+            Tier="Standard",
+        )
+
+    def remove(self, pool, workspace_id):
+        """Removes a builder from the pool
+
+        :return: True if this call removed it, False if it was already gone
+        """
+
+        try:
+            self.ssm_client.delete_parameter(Name=POOL_PARAMETER_PATH + pool + "/" + workspace_id)
+            return True
+        except ClientError as error:
+            if error.response["Error"]["Code"] == "ParameterNotFound":
+                return False
+            raise
+
+    def members(self, pool):
+        """Returns the pooled builders as a dictionary of WorkSpace id to record"""
+
+        Members = {}
+        paginator = self.ssm_client.get_paginator("get_parameters_by_path")
+        for page in paginator.paginate(Path=POOL_PARAMETER_PATH + pool):
+            for parameter in page["Parameters"]:
+                Members[parameter["Name"].rsplit("/", 1)[-1]] = json.loads(parameter["Value"])
+        return Members
+
+
+class LocalPoolStore:
+    """In-memory stand-in for SsmPoolStore, for local runs and tests"""
+
+    def __init__(self):
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def add(self, pool, workspace_id, record):
+        with self.lock:
+            self.pools.setdefault(pool, {})[workspace_id] = record
+
+    def remove(self, pool, workspace_id):
+        with self.lock:
+            return self.pools.get(pool, {}).pop(workspace_id, None) is not None
+
+    def members(self, pool):
+        with self.lock:
+            return dict(self.pools.get(pool, {}))
+
+
+class BuilderPool:
+    """Keeps stopped builder WorkSpaces ready per base bundle and compute type
+
+    :param directory: string, WorkSpaces directory id pooled builders are created in
+    :param specs: list of dictionaries with BundleId, ComputeType, Size and optional
+        RootVolumeSize and UserVolumeSize
+    :param users: list of directory user names reserved for pooled builders
+    :param idle_cost_per_hour (optional): cost of one stopped builder per hour, used
+        to report the idle cost of the pool
+    """
+
+    def __init__(
+        self,
+        directory,
+        specs,
+        users,
+        store=None,
+        workspaces_client=None,
+        cloudwatch_client=None,
+        idle_cost_per_hour=0.0,
+    ):
+        self.directory = directory
+        self.specs = specs
+        self.users = users
+        self.store = store or SsmPoolStore()
+        self.workspaces_client = workspaces_client or aws_client.client("workspaces")
+        self.cloudwatch_client = cloudwatch_client or aws_client.client("cloudwatch")
+        self.idle_cost_per_hour = idle_cost_per_hour
+
+    def claim(self, bundle_id, compute_type, auto_stop_minutes=BUILDER_AUTO_STOP_MINUTES):
+        """Claims a pooled builder matching the bundle and compute type
+
+        :param bundle_id: string
+        :param compute_type: string
+        :param auto_stop_minutes (optional): AutoStop timeout the claimed builder is given
+        :return: dictionary with WorkspaceId, UserName and ClaimLatency, or None on a miss
+        """
+
+        StartTime = time.time()
+        Pool = spec_key(bundle_id, compute_type)
+        Members = self.store.members(Pool)
+        Claimed = None
+
+        if Members:
+            States = self._describe_states(list(Members))
+            Candidates = sorted(
+                (workspace_id for workspace_id in Members if States.get(workspace_id) in CLAIMABLE_STATES),
+                key=lambda workspace_id: CLAIMABLE_STATES.index(States[workspace_id]),
+            )
+            for workspace_id in Candidates:
+                if self.store.remove(Pool, workspace_id):
+                    Claimed = {
+                        "WorkspaceId": workspace_id,
+                        "UserName": Members[workspace_id]["UserName"],
+                        "State": States[workspace_id],
+                    }
+                    break
+
+        if Claimed:
+            self._set_auto_stop(Claimed["WorkspaceId"], auto_stop_minutes)
+
+        ClaimLatency = round(time.time() - StartTime, 3)
+        if Claimed:
+            Claimed["ClaimLatency"] = ClaimLatency
+            logger.info("Claimed pooled builder %s from pool %s in %s seconds.", Claimed["WorkspaceId"], Pool, ClaimLatency)
+        else:
+            logger.info("No pooled builder available in pool %s.", Pool)
+
+        self.publish_metrics(
+            [
+                {"MetricName": "PoolHit" if Claimed else "PoolMiss", "Value": 1, "Unit": "Count"},
+                {"MetricName": "PoolClaimLatency", "Value": ClaimLatency, "Unit": "Seconds"},
+            ],
+            Pool,
+        )
+        return Claimed
+
+    def _set_auto_stop(self, workspace_id, auto_stop_minutes):
+        """Replaces the pool's AutoStop timeout on a claimed builder, so it is not stopped
+        during a long routine. The builder is already out of the pool, so errors are
+        logged and not raised."""
+
+        try:
+            self.workspaces_client.modify_workspace_properties(
+                WorkspaceId=workspace_id,
+                WorkspaceProperties={
+                    "RunningMode": "AUTO_STOP",
+                    "RunningModeAutoStopTimeoutInMinutes": auto_stop_minutes,
+                },
+            )
+            logger.info("Set AutoStop timeout of %s to %s minutes.", workspace_id, auto_stop_minutes)
+        except Exception as e:
+            logger.error(e)
+            logger.info(
+                "Unable to set AutoStop timeout of %s, it keeps the pool timeout of %s minutes.",
+                workspace_id,
+                POOL_AUTO_STOP_MINUTES,
+            )
+
+    def _describe_states(self, workspace_ids):
+        """Returns the state of each WorkSpace, describing up to 25 per call"""
+
+        States = {}
+        for index in range(0, len(workspace_ids), 25):
+            response = self.workspaces_client.describe_workspaces(WorkspaceIds=workspace_ids[index:index + 25])
+            States.update({workspace["WorkspaceId"]: workspace["State"] for workspace in response["Workspaces"]})
+        return States
+
+    def _directory_users(self):
+        """Returns the user names that already have a WorkSpace in the directory"""
+
+        Users = set()
+        paginator = self.workspaces_client.get_paginator("describe_workspaces")
+        for page in paginator.paginate(DirectoryId=self.directory):
+            for workspace in page["Workspaces"]:
+                if workspace["State"] != "TERMINATED":
+                    Users.add(workspace.get("UserName", "").lower())
+        return Users
+
+    def refill(self):
+        """Drops unusable builders, stops running ones and provisions missing ones
+
+        :return: list of dictionaries reporting each pool's size, idle hours and idle cost
+        """
+
+        Report = []
+        BusyUsers = self._directory_users()
+        FreeUsers = [user for user in self.users if user.lower() not in BusyUsers]
+
+        for spec in self.specs:
+            Pool = spec_key(spec["BundleId"], spec["ComputeType"])
+            Members = self.store.members(Pool)
+            States = self._describe_states(list(Members))
+
+            Failed = []
+            for workspace_id in list(Members):
+                State = States.get(workspace_id)
+                if State in CLAIMABLE_STATES or State in TRANSIENT_STATES:
+                    continue
+                logger.info("Dropping pooled builder %s in state %s.", workspace_id, State)
+                # Only the caller that removes a builder from the pool may terminate it
+                if self.store.remove(Pool, workspace_id) and State in FAILED_STATES:
+                    Failed.append(workspace_id)
+                del Members[workspace_id]
+            self._terminate(Failed)
+
+            # Builders claimed since the states were read are no longer stopped
+            Current = self.store.members(Pool)
+            Running = [
+                workspace_id
+                for workspace_id in Members
+                if States[workspace_id] == "AVAILABLE" and workspace_id in Current
+            ]
+            if Running:
+                logger.info("Stopping %s running pooled builder(s).", len(Running))
+            for index in range(0, len(Running), 25):
+                Batch = Running[index:index + 25]
+                self.workspaces_client.stop_workspaces(
+                    StopWorkspaceRequests=[{"WorkspaceId": workspace_id} for workspace_id in Batch]
+                )
+
+            Missing = max(int(spec["Size"]) - len(Members), 0)
+            Users, FreeUsers = FreeUsers[:Missing], FreeUsers[Missing:]
+            if Missing > len(Users):
+                logger.error("Not enough free pool users to fill pool %s, %s builder(s) short.", Pool, Missing - len(Users))
+
+            if Users:
+                self._provision(Pool, spec, Users)
+
+            Now = time.time()
+            IdleHours = sum(Now - record["Added"] for record in Members.values()) / 3600
+            Report.append(
+                {
+                    "Pool": Pool,
+                    "Size": len(Members),
+                    "Provisioning": len(Users),
+                    "IdleHours": round(IdleHours, 2),
+                    "IdleCost": round(IdleHours * self.idle_cost_per_hour, 2),
+                }
+            )
+            self.publish_metrics(
+                [
+                    {"MetricName": "PoolSize", "Value": len(Members), "Unit": "Count"},
+                    {"MetricName": "PoolIdleHours", "Value": IdleHours, "Unit": "None"},
+                    {"MetricName": "PoolIdleCost", "Value": IdleHours * self.idle_cost_per_hour, "Unit": "None"},
+                ],
+                Pool,
+            )
+        return Report
+
+    def _terminate(self, workspace_ids):
+        """Terminates pooled builders that failed, so their users can be pooled again"""
+
+        for index in range(0, len(workspace_ids), 25):
+            Batch = workspace_ids[index:index + 25]
+            logger.info("Terminating failed pooled builder(s) %s.", ", ".join(Batch))
+            response = self.workspaces_client.terminate_workspaces(
+                TerminateWorkspaceRequests=[{"WorkspaceId": workspace_id} for workspace_id in Batch]
+            )
+            for request in response.get("FailedRequests", []):
+                logger.error(
+                    "Unable to terminate pooled builder %s: %s.",
+                    request["WorkspaceId"],
+                    request.get("ErrorMessage"),
+                )
+
+    def _provision(self, Pool, spec, Users):
+        logger.info("Provisioning %s builder(s) for pool %s.", len(Users), Pool)
+        response = self.workspaces_client.create_workspaces(
+            Workspaces=[
+                {
+                    "DirectoryId": self.directory,
+                    "UserName": user,
+                    "BundleId": spec["BundleId"],
+                    "UserVolumeEncryptionEnabled": False,
+                    "RootVolumeEncryptionEnabled": False,
+                    "WorkspaceProperties": {
+                        "RunningMode": "AUTO_STOP",
+                        "RunningModeAutoStopTimeoutInMinutes": POOL_AUTO_STOP_MINUTES,
+                        "RootVolumeSizeGib": int(spec.get("RootVolumeSize", 80)),
+                        "UserVolumeSizeGib": int(spec.get("UserVolumeSize", 10)),
+                        "ComputeTypeName": spec["ComputeType"],
+                    },
+                    "Tags": [
+                        {"Key": "Automated", "Value": "True"},
+                        {"Key": "WKS_Automation_Pool", "Value": Pool},
+                    ],
+                }
+                for user in Users
+            ]
+        )
+        for request in response["PendingRequests"]:
+            self.store.add(Pool, request["WorkspaceId"], {"UserName": request["UserName"], "Added": time.time()})
+        for request in response["FailedRequests"]:
+            logger.error(
+                "Unable to provision pooled builder for %s: %s.",
+                request["WorkspaceRequest"]["UserName"],
+                request.get("ErrorMessage"),
+            )
+
+    def publish_metrics(self, MetricData, Pool):
+        for metric in MetricData:
+            metric["Dimensions"] = [{"Name": "Pool", "Value": Pool}]
+        try:
+            self.cloudwatch_client.put_metric_data(Namespace=METRIC_NAMESPACE, MetricData=MetricData)
+        except Exception as e:
+            logger.error(e)
+            logger.info("Unable to publish builder pool metrics.")
@@ -0,0 +1,225 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Checkpointed resume of failed image pipeline executions.
+
+Every state of the pipeline records its output in the Step Function execution history.
+The outputs of the states below are the checkpoints of a run: the builder WorkSpace id,
+the routine steps still to run, the Windows Updates status and the image id. A resumed
+execution starts from the newest checkpoint of the failed one and continues at the
+state that follows it, instead of running the whole pipeline again.
+"""
+
+import json
+import logging
+from datetime import datetime
+from wks_automation import aws_client
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Checkpoint states, with the checkpoint they record and the state a resumed execution
+# continues at. States before the image is created go back through the builder status
+# checks, so a builder that stopped since the failure is started and prepared again.
+CHECKPOINTS = {
+    "Create Builder WorkSpace": ("Builder", "Check Builder Status (Create)"),
+    "Run Deployment Routine": ("Routine", "Check Builder Status (Create)"),
+    "Run Windows Updates": ("Windows Updates", "Check Builder Status (Create)"),
+    "Cleanup Temp Creds & API": ("Cleanup", "Check Builder Status (Resume)"),
+    "Create Workspace Image (Tagged)": ("Image", "Check Image Status (Post-Create)"),
+    "Create Workspace Image (No Tags)": ("Image", "Check Image Status (Post-Create)"),
+    "Check Image Status (Post-Create)": ("Image", "Check Image Status (Post-Wait)"),
+    "Check Image Status (Post-Wait)": ("Image", "Check Image Status (Post-Wait)"),
+}
+
+# Image checkpoints are replaced once the image is available
+IMAGE_AVAILABLE = ("Image Available", "Delete Builder?")
+
+# State that restores a checkpoint in a resumed execution. A resumed execution that fails
+# again before its next checkpoint is resumed from the same one.
+RESTORE_STATE = "Restore Checkpoint"
+
+# Checkpoints taken while the pipeline holds its lease on the automation API endpoint
+LEASE_CHECKPOINTS = ("Builder", "Routine", "Windows Updates")
+
+# Windows Updates results after which no more updates are installed
+UPDATES_COMPLETE = (
+    "No Updates",
+    "No Updates (Reboot Pending)",
+    "Module Unavailable",
+    "Complete",
+    "Pass Limit Reached",
+)
+
+# Only executions that ended without finishing can be resumed
+RESUMABLE_STATUSES = ("FAILED", "TIMED_OUT", "ABORTED")
+
+
+def execution_arn(execution, current_arn):
+    """Returns the ARN of an execution of the same state machine
+
+    :param execution: string, execution name or ARN
+    :param current_arn: string, ARN of the running execution
+    :return: string
+    """
+
+    if execution.startswith("arn:"):
+        return execution
+    return current_arn.rsplit(":", 1)[0] + ":" + execution
+
+
+def find_checkpoint(events):
+    """Finds the newest checkpoint in an execution history
+
+    An image that went into the ERROR state is not a checkpoint, the run resumes from
+    the builder cleanup before it and creates a new image.
+
+    :param events: list of events from states get_execution_history, newest first
+    :return: dictionary with the Checkpoint, State and Output, or None
+    """
+
+    ImageFailed = False
+    for event in events:
+        if "stateExitedEventDetails" not in event:
+            continue
+        Name = event["stateExitedEventDetails"]["name"]
+        if Name not in CHECKPOINTS and Name != RESTORE_STATE:
+            continue
+        Output = json.loads(event["stateExitedEventDetails"]["output"])
+        if Name == RESTORE_STATE:
+            Checkpoint, State = Output["Resume"]["Checkpoint"], Output["Resume"]["State"]
+        else:
+            Checkpoint, State = CHECKPOINTS[Name]
+
+        if Name == RESTORE_STATE:
+            # The restored image failed as well, go back to the cleanup before it
+            if ImageFailed and Checkpoint in ("Image", IMAGE_AVAILABLE[0]):
+                Checkpoint, State = CHECKPOINTS["Cleanup Temp Creds & API"]
+        elif Checkpoint == "Image":
+            Images = Output["ImageStatus"].get("Images", [{}])
+            ImageState = Images[0].get("State") if Images else "ERROR"
+            if ImageFailed or ImageState == "ERROR":
+                ImageFailed = True
+                continue
+            if ImageState == "AVAILABLE":
+                Checkpoint, State = IMAGE_AVAILABLE
+        elif Checkpoint == "Builder" and Output["AutomationParameters"]["ImageBuilderWorkSpaceId"] == "FAILED":
+            return None
+
+        return {
+            "Checkpoint": Checkpoint,
+            "State": State,
+            "Output": Output,
+            "ImageFailed": ImageFailed,
+            "Timestamp": event["timestamp"],
+        }
+    return None
+
+
+def failure_details(events):
+    """Returns the state the execution failed in and the error it failed with
+
+    :param events: list of events from states get_execution_history, newest first
+    :return: dictionary with the FailedState and Error
+    """
+
+    Details = {"FailedState": None, "Error": None}
+    for event in events:
+        for key in ("executionFailedEventDetails", "executionTimedOutEventDetails", "executionAbortedEventDetails"):
+            if key in event and not Details["Error"]:
+                Details["Error"] = event[key].get("error", event["type"])
+        if "stateEnteredEventDetails" in event:
+            Details["FailedState"] = event["stateEnteredEventDetails"]["name"]
+            break
+    return Details
+
+
+def rename_outputs(Parameters, Suffix):
+    """Gives the image and bundles of a resumed run a new timestamp suffix
+
+    :param Parameters: dictionary of AutomationParameters, updated in place
+    :param Suffix: string, new suffix such as -2024-01-31-12-00
+    """
+
+    OldSuffix = Parameters["ImageName"][len(Parameters["ImageNamePrefix"]):]
+    Parameters["ImageName"] = Parameters["ImageNamePrefix"] + Suffix
+    Parameters["BundleName"] = Parameters["BundleNamePrefix"] + Suffix
+    for Request in Parameters["BundleRequests"]:
+        if Request["BundleName"].endswith(OldSuffix):
+            Request["BundleName"] = Request["BundleName"][: -len(OldSuffix)] + Suffix
+
+
+def restore(execution, pipeline_execution, sfn_client=None):
+    """Rebuilds the state of a failed execution at its newest checkpoint
+
+    :param execution: string, name or ARN of the failed execution
+    :param pipeline_execution: dictionary with the Id and Name of the resumed execution
+    :param sfn_client: Step Functions client, created if not given
+    :return: dictionary, the state machine input at the checkpoint with a Resume section
+    """
+
+    sfn_client = sfn_client or aws_client.client("stepfunctions")
+    ExecutionArn = execution_arn(execution, pipeline_execution["Id"])
+    Execution = sfn_client.describe_execution(executionArn=ExecutionArn)
+    if Execution["status"] not in RESUMABLE_STATUSES:
+        raise ValueError(
+            "Execution %s is %s, only failed, timed out or aborted executions can be resumed."
+            % (Execution["name"], Execution["status"])
+        )
+
+    Events = []
+    paginator = sfn_client.get_paginator("get_execution_history")
+    for page in paginator.paginate(executionArn=ExecutionArn, reverseOrder=True, includeExecutionData=True):
+        Events += page["events"]
+
+    Found = find_checkpoint(Events)
+    if not Found:
+        raise ValueError(
+            "Execution %s failed before the image builder WorkSpace was created, start a new execution instead."
+            % Execution["name"]
+        )
+    logger.info(
+        "Resuming %s from its %s checkpoint at %s.",
+        Execution["name"],
+        Found["Checkpoint"],
+        Found["State"],
+    )
+
+    State = Found["Output"]
+    Parameters = State["AutomationParameters"]
+    Parameters["PipelineExecutionId"] = pipeline_execution["Name"]
+
+    # Updates already finished in the failed run are not scanned for again
+    if State.get("WindowsUpdates", {}).get("Status") in UPDATES_COMPLETE:
+        Parameters["SkipWindowsUpdates"] = True
+
+    # The failed image keeps its name, so the new one needs another
+    if Found["ImageFailed"]:
+        rename_outputs(Parameters, datetime.now().strftime("-%Y-%m-%d-%H-%M"))
+        State.pop("ImageStatus", None)
+
+    Input = json.loads(Execution.get("input") or "{}")
+    Priority = Input.get("BuildPriority", State.get("Resume", {}).get("BuildPriority", 0))
+    State["PipelineExecution"] = pipeline_execution
+    State["Resume"] = dict(
+        failure_details(Events),
+        Execution=Execution["name"],
+        Checkpoint=Found["Checkpoint"],
+        State=Found["State"],
+        CheckpointTime=Found["Timestamp"].isoformat(),
+        BuildPriority=Priority,
+    )
+    return State
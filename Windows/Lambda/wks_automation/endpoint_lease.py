@@ -0,0 +1,216 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import logging
+import re
+import threading
+import time
+from botocore.exceptions import ClientError
+from wks_automation import aws_client
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Root of the parameter store path holding API endpoint leases
+LEASE_PARAMETER_PATH = "/wks_automation/leases/"
+
+# Leases older than this are treated as abandoned by a failed execution
+DEFAULT_LEASE_TTL = 86400
+
+
+def lease_name(holder):
+    """Sanitizes a lease holder id so it is valid in a parameter store name
+
+    :param holder: string, usually the pipeline execution id
+    :return: sanitized string
+    """
+
+    return re.sub(r"[^a-zA-Z0-9_.-]", "_", holder)
+
+
+class SsmLeaseStore:
+    """Stores one parameter per active lease under LEASE_PARAMETER_PATH"""
+
+    def __init__(self, ssm_client=None):
+        self.ssm_client = ssm_client or aws_client.client("ssm")
+
+    def put(self, resource, holder, expires):
+        """Writes or renews a lease
+
+        :param resource: string, id of the shared resource
+        :param holder: string, id of the lease holder
+        :param expires: float, epoch time the lease expires
+        """
+
+        self.ssm_client.put_parameter(
+            Name=LEASE_PARAMETER_PATH + resource + "/" + lease_name(holder),
+            Description="WorkSpaces automation pipeline API endpoint lease.",
+            Value=str(expires),
+            Type="String",
+            Overwrite=True,
+            Tier="Standard",
+        )
+
+    def delete(self, resource, holder):
+        """Removes a lease, ignoring leases that no longer exist
+
+        :param resource: string, id of the shared resource
+        :param holder: string, id of the lease holder
+        """
+
+        try:
+            self.ssm_client.delete_parameter(
+                Name=LEASE_PARAMETER_PATH + resource + "/" + lease_name(holder)
+            )
+        except ClientError as error:
+            if error.response["Error"]["Code"] != "ParameterNotFound":
+                raise
+
+    def list(self, resource):
+        """Lists the leases held on a resource
+
+        :param resource: string, id of the shared resource
+        :return: dictionary of holder to expiry epoch time
+        """
+
+        Leases = {}
+        paginator = self.ssm_client.get_paginator("get_parameters_by_path")
+        for page in paginator.paginate(Path=LEASE_PARAMETER_PATH + resource):
+            for parameter in page["Parameters"]:
+                Leases[parameter["Name"].rsplit("/", 1)[-1]] = float(parameter["Value"])
+        return Leases
+
+
+class LocalLeaseStore:
+    """In-memory stand-in for SsmLeaseStore, for local runs and tests"""
+
+    def __init__(self):
+        self.leases = {}
+        self.lock = threading.Lock()
+
+    def put(self, resource, holder, expires):
+        with self.lock:
+            self.leases.setdefault(resource, {})[lease_name(holder)] = expires
+
+    def delete(self, resource, holder):
+        with self.lock:
+            self.leases.get(resource, {}).pop(lease_name(holder), None)
+
+    def list(self, resource):
+        with self.lock:
+            return dict(self.leases.get(resource, {}))
+
+
+class EndpointLeaseCoordinator:
+    """Reference counts pipelines using the credential API's execute-api endpoint
+
+    The endpoint is enabled when the first lease is acquired and disabled when the last
+    lease is released. The endpoint state is read before every change so redundant
+    update_rest_api and create_deployment calls are skipped.
+    """
+
+    def __init__(self, api_id, store=None, api_client=None, ttl=DEFAULT_LEASE_TTL, stage="prod"):
+        self.api_id = api_id
+        self.store = store or SsmLeaseStore()
+        self.api_client = api_client or aws_client.client("apigateway")
+        self.ttl = ttl
+        self.stage = stage
+
+    def active_leases(self):
+        """Returns the unexpired leases on the API, removing expired ones
+
+        :return: list of lease holder ids
+        """
+
+        Now = time.time()
+        Active = []
+        for holder, expires in self.store.list(self.api_id).items():
+            if expires > Now:
+                Active.append(holder)
+            else:
+                logger.info("Removing expired API lease, %s.", holder)
+                self.store.delete(self.api_id, holder)
+        return Active
+
+    def endpoint_enabled(self):
+        """Returns True if the default execute-api endpoint is enabled"""
+
+        response = self.api_client.get_rest_api(restApiId=self.api_id)
+        return not response.get("disableExecuteApiEndpoint", False)
+
+    def set_endpoint(self, enabled):
+        """Enables or disables the default endpoint, deploying only if the state changes
+
+        :param enabled: boolean
+        :return: True if the endpoint was changed and deployed
+        """
+
+        if self.endpoint_enabled() == enabled:
+            logger.info("API endpoint is already %s, no action required.", "enabled" if enabled else "disabled")
+            return False
+
+        logger.info("%s API endpoint, deploying API update.", "Enabling" if enabled else "Disabling")
+        self.api_client.update_rest_api(
+            restApiId=self.api_id,
+            patchOperations=[
+                {
+                    "op": "replace",
+                    "path": "/disableExecuteApiEndpoint",
+                    "value": str(not enabled),
+                },
+            ],
+        )
+        self.api_client.create_deployment(restApiId=self.api_id, stageName=self.stage)
+        logger.info("API deploy complete, change will be live in approx. 30 seconds.")
+        return True
+
+    def acquire(self, holder):
+        """Takes a lease on the endpoint and enables it if needed
+
+        :param holder: string, pipeline execution id
+        :return: dictionary with the active lease count and whether the endpoint changed
+        """
+
+        self.store.put(self.api_id, holder, time.time() + self.ttl)
+        Active = self.active_leases()
+        logger.info("API lease acquired by %s, %s active lease(s).", holder, len(Active))
+        Changed = self.set_endpoint(True)
+        return {"ActiveLeases": len(Active), "EndpointChanged": Changed}
+
+    def release(self, holder, disable=True):
+        """Releases a lease and disables the endpoint once no leases remain
+
+        :param holder: string, pipeline execution id
+        :param disable: boolean, disable the endpoint when this is the last lease
+        :return: dictionary with the active lease count and whether the endpoint changed
+        """
+
+        self.store.delete(self.api_id, holder)
+        Active = self.active_leases()
+        logger.info("API lease released by %s, %s active lease(s).", holder, len(Active))
+
+        Changed = False
+        if disable and not Active:
+            Changed = self.set_endpoint(False)
+            # Leases may be taken or released while the endpoint is being changed, so
+            # check again after every change until the endpoint matches the leases
+            Converging = Changed
+            while Converging:
+                Leased = bool(self.active_leases())
+                if Leased:
+                    logger.info("API lease found after disabling, re-enabling endpoint.")
+                Converging = self.set_endpoint(Leased)
+        return {"ActiveLeases": len(Active), "EndpointChanged": Changed}
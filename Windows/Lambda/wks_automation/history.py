@@ -0,0 +1,684 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import argparse
+import json
+import logging
+import math
+import os
+import sqlite3
+import sys
+import threading
+import time
+from botocore.exceptions import ClientError
+from wks_automation import aws_client
+from wks_automation.profiling import COMPUTE_TYPES, cpu_scaled_seconds
+from wks_automation.routine import step_hash
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# S3 prefix holding one JSON record per pipeline run, and a SQLite snapshot of them all
+HISTORY_PREFIX = "wks_automation/history/"
+RUN_PREFIX = HISTORY_PREFIX + "runs/"
+SNAPSHOT_KEY = HISTORY_PREFIX + "history.sqlite"
+
+# Pipeline stages, each matched by substrings of its Step Function state names. The
+# first match wins, states matching none are counted as Other.
+STAGES = [
+    ("Queue", ("Build Slot",)),
+    ("Pre-flight", ("Pre-flight",)),
+    ("Replication", ("Replicat",)),
+    ("Rollout", ("Rollout",)),
+    ("Provision", ("Create Builder", "(Create)", "(Reboot)", "(Resume)", "Attach Security Group")),
+    ("Routine", ("Deployment", "(Routine)")),
+    ("Windows Updates", ("Windows Updates", "Updates to Install", "(Clear Pending)")),
+    ("Image", ("Image",)),
+    ("Cleanup", ("Cleanup", "Delete Builder")),
+    ("Bundle", ("Bundle",)),
+]
+
+# Windows Updates are skipped unless the pipeline input sets SkipWindowsUpdates to False
+DEFAULT_SKIP_WINDOWS_UPDATES = True
+
+# Stages during which the image builder WorkSpace is running
+BUILDER_STAGES = ("Provision", "Routine", "Windows Updates", "Image")
+
+# A step regressed when its latest run took this much longer than the median before it,
+# and longer than the 95th percentile, with at least MIN_SAMPLES earlier runs
+REGRESSION_FACTOR = 1.5
+MIN_SAMPLES = 3
+
+# Compute types compared by the recommender, and their hourly cost. The default costs
+# are relative units, vCPUs plus a quarter of the GiB of memory, which roughly follows
+# the WorkSpaces hourly prices. Set real prices to get costs in currency.
+DEFAULT_HOURLY_COSTS = {
+    compute_type: COMPUTE_TYPES[compute_type]["vCPU"] + COMPUTE_TYPES[compute_type]["MemoryGB"] / 4.0
+    for compute_type in ("STANDARD", "PERFORMANCE", "POWER", "POWERPRO")
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    execution TEXT PRIMARY KEY, started REAL, compute_type TEXT, bundle_id TEXT,
+    total_seconds REAL, builder_seconds REAL);
+CREATE TABLE IF NOT EXISTS stages (execution TEXT, stage TEXT, seconds REAL);
+CREATE TABLE IF NOT EXISTS steps (
+    execution TEXT, position INTEGER, hash TEXT, type TEXT, seconds REAL, status TEXT);
+CREATE TABLE IF NOT EXISTS reboots (execution TEXT, seconds REAL);
+CREATE TABLE IF NOT EXISTS profiles (
+    execution TEXT, position INTEGER, samples INTEGER, cpu_avg REAL, cpu_max REAL,
+    memory_gb_max REAL, disk_mbps_avg REAL, network_mbps_avg REAL);
+CREATE INDEX IF NOT EXISTS steps_hash ON steps (hash);
+"""
+
+
+def stage_of(state_name):
+    """Returns the pipeline stage a Step Function state belongs to"""
+
+    for stage, markers in STAGES:
+        if any(marker in state_name for marker in markers):
+            return stage
+    return "Other"
+
+
+def stage_durations(events):
+    """Adds up the time spent in each pipeline stage from an execution history
+
+    :param events: list of events from states get_execution_history, oldest first
+    :return: dictionary of stage name to seconds
+    """
+
+    Entered = {}
+    Durations = {}
+    for event in events:
+        if "stateEnteredEventDetails" in event:
+            Entered[event["stateEnteredEventDetails"]["name"]] = event["timestamp"]
+        elif "stateExitedEventDetails" in event:
+            name = event["stateExitedEventDetails"]["name"]
+            if name in Entered:
+                Seconds = (event["timestamp"] - Entered.pop(name)).total_seconds()
+                Stage = stage_of(name)
+                Durations[Stage] = round(Durations.get(Stage, 0) + Seconds, 1)
+    return Durations
+
+
+def percentile(values, pct):
+    """Returns the pct percentile of values, interpolating between samples"""
+
+    if not values:
+        return None
+    Ordered = sorted(values)
+    Rank = (len(Ordered) - 1) * pct / 100.0
+    Low = math.floor(Rank)
+    High = math.ceil(Rank)
+    return Ordered[Low] + (Ordered[High] - Ordered[Low]) * (Rank - Low)
+
+
+def build_record(event, stages, started):
+    """Builds the history record of a finished pipeline run
+
+    :param event: dictionary, Step Function state at the end of the pipeline
+    :param stages: dictionary of stage name to seconds, from stage_durations
+    :param started: epoch time the execution started
+    :return: dictionary
+    """
+
+    Parameters = event["AutomationParameters"]
+    Routine = event.get("InstallRoutineRemaining") or {}
+    return {
+        "Execution": event["PipelineExecution"]["Name"],
+        "Started": started,
+        "ComputeType": Parameters.get("ImageBuilderComputeType", ""),
+        "BundleId": Parameters.get("ImageBuilderBundleId", ""),
+        "Stages": stages,
+        "Steps": Routine.get("StepTimings", []),
+        "Reboots": Routine.get("Reboots", []),
+    }
+
+
+class S3RunRecords:
+    """Stores one JSON object per pipeline run under RUN_PREFIX, so concurrent runs
+    never write to the same object"""
+
+    def __init__(self, bucket, s3_client=None):
+        self.bucket = bucket
+        self.s3_client = s3_client or aws_client.client("s3")
+
+    def put(self, record):
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=RUN_PREFIX + record["Execution"] + ".json",
+            Body=json.dumps(record).encode("utf-8"),
+            ContentType="application/json",
+        )
+
+    def keys(self):
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=RUN_PREFIX):
+            for item in page.get("Contents", []):
+                yield item["Key"][len(RUN_PREFIX):-len(".json")]
+
+    def get(self, execution):
+        response = self.s3_client.get_object(Bucket=self.bucket, Key=RUN_PREFIX + execution + ".json")
+        return json.loads(response["Body"].read())
+
+    def download_snapshot(self, path):
+        """Copies the shared SQLite snapshot to path, returns False if there is none"""
+
+        try:
+            self.s3_client.download_file(self.bucket, SNAPSHOT_KEY, path)
+            return True
+        except ClientError as error:
+            if error.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return False
+            raise
+
+    def upload_snapshot(self, path):
+        self.s3_client.upload_file(path, self.bucket, SNAPSHOT_KEY)
+
+
+class LocalRunRecords:
+    """In-memory stand-in for S3RunRecords, for local runs and tests"""
+
+    def __init__(self):
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def put(self, record):
+        with self.lock:
+            self.records[record["Execution"]] = record
+
+    def keys(self):
+        with self.lock:
+            return list(self.records)
+
+    def get(self, execution):
+        with self.lock:
+            return self.records[execution]
+
+    def download_snapshot(self, path):
+        return False
+
+    def upload_snapshot(self, path):
+        pass
+
+
+class RunHistory:
+    """Queryable SQLite copy of the pipeline run records
+
+    :param path (optional): string, SQLite database file, in memory if not given
+    """
+
+    def __init__(self, path=":memory:"):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def add(self, record):
+        """Adds or replaces one run record"""
+
+        Execution = record["Execution"]
+        Stages = record.get("Stages", {})
+        with self.db:
+            for table in ("runs", "stages", "steps", "reboots", "profiles"):
+                self.db.execute("DELETE FROM " + table + " WHERE execution = ?", (Execution,))  # nosec B608
+            self.db.execute(
+                "INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    Execution,
+                    record.get("Started", 0),
+                    record.get("ComputeType", ""),
+                    record.get("BundleId", ""),
+                    sum(Stages.values()),
+                    sum(Stages.get(stage, 0) for stage in BUILDER_STAGES),
+                ),
+            )
+            self.db.executemany(
+                "INSERT INTO stages VALUES (?, ?, ?)",
+                [(Execution, stage, seconds) for stage, seconds in Stages.items()],
+            )
+            self.db.executemany(
+                "INSERT INTO steps VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (Execution, position, step["Hash"], step["Type"], step["Duration"], step["Status"])
+                    for position, step in enumerate(record.get("Steps", []))
+                ],
+            )
+            self.db.executemany(
+                "INSERT INTO profiles VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        Execution,
+                        position,
+                        step["Profile"]["Samples"],
+                        step["Profile"]["CpuAvg"],
+                        step["Profile"]["CpuMax"],
+                        step["Profile"]["MemoryGBMax"],
+                        step["Profile"]["DiskMBpsAvg"],
+                        step["Profile"]["NetworkMBpsAvg"],
+                    )
+                    for position, step in enumerate(record.get("Steps", []))
+                    if step.get("Profile", {}).get("Samples")
+                ],
+            )
+            self.db.executemany(
+                "INSERT INTO reboots VALUES (?, ?)",
+                [(Execution, seconds) for seconds in record.get("Reboots", [])],
+            )
+
+    def sync(self, records):
+        """Imports run records not yet in the database
+
+        :param records: S3RunRecords or LocalRunRecords
+        :return: integer, number of records imported
+        """
+
+        Known = {row[0] for row in self.db.execute("SELECT execution FROM runs")}
+        Imported = 0
+        for execution in records.keys():
+            if execution not in Known:
+                self.add(records.get(execution))
+                Imported += 1
+        logger.info("Imported %s run record(s) into the run history.", Imported)
+        return Imported
+
+    def save(self, path):
+        """Writes a copy of the database to path"""
+
+        target = sqlite3.connect(path)
+        with target:
+            self.db.backup(target)
+        target.close()
+
+    def _values(self, query, parameters=()):
+        return [row[0] for row in self.db.execute(query, parameters)]
+
+    def _scoped_values(
+        self,
+        query,
+        parameters,
+        compute_type=None,
+        bundle_id=None,
+        min_samples=1,
+        other_compute_types=True,
+    ):
+        """Runs a query on runs r, narrowed to runs on the same compute type and bundle
+
+        The {scope} placeholder in query is replaced with the filter. A wider scope is
+        only used when the narrower one has fewer than min_samples values, and runs on
+        other compute types only if other_compute_types is set.
+        """
+
+        Scopes = []
+        if compute_type and bundle_id:
+            Scopes.append((" AND r.compute_type = ? AND r.bundle_id = ?", (compute_type, bundle_id)))
+        if compute_type:
+            Scopes.append((" AND r.compute_type = ?", (compute_type,)))
+        elif bundle_id:
+            Scopes.append((" AND r.bundle_id = ?", (bundle_id,)))
+        if other_compute_types or not compute_type:
+            Scopes.append(("", ()))
+
+        Values = []
+        for clause, values in Scopes:
+            Values = self._values(query.format(scope=clause), tuple(parameters) + values)  # nosec B608
+            if len(Values) >= min_samples:
+                break
+        return Values
+
+    def stage_seconds(self, stage, compute_type=None):
+        """Returns the recorded durations of a stage, for a compute type if it has any"""
+
+        if compute_type:
+            Values = self._values(
+                "SELECT s.seconds FROM stages s JOIN runs r ON r.execution = s.execution"
+                " WHERE s.stage = ? AND r.compute_type = ?",
+                (stage, compute_type),
+            )
+            if Values:
+                return Values
+        return self._values("SELECT seconds FROM stages WHERE stage = ?", (stage,))
+
+    def step_seconds(self, hash, exclude=None, compute_type=None, bundle_id=None):
+        """Returns the recorded durations of a step, oldest run first, from runs on the
+        compute type and bundle if it has any"""
+
+        return self._scoped_values(
+            "SELECT st.seconds FROM steps st JOIN runs r ON r.execution = st.execution"
+            " WHERE st.hash = ? AND st.execution != ?{scope} ORDER BY r.started",
+            (hash, exclude or ""),
+            compute_type,
+            bundle_id,
+        )
+
+    def step_runs(self, hash):
+        """Returns each recorded run of a step with its compute type and profile
+
+        :return: list of dictionaries with ComputeType, Seconds and Profile (or None)
+        """
+
+        Runs = []
+        for row in self.db.execute(
+            "SELECT r.compute_type, st.seconds, p.samples, p.cpu_avg, p.cpu_max, p.memory_gb_max"
+            " FROM steps st JOIN runs r ON r.execution = st.execution"
+            " LEFT JOIN profiles p ON p.execution = st.execution AND p.position = st.position"
+            " WHERE st.hash = ?",
+            (hash,),
+        ):
+            Profile = None
+            if row[2]:
+                Profile = {"Samples": row[2], "CpuAvg": row[3], "CpuMax": row[4], "MemoryGBMax": row[5]}
+            Runs.append({"ComputeType": row[0], "Seconds": row[1], "Profile": Profile})
+        return Runs
+
+    def type_seconds(self, step_type, compute_type=None, bundle_id=None):
+        return self._scoped_values(
+            "SELECT st.seconds FROM steps st JOIN runs r ON r.execution = st.execution"
+            " WHERE st.type = ?{scope}",
+            (step_type,),
+            compute_type,
+            bundle_id,
+        )
+
+    def reboot_seconds(self):
+        return self._values("SELECT seconds FROM reboots")
+
+    def run_count(self):
+        return self._values("SELECT COUNT(*) FROM runs")[0]
+
+    def stages(self):
+        return self._values("SELECT DISTINCT stage FROM stages")
+
+    def regressions(self, execution, factor=REGRESSION_FACTOR, min_samples=MIN_SAMPLES):
+        """Lists the steps of a run that took much longer than in earlier runs on the same
+        compute type, and the same bundle when it has enough of them
+
+        :param execution: string, execution name of the run to check
+        :return: list of dictionaries with Hash, Type, Seconds, BaselineP50 and BaselineP95
+        """
+
+        Regressions = []
+        Rows = self.db.execute(
+            "SELECT hash, type, seconds FROM steps WHERE execution = ? ORDER BY position",
+            (execution,),
+        ).fetchall()
+        Run = self.db.execute(
+            "SELECT started, compute_type, bundle_id FROM runs WHERE execution = ?", (execution,)
+        ).fetchone() or (time.time(), None, None)
+        for hash, step_type, seconds in Rows:
+            Baseline = self._scoped_values(
+                "SELECT st.seconds FROM steps st JOIN runs r ON r.execution = st.execution"
+                " WHERE st.hash = ? AND r.started < ?{scope}",
+                (hash, Run[0]),
+                Run[1],
+                Run[2],
+                min_samples,
+                other_compute_types=False,
+            )
+            if len(Baseline) < min_samples:
+                continue
+            P50 = percentile(Baseline, 50)
+            P95 = percentile(Baseline, 95)
+            if seconds > P50 * factor and seconds > P95:
+                Regressions.append(
+                    {
+                        "Hash": hash,
+                        "Type": step_type,
+                        "Seconds": seconds,
+                        "BaselineP50": round(P50, 1),
+                        "BaselineP95": round(P95, 1),
+                    }
+                )
+        return Regressions
+
+
+class Planner:
+    """Predicts the wall-clock time and builder-hours of a proposed build from the
+    run history
+
+    Steps seen before are estimated from their own history, other steps from all steps
+    of the same type. Both use runs on the same compute type and bundle when there are
+    any. The p95 estimate adds up each part's p95, so it is pessimistic.
+
+    :param history: RunHistory
+    """
+
+    def __init__(self, history):
+        self.history = history
+
+    def _estimate(self, values):
+        return {
+            "P50": round(percentile(values, 50) or 0, 1),
+            "P95": round(percentile(values, 95) or 0, 1),
+            "Samples": len(values),
+        }
+
+    def plan(
+        self,
+        InstallRoutine,
+        compute_type=None,
+        skip_windows_updates=DEFAULT_SKIP_WINDOWS_UPDATES,
+        bundle_id=None,
+    ):
+        """Estimates a build
+
+        :param InstallRoutine: list of steps
+        :param compute_type (optional): string, builder compute type
+        :param skip_windows_updates (optional): boolean
+        :param bundle_id (optional): string, builder bundle
+        :return: dictionary with the total, stage and step estimates
+        """
+
+        Steps = []
+        Unknown = 0
+        for step in InstallRoutine or []:
+            if step[0].upper() == "REBOOT":
+                Values = self.history.reboot_seconds()
+                Basis = "reboots"
+            else:
+                Values = self.history.step_seconds(step_hash(step), compute_type=compute_type, bundle_id=bundle_id)
+                Basis = "step"
+                if not Values:
+                    Values = self.history.type_seconds(step[0].upper(), compute_type, bundle_id)
+                    Basis = "type"
+            if not Values:
+                Unknown += 1
+                Basis = "none"
+            Estimate = self._estimate(Values)
+            Estimate.update({"Hash": step_hash(step), "Type": step[0].upper(), "Basis": Basis})
+            Steps.append(Estimate)
+
+        Stages = {}
+        for stage in self.history.stages():
+            if stage == "Routine" or (stage == "Windows Updates" and skip_windows_updates):
+                continue
+            Stages[stage] = self._estimate(self.history.stage_seconds(stage, compute_type))
+        Stages["Routine"] = {
+            "P50": round(sum(step["P50"] for step in Steps), 1),
+            "P95": round(sum(step["P95"] for step in Steps), 1),
+            "Samples": min([step["Samples"] for step in Steps] or [0]),
+        }
+
+        Plan = {"Stages": Stages, "Steps": Steps, "UnknownSteps": Unknown}
+        for pct in ("P50", "P95"):
+            Plan["Wall" + pct] = round(sum(stage[pct] for stage in Stages.values()), 1)
+            Plan["BuilderHours" + pct] = round(
+                sum(Stages[stage][pct] for stage in BUILDER_STAGES if stage in Stages) / 3600, 2
+            )
+        return Plan
+
+
+class Recommender:
+    """Recommends the builder compute type for a routine from the run history
+
+    Each step is estimated from its runs on the compute type when there are any. Other
+    steps are scaled from their profiled runs on other compute types by how busy they
+    kept the CPUs and how much memory they used. Steps never profiled use their own
+    runs, or all steps of the same type, unscaled. The other pipeline stages come from
+    the Planner.
+
+    :param history: RunHistory
+    :param hourly_costs (optional): dictionary of compute type to hourly cost
+    """
+
+    def __init__(self, history, hourly_costs=None):
+        self.history = history
+        self.hourly_costs = hourly_costs or DEFAULT_HOURLY_COSTS
+
+    def step_estimate(self, step, compute_type):
+        """Estimates the p50 seconds of one step on a compute type
+
+        :return: tuple of seconds, basis of the estimate and whether the step fits
+        """
+
+        if step[0].upper() == "REBOOT":
+            return percentile(self.history.reboot_seconds(), 50) or 0, "reboots", True
+
+        Runs = self.history.step_runs(step_hash(step))
+        Same = [run["Seconds"] for run in Runs if run["ComputeType"] == compute_type]
+        if Same:
+            return percentile(Same, 50), "observed", True
+
+        Scaled = []
+        Fits = True
+        for run in Runs:
+            if run["Profile"] and run["ComputeType"] in COMPUTE_TYPES and compute_type in COMPUTE_TYPES:
+                Seconds, RunFits = cpu_scaled_seconds(run["Seconds"], run["Profile"], run["ComputeType"], compute_type)
+                Scaled.append(Seconds)
+                Fits = Fits and RunFits
+        if Scaled:
+            return percentile(Scaled, 50), "profiled", Fits
+
+        if Runs:
+            return percentile([run["Seconds"] for run in Runs], 50), "unscaled", True
+        Values = self.history.type_seconds(step[0].upper())
+        if Values:
+            return percentile(Values, 50), "type", True
+        return 0, "none", True
+
+    def recommend(self, InstallRoutine, objective="cost", skip_windows_updates=DEFAULT_SKIP_WINDOWS_UPDATES):
+        """Compares the compute types for a routine
+
+        :param InstallRoutine: list of steps
+        :param objective (optional): string, "cost" for the lowest builder cost or "time"
+        for the shortest build
+        :param skip_windows_updates (optional): boolean
+        :return: dictionary with the Recommended compute type (None without any history)
+        and the estimate for each compute type
+        """
+
+        Stages = Planner(self.history)
+        Options = []
+        for compute_type, hourly_cost in self.hourly_costs.items():
+            Base = Stages.plan([], compute_type, skip_windows_updates)
+            Routine = 0
+            Basis = {}
+            Fits = True
+            for step in InstallRoutine or []:
+                Seconds, StepBasis, StepFits = self.step_estimate(step, compute_type)
+                Routine += Seconds
+                Basis[StepBasis] = Basis.get(StepBasis, 0) + 1
+                Fits = Fits and StepFits
+            BuilderHours = Base["BuilderHoursP50"] + Routine / 3600
+            Options.append(
+                {
+                    "ComputeType": compute_type,
+                    "RoutineSeconds": round(Routine, 1),
+                    "WallSeconds": round(Base["WallP50"] + Routine, 1),
+                    "BuilderHours": round(BuilderHours, 2),
+                    "Cost": round(BuilderHours * hourly_cost, 2),
+                    "FitsMemory": Fits,
+                    "Basis": Basis,
+                }
+            )
+
+        # Compute types a step would run out of memory on are only picked if all would
+        Candidates = [option for option in Options if option["FitsMemory"]] or Options
+        if objective == "time":
+            Best = min(Candidates, key=lambda option: (option["WallSeconds"], option["Cost"]))
+        else:
+            Best = min(Candidates, key=lambda option: (option["Cost"], option["WallSeconds"]))
+        return {
+            "Objective": objective,
+            "Recommended": Best["ComputeType"] if self.history.run_count() else None,
+            "Options": Options,
+        }
+
+
+def open_history(bucket, path=None):
+    """Opens a local run history, starting from the shared snapshot in S3 if there is
+    no local copy, and imports any newer run records
+
+    :param bucket: string, bucket holding the run records
+    :param path (optional): string, local SQLite file
+    :return: RunHistory
+    """
+
+    records = S3RunRecords(bucket)
+    path = path or os.path.join(os.path.expanduser("~"), ".wks_automation_history.sqlite")
+    if not os.path.exists(path):
+        records.download_snapshot(path)
+    history = RunHistory(path)
+    history.sync(records)
+    return history
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Query the WorkSpaces image pipeline run history."
+    )
+    parser.add_argument("--bucket", required=True, help="bucket holding the run history")
+    parser.add_argument("--db", help="local SQLite file, defaults to one in your home folder")
+    commands = parser.add_subparsers(dest="command", required=True)
+    plan = commands.add_parser("plan", help="estimate a build from its pipeline input")
+    plan.add_argument("input", help="JSON file with the Step Function input")
+    recommend = commands.add_parser("recommend", help="recommend a builder compute type for a build")
+    recommend.add_argument("input", help="JSON file with the Step Function input")
+    recommend.add_argument("--objective", choices=("cost", "time"), default="cost")
+    regressions = commands.add_parser("regressions", help="list steps that regressed in a run")
+    regressions.add_argument("execution", help="execution name")
+    commands.add_parser("sync", help="import new run records")
+    args = parser.parse_args(argv)
+
+    history = open_history(args.bucket, args.db)
+    if args.command == "plan":
+        with open(args.input) as file:
+            Input = json.load(file)
+        Result = Planner(history).plan(
+            Input.get("InstallRoutine", []),
+            Input.get("ImageBuilderComputeType"),
+            Input.get("SkipWindowsUpdates", DEFAULT_SKIP_WINDOWS_UPDATES),
+            Input.get("ImageBuilderBundleId"),
+        )
+    elif args.command == "recommend":
+        with open(args.input) as file:
+            Input = json.load(file)
+        Result = Recommender(history).recommend(
+            Input.get("InstallRoutine", []),
+            args.objective,
+            Input.get("SkipWindowsUpdates", DEFAULT_SKIP_WINDOWS_UPDATES),
+        )
+    elif args.command == "regressions":
+        Result = history.regressions(args.execution)
+    else:
+        Result = {"Runs": history.run_count()}
+    json.dump(Result, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from botocore.exceptions import ClientError
+from wks_automation import aws_client
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Parameter store path holding one parameter per cached image layer
+LAYER_PARAMETER_PATH = "/wks_automation/layers/"
+
+# Pipeline parameters that only name or describe the build, and do not change the
+# contents of the image
+NAMING_PARAMETERS = {
+    "ImageNamePrefix",
+    "ImageDescription",
+    "ImageTags",
+    "ImageNotificationARN",
+    "BundleNamePrefix",
+    "BundleDescription",
+    "BundleTags",
+    "ImageBuilderUser",
+    "BuildPriority",
+    "DeleteBuilder",
+    "DisableAPI",
+    "UseBuilderPool",
+}
+
+# Parameters that belong to the layered build itself, never passed to layer builds
+LAYER_PARAMETERS = {"Layers", "PipelineExecution"}
+
+DEFAULT_BASE_MAX_AGE_DAYS = 30
+DEFAULT_CHILD_CONCURRENCY = 2
+
+
+def fingerprint(parameters, parent=""):
+    """Returns a fingerprint of the parameters that decide an image layer's contents
+
+    :param parameters: dictionary of pipeline parameters for the layer build
+    :param parent (optional): string, fingerprint of the layer this one is built on
+    :return: string, hex SHA256 digest
+    """
+
+    Contents = {key: value for key, value in parameters.items() if key not in NAMING_PARAMETERS}
+    Contents["Parent"] = parent
+    return hashlib.sha256(json.dumps(Contents, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class SsmLayerCache:
+    """Stores one parameter per built layer under LAYER_PARAMETER_PATH"""
+
+    def __init__(self, ssm_client=None):
+        self.ssm_client = ssm_client or aws_client.client("ssm")
+
+    def get(self, layer):
+        """Returns the cached layer record, or None"""
+
+        try:
+            response = self.ssm_client.get_parameter(Name=LAYER_PARAMETER_PATH + layer)
+            return json.loads(response["Parameter"]["Value"])
+        except ClientError as error:
+            if error.response["Error"]["Code"] == "ParameterNotFound":
+                return None
+            raise
+
+    def put(self, layer, record):
+        self.ssm_client.put_parameter(
+            Name=LAYER_PARAMETER_PATH + layer,
+            Description="WorkSpaces automation pipeline cached image layer.",
+            Value=json.dumps(record),
+            Type="String",
+            Overwrite=True,
+            Tier="Standard",
+        )
+
+    def records(self):
+        """Returns every cached layer record as a dictionary of layer to record"""
+
+        Records = {}
+        paginator = self.ssm_client.get_paginator("get_parameters_by_path")
+        for page in paginator.paginate(Path=LAYER_PARAMETER_PATH):
+            for parameter in page["Parameters"]:
+                Records[parameter["Name"].rsplit("/", 1)[-1]] = json.loads(parameter["Value"])
+        return Records
+
+
+class LocalLayerCache:
+    """In-memory stand-in for SsmLayerCache, for local runs and tests"""
+
+    def __init__(self):
+        self.layers = {}
+        self.lock = threading.Lock()
+
+    def get(self, layer):
+        with self.lock:
+            return self.layers.get(layer)
+
+    def put(self, layer, record):
+        with self.lock:
+            self.layers[layer] = record
+
+    def records(self):
+        with self.lock:
+            return dict(self.layers)
+
+
+class LayerPlanner:
+    """Plans a layered build: one base image shared by several child images
+
+    The base image and a bundle made from it are cached by the fingerprint of the base
+    build parameters. Each child build starts from the base bundle and only runs its own
+    routine. A layer is rebuilt only when its fingerprint changes, its image or bundle no
+    longer exists, or, for the base, it is older than the maximum age, so it picks up
+    new Windows Updates.
+
+    :param cache (optional): SsmLayerCache or LocalLayerCache
+    :param workspaces_client (optional): boto3 WorkSpaces client
+    """
+
+    def __init__(self, cache=None, workspaces_client=None):
+        self.cache = cache or SsmLayerCache()
+        self.workspaces_client = workspaces_client or aws_client.client("workspaces")
+
+    def _image_available(self, image_id):
+        response = self.workspaces_client.describe_workspace_images(ImageIds=[image_id])
+        return bool(response["Images"]) and response["Images"][0]["State"] == "AVAILABLE"
+
+    def _bundle_exists(self, bundle_id):
+        response = self.workspaces_client.describe_workspace_bundles(BundleIds=[bundle_id])
+        return bool(response["Bundles"])
+
+    def _cached(self, layer, max_age_days=None):
+        """Returns the cached record for a layer if it can still be used, or None"""
+
+        Record = self.cache.get(layer)
+        if not Record:
+            return None
+        if max_age_days is not None and time.time() - Record["Created"] > max_age_days * 86400:
+            logger.info("Cached layer %s is older than %s days.", layer, max_age_days)
+            return None
+        if not self._image_available(Record["ImageId"]):
+            logger.info("Image %s of cached layer %s is no longer available.", Record["ImageId"], layer)
+            return None
+        if Record.get("BundleId") and not self._bundle_exists(Record["BundleId"]):
+            logger.info("Bundle %s of cached layer %s no longer exists.", Record["BundleId"], layer)
+            return None
+        return Record
+
+    def plan(self, event):
+        """Fingerprints the base and child layers and looks them up in the cache
+
+        :param event: dictionary, layered build input with a Layers parameter
+        :return: dictionary, the layer plan
+        """
+
+        Layers = event["Layers"]
+        Shared = {key: value for key, value in event.items() if key not in LAYER_PARAMETERS}
+
+        BaseInput = dict(Shared)
+        BaseInput.update(
+            {
+                "InstallRoutine": Layers["BaseRoutine"],
+                "ImageNamePrefix": Shared.get("ImageNamePrefix", os.environ["Default_ImagePrefix"]) + "_Base",
+                "BundleNamePrefix": Shared.get("BundleNamePrefix", os.environ["Default_BundlePrefix"]) + "_Base",
+                "CreateBundle": True,
+                "BundleMatrix": False,
+                "FleetRollout": False,
+                "ReplicationRegions": [],
+            }
+        )
+        BaseLayer = fingerprint(BaseInput)
+        BaseInput["ImageTags"] = (Shared.get("ImageTags") or []) + [
+            {"Key": "WKS_Automation_Layer", "Value": BaseLayer[:32]}
+        ]
+
+        Plan = {
+            "BaseLayer": BaseLayer,
+            "BaseInput": BaseInput,
+            "BaseCached": False,
+            "ChildConcurrency": int(Layers.get("ChildConcurrency", DEFAULT_CHILD_CONCURRENCY)),
+            "Children": Layers["Children"],
+            "Shared": Shared,
+        }
+
+        Base = self._cached(BaseLayer, float(Layers.get("BaseMaxAgeDays", DEFAULT_BASE_MAX_AGE_DAYS)))
+        if Base:
+            logger.info("Using cached base layer %s, bundle %s.", BaseLayer, Base["BundleId"])
+            Plan["BaseCached"] = True
+            Plan["Base"] = Base
+            Plan.update(self.plan_children(Plan))
+        else:
+            logger.info("Base layer %s must be built.", BaseLayer)
+        return Plan
+
+    def register_base(self, plan, output):
+        """Caches the base layer built by a pipeline execution and plans the children
+
+        :param plan: dictionary, the layer plan
+        :param output: dictionary, output of the base layer pipeline execution
+        :return: dictionary, the updated layer plan
+        """
+
+        Image = output["ImageStatus"]["Images"][0]
+        if Image["State"] != "AVAILABLE" or not output.get("BundleStatus"):
+            raise ValueError("Base layer build did not create an available image and bundle.")
+
+        Base = {
+            "ImageId": Image["ImageId"],
+            "BundleId": output["BundleStatus"][0]["WorkspaceBundle"]["BundleId"],
+            "Created": round(time.time()),
+        }
+        self.cache.put(plan["BaseLayer"], Base)
+        logger.info("Cached base layer %s, bundle %s.", plan["BaseLayer"], Base["BundleId"])
+
+        plan = dict(plan, Base=Base)
+        plan.update(self.plan_children(plan))
+        return plan
+
+    def plan_children(self, plan):
+        """Builds the pipeline input of each child layer that is not cached
+
+        :param plan: dictionary, the layer plan with a Base record
+        :return: dictionary with ChildInputs, ChildLayers, CachedChildren and
+            ChildConcurrency
+        """
+
+        ChildInputs = []
+        ChildLayers = []
+        CachedChildren = []
+        for child in plan["Children"]:
+            ChildInput = dict(plan["Shared"])
+            ChildInput.update(child)
+            ChildInput["ImageBuilderBundleId"] = plan["Base"]["BundleId"]
+            ChildLayer = fingerprint(ChildInput, plan["BaseLayer"])
+
+            Cached = self._cached(ChildLayer)
+            if Cached:
+                logger.info("Child layer %s is unchanged, using image %s.", ChildLayer, Cached["ImageId"])
+                CachedChildren.append(dict(Cached, Layer=ChildLayer))
+                continue
+
+            ChildInput["ImageTags"] = (ChildInput.get("ImageTags") or []) + [
+                {"Key": "WKS_Automation_Layer", "Value": ChildLayer[:32]},
+                {"Key": "WKS_Automation_Base_Layer", "Value": plan["BaseLayer"][:32]},
+            ]
+            ChildInputs.append(ChildInput)
+            ChildLayers.append(ChildLayer)
+
+        # A user can only have one WorkSpace, so children that share a builder user
+        # are built one at a time
+        Users = [child.get("ImageBuilderUser", os.environ["Default_WorkSpaceUser"]).lower() for child in ChildInputs]
+        ChildConcurrency = max(plan["ChildConcurrency"], 1)
+        if len(set(Users)) < len(Users):
+            logger.info("Child layers share an image builder user, building them one at a time.")
+            ChildConcurrency = 1
+
+        logger.info("%s child layer(s) to build, %s unchanged.", len(ChildInputs), len(CachedChildren))
+        return {
+            "ChildInputs": ChildInputs,
+            "ChildLayers": ChildLayers,
+            "CachedChildren": CachedChildren,
+            "ChildConcurrency": ChildConcurrency,
+        }
+
+    def register_children(self, plan, results):
+        """Caches the child layers that built successfully
+
+        :param plan: dictionary, the layer plan
+        :param results: list of child execution results, in ChildInputs order
+        :return: list of dictionaries reporting each child layer
+        """
+
+        Report = [dict(child, Status="UNCHANGED") for child in plan["CachedChildren"]]
+        for layer, result in zip(plan["ChildLayers"], results):
+            # Failed child executions are caught by the Step Function and return an
+            # Error and Cause instead of an Output
+            Output = result.get("Output") or {}
+            Images = Output.get("ImageStatus", {}).get("Images", [])
+            if not Images or Images[0]["State"] != "AVAILABLE":
+                logger.info("Child layer %s did not build.", layer)
+                Report.append({"Layer": layer, "Status": "FAILED", "Error": result.get("Cause", "Image not available.")})
+                continue
+
+            Record = {"ImageId": Images[0]["ImageId"], "Created": round(time.time())}
+            if Output.get("BundleStatus"):
+                Record["BundleId"] = Output["BundleStatus"][0]["WorkspaceBundle"]["BundleId"]
+            self.cache.put(layer, Record)
+            Report.append(dict(Record, Layer=layer, Status="BUILT"))
+        return Report
@@ -0,0 +1,61 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import logging
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+class AdaptivePoller:
+    """Chooses how long a Step Function Wait state sleeps between status checks
+
+    Polls quickly after something changes, then backs off while nothing does, so long
+    running operations are not checked needlessly and short ones are not overslept.
+    """
+
+    def __init__(self, initial=60, maximum=600, factor=2.0, minimum=10):
+        """
+        :param initial: integer seconds, first delay and the delay after a change
+        :param maximum: integer seconds, longest delay
+        :param factor: float, growth of the delay while nothing changes
+        :param minimum: integer seconds, shortest delay
+        """
+
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.minimum = minimum
+
+    def next_delay(self, previous=None, changed=False, expected_remaining=None):
+        """Returns the delay before the next status check
+
+        :param previous (optional): integer seconds, the last delay used
+        :param changed (optional): boolean, whether the last check saw a state change
+        :param expected_remaining (optional): seconds until completion is expected
+        :return: integer seconds
+        """
+
+        if previous is None or changed:
+            Delay = self.initial
+        else:
+            Delay = previous * self.factor
+
+        # Do not sleep far past the expected completion
+        if expected_remaining is not None:
+            Delay = min(Delay, max(expected_remaining, self.minimum))
+
+        return int(min(max(Delay, self.minimum), self.maximum))
@@ -0,0 +1,197 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Resource profiling of the image builder WorkSpace during routine steps.
+
+A scheduled task on the builder samples CPU, memory, disk and network counters every
+few seconds into a file in the staging folder. After each routine step, the samples
+taken while it ran are read back and summarized into the step's result. The task is
+started again after each reboot, and removed with the staging folder during cleanup.
+"""
+
+import logging
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+PROFILE_TASK = "wks_automation_profiler"
+PROFILE_LOG = "C:\\wks_automation\\profile.csv"
+PROFILER_SCRIPT = "C:\\wks_automation\\profiler.ps1"
+SAMPLE_INTERVAL = 5
+
+# vCPUs and memory (GiB) of the compute types an image builder can use
+COMPUTE_TYPES = {
+    "VALUE": {"vCPU": 1, "MemoryGB": 2},
+    "STANDARD": {"vCPU": 2, "MemoryGB": 4},
+    "PERFORMANCE": {"vCPU": 2, "MemoryGB": 8},
+    "POWER": {"vCPU": 4, "MemoryGB": 16},
+    "POWERPRO": {"vCPU": 8, "MemoryGB": 32},
+    "GENERALPURPOSE_4XLARGE": {"vCPU": 16, "MemoryGB": 64},
+    "GENERALPURPOSE_8XLARGE": {"vCPU": 32, "MemoryGB": 128},
+}
+
+
+# Peak CPU % from which a step is treated as limited by its vCPUs, the share of physical
+# memory a step can use before it is treated as not fitting, and the slowdown applied then
+CPU_BOUND = 90.0
+MEMORY_HEADROOM = 0.9
+MEMORY_PENALTY = 1.5
+
+# Writes one line per sample: epoch seconds, CPU %, physical memory bytes in use, disk
+# bytes per second and network bytes per second, formatted the same in every locale.
+# Memory in use is physical memory less available bytes, so pagefile-backed commit that
+# is not resident does not count against the compute type's memory.
+COLLECTOR_SCRIPT = """\
+$Counters = '\\Processor(_Total)\\%% Processor Time', '\\Memory\\Available Bytes',
+    '\\PhysicalDisk(_Total)\\Disk Bytes/sec', '\\Network Interface(*)\\Bytes Total/sec'
+$Culture = [Globalization.CultureInfo]::InvariantCulture
+$Physical = (Get-CimInstance -ClassName Win32_ComputerSystem).TotalPhysicalMemory
+Get-Counter -Counter $Counters -SampleInterval %(interval)s -Continuous -ErrorAction SilentlyContinue | ForEach-Object {
+    $Values = $_.CounterSamples
+    $Cpu = ($Values | Where-Object Path -like '*\\%% processor time').CookedValue
+    $Memory = $Physical - ($Values | Where-Object Path -like '*\\available bytes').CookedValue
+    $Disk = ($Values | Where-Object Path -like '*\\disk bytes/sec').CookedValue
+    $Network = ($Values | Where-Object Path -like '*\\bytes total/sec' | Measure-Object CookedValue -Sum).Sum
+    [string]::Format($Culture, '{0},{1:F1},{2:F0},{3:F0},{4:F0}',
+        [DateTimeOffset]::UtcNow.ToUnixTimeSeconds(), $Cpu, $Memory, $Disk, $Network) |
+        Add-Content -Path '%(log)s'
+}
+""" % {"interval": SAMPLE_INTERVAL, "log": PROFILE_LOG}
+
+# Registers the collector to run as SYSTEM at startup and starts it, if not running
+START_SCRIPT = """\
+if (-not (Test-Path '%(script)s')) {
+    Set-Content -Path '%(script)s' -Value @'
+%(collector)s'@
+}
+if (-not (Get-ScheduledTask -TaskName '%(task)s' -ErrorAction SilentlyContinue)) {
+    $Action = New-ScheduledTaskAction -Execute 'powershell.exe' -Argument '-NoProfile -ExecutionPolicy Bypass -File %(script)s'
+    $Settings = New-ScheduledTaskSettingsSet -ExecutionTimeLimit ([TimeSpan]::Zero)
+    Register-ScheduledTask -TaskName '%(task)s' -Action $Action -Trigger (New-ScheduledTaskTrigger -AtStartup) -Settings $Settings -User 'SYSTEM' -RunLevel Highest | Out-Null
+}
+if ((Get-ScheduledTask -TaskName '%(task)s').State -ne 'Running') { Start-ScheduledTask -TaskName '%(task)s' }
+""" % {"script": PROFILER_SCRIPT, "collector": COLLECTOR_SCRIPT, "task": PROFILE_TASK}
+
+SAMPLES_SCRIPT = """\
+Get-Content -Path '%(log)s' -ErrorAction SilentlyContinue | Where-Object {
+    $Time = [long]($_ -split ',')[0]; $Time -ge %%(start)d -and $Time -le %%(end)d }
+""" % {"log": PROFILE_LOG}
+
+STOP_SCRIPT = (
+    "Get-ScheduledTask -TaskName %s -ErrorAction SilentlyContinue | ForEach-Object "
+    "{ Stop-ScheduledTask -TaskName $_.TaskName; Unregister-ScheduledTask -TaskName $_.TaskName -Confirm:$false }"
+    % PROFILE_TASK
+)
+
+
+def start_collector(session):
+    """Starts the builder-side collector, unless it is already running
+
+    :param session: active pywinrm session
+    :return: boolean, True if the collector is running
+    """
+
+    result = session.run_ps(START_SCRIPT)
+    if result.status_code != 0:
+        logger.info("Unable to start the builder profiler: %s", result.std_err.decode(errors="ignore")[:500])
+        return False
+    return True
+
+
+def summarize(lines):
+    """Summarizes collector samples
+
+    :param lines: list of sample lines written by the collector
+    :return: dictionary of sample count and CPU, memory, disk and network figures
+    """
+
+    Samples = []
+    for line in lines:
+        Fields = line.strip().split(",")
+        if len(Fields) == 5:
+            try:
+                Samples.append([float(field) for field in Fields])
+            except ValueError:
+                continue
+    if not Samples:
+        return {"Samples": 0}
+
+    def average(column):
+        return sum(sample[column] for sample in Samples) / len(Samples)
+
+    return {
+        "Samples": len(Samples),
+        "CpuAvg": round(average(1), 1),
+        "CpuMax": round(max(sample[1] for sample in Samples), 1),
+        "MemoryGBMax": round(max(sample[2] for sample in Samples) / 1073741824, 2),
+        "DiskMBpsAvg": round(average(3) / 1048576, 2),
+        "NetworkMBpsAvg": round(average(4) / 1048576, 2),
+    }
+
+
+def step_profile(session, start, end):
+    """Returns the resource profile of the builder between two times
+
+    The sample covering the end of the step is written up to one interval later, so
+    the window is extended by one interval.
+
+    :param session: active pywinrm session
+    :param start: epoch seconds the step started
+    :param end: epoch seconds the step ended
+    :return: dictionary returned by summarize, or None if the samples could not be read
+    """
+
+    try:
+        result = session.run_ps(
+            SAMPLES_SCRIPT % {"start": int(start), "end": int(end) + SAMPLE_INTERVAL}
+        )
+        if result.status_code != 0:
+            return None
+        return summarize(result.std_out.decode(errors="ignore").splitlines())
+    except Exception as e:
+        logger.error(e)
+        return None
+
+
+def cpu_scaled_seconds(seconds, profile, source_type, target_type):
+    """Estimates how long a profiled step would take on another compute type
+
+    A step that kept the CPUs busy is assumed to spread over more vCPUs, so its busy
+    share of the time scales with the vCPU count. A step that used fewer vCPUs than it
+    had is only slowed down on a compute type with fewer vCPUs than it used. A step that
+    would not fit in the memory of the target type is penalized.
+
+    :param seconds: float, duration of the step on source_type
+    :param profile: dictionary returned by summarize
+    :param source_type: string, compute type the step ran on
+    :param target_type: string, compute type to estimate for
+    :return: tuple of estimated seconds and whether the step fits in memory
+    """
+
+    Source = COMPUTE_TYPES[source_type]
+    Target = COMPUTE_TYPES[target_type]
+    Busy = min(profile["CpuAvg"], 100.0) / 100.0
+    if profile["CpuMax"] >= CPU_BOUND:
+        Scale = Source["vCPU"] / float(Target["vCPU"])
+    else:
+        Scale = max(1.0, Busy * Source["vCPU"] / Target["vCPU"])
+    Estimate = seconds * ((1 - Busy) + Busy * Scale)
+
+    Fits = profile["MemoryGBMax"] <= Target["MemoryGB"] * MEMORY_HEADROOM
+    if not Fits:
+        Estimate = Estimate * MEMORY_PENALTY
+    return Estimate, Fits
+
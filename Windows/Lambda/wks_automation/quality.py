@@ -0,0 +1,135 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import json
+import logging
+from botocore.exceptions import ClientError
+from wks_automation import aws_client
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Parameter store path holding one baseline per image name prefix
+BASELINE_PARAMETER_PATH = "/wks_automation/quality/"
+
+# Quality gate settings. A metric fails when it is more than MaxIncrease (a fraction)
+# above the baseline and more than MinIncrease above it, or above its Limit.
+DEFAULT_QUALITY_GATE = {
+    "MaxIncrease": {"BootSeconds": 0.25, "LogonSeconds": 0.25, "StartupApps": 0.2, "DiskUsedGB": 0.15},
+    "MinIncrease": {"BootSeconds": 30, "LogonSeconds": 20, "StartupApps": 2, "DiskUsedGB": 2},
+    "Limits": {},
+}
+
+# Collects the image metrics on the test WorkSpace and prints them as JSON. Logon time
+# is the first logon of a throwaway local account, run as a scheduled task, which
+# creates its profile from the default profile the way a new user's first logon does.
+MEASURE_SCRIPT = """$ErrorActionPreference = 'SilentlyContinue'
+$Boot = Get-WinEvent -FilterHashtable @{LogName='Microsoft-Windows-Diagnostics-Performance/Operational'; Id=100} -MaxEvents 1
+$BootMs = $null
+if ($Boot) {
+    $BootMs = [int](([xml]$Boot.ToXml()).Event.EventData.Data | Where-Object Name -eq 'MainPathBootTime').'#text'
+}
+
+$Name = 'wks_qg_' + (Get-Random -Maximum 99999)
+$Plain = [Guid]::NewGuid().ToString() + 'aA1!'
+New-LocalUser -Name $Name -Password (ConvertTo-SecureString $Plain -AsPlainText -Force) | Out-Null
+Add-LocalGroupMember -Group 'Administrators' -Member $Name
+$Action = New-ScheduledTaskAction -Execute 'cmd.exe' -Argument '/c exit'
+Register-ScheduledTask -TaskName $Name -Action $Action -User $Name -Password $Plain -RunLevel Highest | Out-Null
+$Timer = [Diagnostics.Stopwatch]::StartNew()
+Start-ScheduledTask -TaskName $Name
+do {
+    Start-Sleep -Milliseconds 250
+    $Info = Get-ScheduledTaskInfo -TaskName $Name
+} while (($Info.LastTaskResult -eq 267011 -or (Get-ScheduledTask -TaskName $Name).State -eq 'Running') -and $Timer.Elapsed.TotalSeconds -lt 600)
+$LogonMs = $Timer.ElapsedMilliseconds
+Unregister-ScheduledTask -TaskName $Name -Confirm:$false
+$User = Get-LocalUser -Name $Name
+Get-CimInstance -Class Win32_UserProfile | Where-Object SID -eq $User.SID | Remove-CimInstance
+Remove-LocalUser -Name $Name
+
+$Startup = @(Get-CimInstance Win32_StartupCommand).Count
+$Startup += @(Get-ScheduledTask | Where-Object { $_.State -ne 'Disabled' -and ($_.Triggers | Where-Object { $_.CimClass.CimClassName -eq 'MSFT_TaskLogonTrigger' }) }).Count
+$Disk = Get-CimInstance Win32_LogicalDisk -Filter "DeviceID='C:'"
+
+@{
+    BootMs = $BootMs
+    LogonMs = $LogonMs
+    StartupApps = $Startup
+    DiskUsedGB = [math]::Round(($Disk.Size - $Disk.FreeSpace) / 1GB, 2)
+} | ConvertTo-Json -Compress
+"""
+
+
+def compare(metrics, baseline, settings):
+    """Compares image metrics with the baseline of the previous image
+
+    :param metrics: dictionary of metric name to value
+    :param baseline: dictionary of metric name to value, or None for the first image
+    :param settings: dictionary in the form of DEFAULT_QUALITY_GATE
+    :return: list of problems, empty if the image passes
+    """
+
+    Problems = []
+    for metric, value in metrics.items():
+        if value is None:
+            continue
+        Limit = settings.get("Limits", {}).get(metric)
+        if Limit is not None and value > Limit:
+            Problems.append(metric + " is " + str(value) + ", above the limit of " + str(Limit) + ".")
+            continue
+        if not baseline or baseline.get(metric) is None:
+            continue
+        Previous = baseline[metric]
+        MaxIncrease = settings.get("MaxIncrease", {}).get(metric)
+        MinIncrease = settings.get("MinIncrease", {}).get(metric, 0)
+        if MaxIncrease is None:
+            continue
+        if value > Previous * (1 + MaxIncrease) and value - Previous > MinIncrease:
+            Problems.append(
+                metric + " is " + str(value) + ", up from " + str(Previous)
+                + " for the previous image."
+            )
+    return Problems
+
+
+class SsmBaselineStore:
+    """Stores one parameter per image name prefix under BASELINE_PARAMETER_PATH"""
+
+    def __init__(self, ssm_client=None):
+        self.ssm_client = ssm_client or aws_client.client("ssm")
+
+    def get(self, name):
+        """Returns the baseline record, or None"""
+
+        try:
+            response = self.ssm_client.get_parameter(Name=BASELINE_PARAMETER_PATH + name)
+            return json.loads(response["Parameter"]["Value"])
+        except ClientError as error:
+            if error.response["Error"]["Code"] == "ParameterNotFound":
+                return None
+            raise
+
+    def put(self, name, record):
+        self.ssm_client.put_parameter(
+            Name=BASELINE_PARAMETER_PATH + name,
+            Description="WorkSpaces automation pipeline image performance baseline.",
+            Value=json.dumps(record),
+            Type="String",
+            Overwrite=True,
+            Tier="Standard",
+        )
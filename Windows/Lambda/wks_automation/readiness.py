@@ -0,0 +1,124 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import logging
+import socket
+import time
+import requests
+import winrm
+from winrm.exceptions import WinRMOperationTimeoutError, WinRMTransportError
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+WINRM_PORT = 5985
+
+# Seconds since the builder last started
+UPTIME_SCRIPT = "[int]((Get-Date) - (Get-CimInstance Win32_OperatingSystem).LastBootUpTime).TotalSeconds"
+
+# Creates the staging directory used by the configuration routine, fails if it cannot
+STAGING_SCRIPT = """$ErrorActionPreference = 'Stop'
+New-Item -Path '{path}' -ItemType Directory -Force | Out-Null
+Test-Path -Path '{path}' -PathType Container
+"""
+
+# Failures of the WinRM connection itself, rather than of the command it ran
+TRANSPORT_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    WinRMTransportError,
+    WinRMOperationTimeoutError,
+)
+
+
+def is_transport_error(error):
+    """Checks whether an exception is a WinRM connection failure that may pass if the
+    command is run again
+
+    :param error: exception
+    :return: boolean
+    """
+
+    return isinstance(error, TRANSPORT_ERRORS)
+
+
+def probe(host, user, password, booted_after=None, timeout=10, staging_dir=None):
+    """Checks whether the image builder WorkSpace accepts WinRM commands
+
+    :param host: string, builder IP address
+    :param user: string, local account used by the automation
+    :param password: string
+    :param booted_after (optional): epoch time a reboot was started, the builder is only
+        ready once it has started again after this time
+    :param timeout (optional): integer seconds allowed for each check
+    :param staging_dir (optional): string, directory that must be created before the
+        builder counts as ready
+    :return: dictionary with Ready, Stage (the check that failed, or "ready") and Latency
+    """
+
+    StartTime = time.time()
+    Result = {"Ready": False, "Stage": "port"}
+    try:
+        with socket.create_connection((host, WINRM_PORT), timeout=timeout):
+            pass
+
+        Result["Stage"] = "auth"
+        session = winrm.Session(
+            host,
+            auth=(user, password),
+            read_timeout_sec=timeout + 10,
+            operation_timeout_sec=timeout,
+        )
+        response = session.run_ps(UPTIME_SCRIPT)
+        if response.status_code != 0:
+            raise RuntimeError(response.std_err)
+        Uptime = int(response.std_out.decode("utf-8", "ignore").strip())
+        Result["Uptime"] = Uptime
+
+        # Until the reboot actually happens the builder still answers on its old session
+        Result["Stage"] = "reboot"
+        if booted_after is not None and Uptime >= time.time() - booted_after:
+            raise RuntimeError("builder has not restarted yet")
+
+        if staging_dir:
+            Result["Stage"] = "staging"
+            response = session.run_ps(STAGING_SCRIPT.format(path=staging_dir))
+            if response.status_code != 0 or b"True" not in response.std_out:
+                raise RuntimeError(response.std_err)
+
+        Result["Ready"] = True
+        Result["Stage"] = "ready"
+    except Exception as e:
+        logger.info("WinRM readiness check failed at %s: %s", Result["Stage"], e)
+
+    Result["Latency"] = round(time.time() - StartTime, 3)
+    return Result
+
+
+def wait_until_ready(host, user, password, booted_after=None, budget=60, interval=2):
+    """Probes repeatedly, doubling the interval, until the builder is ready or the
+    time budget is spent
+
+    :return: the last probe result
+    """
+
+    Deadline = time.time() + budget
+    while True:
+        Result = probe(host, user, password, booted_after)
+        if Result["Ready"] or time.time() + interval > Deadline:
+            return Result
+        time.sleep(interval)
+        interval = min(interval * 2, 30)
@@ -0,0 +1,484 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import argparse
+import base64
+import copy
+import datetime
+import functools
+import importlib
+import io
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import types
+from botocore.exceptions import ClientError
+from wks_automation import aws_client
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+TRACE_VERSION = 1
+
+# S3 prefix traces are written to when Trace_Enabled is true
+TRACE_PREFIX = "wks_automation/traces/"
+
+# Values replaced before a trace is written, by channel and operation
+REDACTED = "REDACTED"
+REDACT_REQUEST = {("aws.ssm", "put_parameter"): ("Value",)}
+REDACT_RESPONSE = {("aws.ssm", "get_parameter"): ("Parameter", "Value")}
+
+# Attributes passed straight through to the recorded object
+PASSTHROUGH_ATTRIBUTES = {"meta", "exceptions", "can_paginate"}
+
+
+def encode(value):
+    """Converts a request or response into JSON-serializable form"""
+
+    if isinstance(value, dict):
+        return {str(key): encode(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode(item) for item in value]
+    if isinstance(value, datetime.datetime):
+        return {"__datetime__": value.isoformat()}
+    if isinstance(value, bytes):
+        return {"__bytes__": base64.b64encode(value).decode("ascii")}
+    if isinstance(value, io.BytesIO):
+        return {"__stream__": base64.b64encode(value.getvalue()).decode("ascii")}
+    if hasattr(value, "status_code") and hasattr(value, "std_out"):
+        return {
+            "__winrm__": {
+                "status_code": value.status_code,
+                "std_out": encode(value.std_out),
+                "std_err": encode(value.std_err),
+            }
+        }
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+def decode(value):
+    """Reverses encode"""
+
+    if isinstance(value, list):
+        return [decode(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if "__datetime__" in value:
+        return datetime.datetime.fromisoformat(value["__datetime__"])
+    if "__bytes__" in value:
+        return base64.b64decode(value["__bytes__"])
+    if "__stream__" in value:
+        return io.BytesIO(base64.b64decode(value["__stream__"]))
+    if "__winrm__" in value:
+        return types.SimpleNamespace(**decode(value["__winrm__"]))
+    return {key: decode(item) for key, item in value.items()}
+
+
+def materialize(response):
+    """Reads any streaming bodies in a response into memory, so they can be both
+    recorded and read by the caller"""
+
+    if isinstance(response, dict):
+        for key, item in response.items():
+            if hasattr(item, "read") and not isinstance(item, io.BytesIO):
+                response[key] = io.BytesIO(item.read())
+            else:
+                materialize(item)
+    return response
+
+
+def redact(value, path):
+    """Returns a copy of value with the item at path replaced"""
+
+    if not isinstance(value, dict) or path[0] not in value:
+        return value
+    value = dict(value)
+    value[path[0]] = REDACTED if len(path) == 1 else redact(value[path[0]], path[1:])
+    return value
+
+
+class Recorder:
+    """Records every AWS API call and WinRM command made while it is active
+
+    AWS clients are recorded below the RateLimitedClient wrapper and above botocore.
+    Each attempt the wrapper makes, including one throttled after botocore's own
+    retries, is one call in the trace. The retries botocore makes inside an attempt
+    are not recorded. Each page of a paginator is recorded as a "paginate." call.
+
+    :param function: string, name of the handler module
+    :param event: dictionary, the handler event
+    """
+
+    def __init__(self, function, event):
+        self.trace = {
+            "Version": TRACE_VERSION,
+            "Function": function,
+            "Event": encode(copy.deepcopy(event)),
+            "Calls": [],
+        }
+        self.lock = threading.Lock()
+        self.start_time = None
+        self.patched = []
+
+    def add(self, channel, operation, request, started, response=None, error=None):
+        Call = {
+            "Channel": channel,
+            "Operation": operation,
+            "Request": encode(request),
+            "Started": round(started - self.start_time, 3),
+            "Duration": round(time.time() - started, 3),
+        }
+        for key in REDACT_REQUEST.get((channel, operation), ()):
+            Call["Request"] = redact(Call["Request"], ("kwargs", key))
+        if error is None:
+            Call["Response"] = encode(response)
+            if (channel, operation) in REDACT_RESPONSE:
+                Call["Response"] = redact(Call["Response"], REDACT_RESPONSE[(channel, operation)])
+        else:
+            Call["Error"] = error
+        with self.lock:
+            self.trace["Calls"].append(Call)
+
+    def start(self):
+        self.start_time = time.time()
+        self._patch(aws_client, "tap", self.tap)
+        winrm = sys.modules.get("winrm")
+        if winrm is not None:
+            Session = winrm.Session
+
+            def session(*args, **kwargs):
+                return RecordingProxy(Session(*args, **kwargs), "winrm", self)
+
+            self._patch(winrm, "Session", session)
+
+    def tap(self, service, name, attribute):
+        """Wraps an AWS client attribute so its calls are recorded"""
+
+        return RecordingProxy.wrap(attribute, "aws." + service, name, self)
+
+    def stop(self, result=None, error=None):
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+        self.patched = []
+        self.trace["Duration"] = round(time.time() - self.start_time, 3)
+        self.trace["Result"] = encode(result)
+        if error is not None:
+            self.trace["Error"] = error
+        return self.trace
+
+    def _patch(self, owner, name, value):
+        self.patched.append((owner, name, getattr(owner, name)))
+        setattr(owner, name, value)
+
+
+class RecordingProxy:
+    """Passes calls through to a WinRM session and records them"""
+
+    def __init__(self, target, channel, recorder):
+        self._target = target
+        self._channel = channel
+        self._recorder = recorder
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if name == "protocol":
+            return RecordingProxy(attribute, self._channel + ".protocol", self._recorder)
+        return self.wrap(attribute, self._channel, name, self._recorder)
+
+    @staticmethod
+    def wrap(attribute, channel, name, recorder):
+        """Returns attribute, with calls to it recorded if it is a method"""
+
+        if name in PASSTHROUGH_ATTRIBUTES or name.startswith("_") or not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            Started = time.time()
+            Request = {"args": list(args), "kwargs": kwargs}
+            try:
+                response = materialize(attribute(*args, **kwargs))
+            except ClientError as error:
+                recorder.add(channel, name, Request, Started, error=error.response)
+                raise
+            recorder.add(channel, name, Request, Started, response=response)
+            return response
+
+        return call
+
+
+class Replayer:
+    """Feeds recorded calls back to a handler without calling AWS or the builder
+
+    Calls are answered in recorded order for each channel and operation. Recorded call
+    durations, and any time.sleep in the handler, are multiplied by speed, so 0 replays
+    as fast as possible and 1 in real time.
+
+    :param trace: dictionary, from Recorder.stop or a trace file
+    :param speed (optional): float, time scale
+    :param throttle_first (optional): number of calls to each AWS operation throttled first
+    :param throttle_rate (optional): probability any later AWS call is throttled
+    :param cycle_winrm (optional): boolean, start WinRM answers over when they run out,
+        for routines longer than the one recorded
+    """
+
+    def __init__(self, trace, speed=0.0, throttle_first=0, throttle_rate=0.0, cycle_winrm=False, seed=None):
+        self.trace = trace
+        self.speed = speed
+        self.cycle_winrm = cycle_winrm
+        self.queues = {}
+        for call in trace["Calls"]:
+            self.queues.setdefault((call["Channel"], call["Operation"]), []).append(call)
+        self.positions = {key: 0 for key in self.queues}
+        self.stub = aws_client.ThrottlingStubClient(throttle_first=throttle_first, throttle_rate=throttle_rate, seed=seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.patched = []
+        self.sleep = time.sleep
+
+    def answer(self, channel, operation):
+        """Returns the decoded response of the next recorded call, or raises its error"""
+
+        if channel.startswith("aws."):
+            # Raises ClientError for the calls chosen to be throttled, including pages,
+            # which RateLimitedClient retries like any other call
+            getattr(self.stub, channel + "." + operation)()
+
+        Key = (channel, operation)
+        with self.lock:
+            Queue = self.queues.get(Key, [])
+            Position = self.positions.get(Key, 0)
+            if Position >= len(Queue) and Queue and channel.startswith("winrm") and self.cycle_winrm:
+                Position = 0
+            if Position >= len(Queue):
+                raise RuntimeError("No recorded response left for " + channel + " " + operation + ".")
+            self.positions[Key] = Position + 1
+            self.calls += 1
+            Call = Queue[Position]
+
+        if self.speed:
+            self.sleep(Call["Duration"] * self.speed)
+        if "Error" in Call:
+            raise ClientError(Call["Error"], operation)
+        return decode(Call["Response"])
+
+    def tap(self, service, name, attribute):
+        """Answers calls to any AWS client, including ones created before install"""
+
+        if name in PASSTHROUGH_ATTRIBUTES or name.startswith("_") or not callable(attribute):
+            return attribute
+        return lambda *args, **kwargs: self.answer("aws." + service, name)
+
+    def peek(self, Key):
+        """Returns the next recorded call for a channel and operation, or an empty dictionary"""
+
+        with self.lock:
+            Queue = self.queues.get(Key, [])
+            Position = self.positions.get(Key, 0)
+            return Queue[Position] if Position < len(Queue) else {}
+
+    def install(self):
+        self._patch(aws_client, "client_factory", lambda service, *args, **kwargs: ReplayProxy(self, "aws." + service))
+        self._patch(aws_client, "tap", self.tap)
+        self._patch(time, "sleep", lambda seconds: self.sleep(seconds * self.speed))
+        winrm = sys.modules.get("winrm")
+        if winrm is None:
+            # pywinrm is only needed to talk to a real builder
+            winrm = sys.modules["winrm"] = types.ModuleType("winrm")
+            winrm.Session = None
+        self._patch(winrm, "Session", lambda *args, **kwargs: ReplayProxy(self, "winrm"))
+
+    def uninstall(self):
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+        self.patched = []
+
+    def _patch(self, owner, name, value):
+        self.patched.append((owner, name, getattr(owner, name, None)))
+        setattr(owner, name, value)
+
+    def run(self, event=None, repeat_routine=1):
+        """Runs the recorded handler against the trace
+
+        :param event (optional): dictionary, replaces the recorded event
+        :param repeat_routine (optional): integer, repeats the InstallRoutine this many times
+        :return: dictionary comparing the replayed run with the recorded one
+        """
+
+        Event = event if event is not None else decode(self.trace["Event"])
+        if repeat_routine > 1:
+            for holder in (Event.get("AutomationParameters", {}), Event.get("InstallRoutineRemaining", {})):
+                if holder.get("InstallRoutine"):
+                    holder["InstallRoutine"] = holder["InstallRoutine"] * repeat_routine
+
+        self.install()
+        try:
+            aws_client.counters.reset()
+            # Reloaded so clients created at import are created again offline
+            module = importlib.import_module(self.trace["Function"])
+            handler = importlib.reload(module).lambda_handler
+            StartTime = time.time()
+            Error = None
+            try:
+                Result = handler(Event, None)
+            except Exception as e:
+                Result = None
+                Error = str(e)
+            Duration = round(time.time() - StartTime, 3)
+        finally:
+            self.uninstall()
+
+        return {
+            "Function": self.trace["Function"],
+            "RecordedDuration": self.trace.get("Duration"),
+            "ReplayedDuration": Duration,
+            "RecordedCalls": len(self.trace["Calls"]),
+            "ReplayedCalls": self.calls,
+            "ResultMatches": Error is None and encode(Result) == self.trace.get("Result"),
+            "Error": Error,
+            "APIUsage": aws_client.counters.snapshot()["Totals"],
+        }
+
+
+class ReplayProxy:
+    """Stands in for an AWS client or WinRM session, answering from a Replayer"""
+
+    # No botocore metadata, so RateLimitedClient does not register retry hooks
+    meta = None
+
+    def __init__(self, replayer, channel):
+        self._replayer = replayer
+        self._channel = channel
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if name == "protocol":
+            return ReplayProxy(self._replayer, self._channel + ".protocol")
+        if name == "get_paginator":
+            return lambda operation: ReplayPaginator(self._replayer, self._channel, operation)
+        return lambda *args, **kwargs: self._replayer.answer(self._channel, name)
+
+
+class ReplayPaginator:
+    """Replays the recorded pages of a paginator
+
+    Like a botocore paginator, each page is requested through _method, which
+    RateLimitedClient replaces to rate limit and retry the page.
+    """
+
+    def __init__(self, replayer, channel, operation):
+        self._replayer = replayer
+        self._key = (channel, "paginate." + operation)
+        self._method = lambda **kwargs: replayer.answer(channel, "paginate." + operation)
+
+    def paginate(self, **kwargs):
+        First = self._replayer.peek(self._key).get("Request", {})
+        yield self._method(**kwargs)
+        while self._later_page(First):
+            yield self._method(**kwargs)
+
+    def _later_page(self, First):
+        """Returns True if the next recorded call continues the same pagination, which is
+        the first request plus a pagination token"""
+
+        Request = self._replayer.peek(self._key).get("Request")
+        if not Request:
+            return False
+        # Traces from before pages were recorded per request number their pages
+        if "Page" in Request:
+            return Request["Page"] > 0
+        Kwargs, FirstKwargs = Request.get("kwargs", {}), First.get("kwargs", {})
+        return len(Kwargs) > len(FirstKwargs) and all(
+            Kwargs.get(key) == value for key, value in FirstKwargs.items()
+        )
+
+
+def traced(handler):
+    """Records a handler's AWS and WinRM calls to a trace file in S3 when the
+    Trace_Enabled environment variable is true"""
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        if os.environ.get("Trace_Enabled", "false").lower() != "true":
+            return handler(event, context)
+
+        recorder = Recorder(handler.__module__, event)
+        recorder.start()
+        Result = None
+        Error = None
+        try:
+            Result = handler(event, context)
+            return Result
+        except Exception as e:
+            Error = str(e)
+            raise
+        finally:
+            Trace = recorder.stop(Result, Error)
+            Key = (
+                TRACE_PREFIX + handler.__module__ + "/"
+                + time.strftime("%Y%m%dT%H%M%S") + "_"
+                + getattr(context, "aws_request_id", "local") + ".json"
+            )
+            try:
+                aws_client.client("s3").put_object(
+                    Bucket=os.environ["Default_S3Bucket"],
+                    Key=Key,
+                    Body=json.dumps(Trace).encode("utf-8"),
+                    ContentType="application/json",
+                )
+                logger.info("Trace of %s calls written to %s.", len(Trace["Calls"]), Key)
+            except Exception as e:
+                logger.error(e)
+                logger.info("Unable to write trace to S3.")
+
+    return wrapper
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a recorded pipeline function trace.")
+    parser.add_argument("trace", nargs="+", help="trace JSON files")
+    parser.add_argument("--speed", type=float, default=0.0, help="time scale, 0 for no waits, 1 for real time")
+    parser.add_argument("--throttle-first", type=int, default=0, help="AWS calls per operation to throttle first")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="probability of throttling any AWS call")
+    parser.add_argument("--repeat-routine", type=int, default=1, help="repeat the InstallRoutine this many times")
+    parser.add_argument("--seed", type=int, help="random seed for throttling")
+    args = parser.parse_args(argv)
+
+    Results = []
+    for path in args.trace:
+        with open(path) as file:
+            Trace = json.load(file)
+        Replay = Replayer(
+            Trace,
+            speed=args.speed,
+            throttle_first=args.throttle_first,
+            throttle_rate=args.throttle_rate,
+            cycle_winrm=args.repeat_routine > 1,
+            seed=args.seed,
+        )
+        Results.append(Replay.run(repeat_routine=args.repeat_routine))
+    json.dump(Results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
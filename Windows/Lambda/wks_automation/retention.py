@@ -0,0 +1,270 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Retention pruning of the images and bundles created by the pipeline.
+
+Each run names its image ImageNamePrefix-YYYY-MM-DD-HH-MM, and its bundles the same way
+from BundleNamePrefix. Images and bundles are grouped into series by the name without
+the timestamp. In each series the newest ones, and the ones inside the age window, are
+kept and the rest are deleted, unless a WorkSpace, a bundle or a cached image layer
+still uses them.
+"""
+
+import json
+import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from wks_automation import aws_client
+from wks_automation.aws_client import is_throttling_error
+from wks_automation.layers import SsmLayerCache
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Image and bundle names given by the pipeline, a series name and a timestamp
+PIPELINE_NAME = re.compile(r"^(?P<series>.+)-\d{4}-\d{2}-\d{2}-\d{2}-\d{2}$")
+
+# Prefixes selects the series to prune, Tags (optional) must all be set on an image or
+# bundle before it is deleted. At least one image or bundle is always kept per series.
+DEFAULT_RETENTION = {
+    "Prefixes": [],
+    "Tags": {},
+    "KeepNewest": 5,
+    "MaxAgeDays": 30,
+    "DryRun": True,
+    "Concurrency": 4,
+}
+
+# Only images in these states are deleted, images still being created are left alone
+DELETABLE_IMAGE_STATES = ("AVAILABLE", "ERROR")
+
+
+def series_of(name, prefixes):
+    """Returns the series of a pipeline image or bundle name, or None
+
+    :param name: string, image or bundle name
+    :param prefixes: list of name prefixes selecting the series to prune
+    :return: string, or None if the name was not given by the pipeline or not selected
+    """
+
+    Match = PIPELINE_NAME.match(name)
+    if not Match:
+        return None
+    Series = Match.group("series")
+    if not any(Series.startswith(prefix) for prefix in prefixes):
+        return None
+    return Series
+
+
+def retention_from_environment():
+    """Creates the retention settings from the Retention_* environment variables
+
+    :return: dictionary of retention settings
+    """
+
+    return dict(
+        DEFAULT_RETENTION,
+        Prefixes=[prefix.strip() for prefix in os.environ.get("Retention_Prefixes", "").split(",") if prefix.strip()],
+        Tags=json.loads(os.environ.get("Retention_Tags") or "{}"),
+        KeepNewest=int(os.environ.get("Retention_Keep_Newest", DEFAULT_RETENTION["KeepNewest"])),
+        MaxAgeDays=float(os.environ.get("Retention_Max_Age_Days", DEFAULT_RETENTION["MaxAgeDays"])),
+        DryRun=os.environ.get("Retention_Dry_Run", "true").lower() == "true",
+    )
+
+
+class ArtifactRetention:
+    """Plans and applies retention to the pipeline's images and bundles
+
+    :param settings: dictionary of retention settings, see DEFAULT_RETENTION
+    :param protected_bundles (optional): list of bundle ids that are never deleted
+    :param layer_cache (optional): SsmLayerCache or LocalLayerCache
+    :param workspaces_client (optional): boto3 WorkSpaces client
+    """
+
+    def __init__(self, settings, protected_bundles=(), layer_cache=None, workspaces_client=None):
+        self.settings = dict(DEFAULT_RETENTION, **settings)
+        self.protected_bundles = set(protected_bundles)
+        self.layer_cache = layer_cache or SsmLayerCache()
+        self.workspaces_client = workspaces_client or aws_client.client("workspaces")
+
+    def _paginate(self, operation, key, **kwargs):
+        Items = []
+        paginator = self.workspaces_client.get_paginator(operation)
+        for page in paginator.paginate(**kwargs):
+            Items += page[key]
+        return Items
+
+    def _tagged(self, resource_id):
+        """Returns True if the resource has every tag in the Tags setting"""
+
+        if not self.settings["Tags"]:
+            return True
+        response = self.workspaces_client.describe_tags(ResourceId=resource_id)
+        Tags = {tag["Key"]: tag.get("Value") for tag in response["TagList"]}
+        return all(Tags.get(key) == value for key, value in self.settings["Tags"].items())
+
+    def _expired(self, items, id_key, created_key):
+        """Splits one kind of resource into kept and expired, per series
+
+        :return: tuple of the kept list and the expired list of report entries
+        """
+
+        Series = {}
+        for item in items:
+            Name = series_of(item["Name"], self.settings["Prefixes"])
+            if Name:
+                Series.setdefault(Name, []).append(item)
+
+        KeepNewest = max(1, int(self.settings["KeepNewest"]))
+        Cutoff = time.time() - float(self.settings["MaxAgeDays"]) * 86400
+        Kept, Expired = [], []
+        for name, members in Series.items():
+            members.sort(key=lambda item: item[created_key], reverse=True)
+            for rank, item in enumerate(members):
+                Entry = {
+                    "Id": item[id_key],
+                    "Name": item["Name"],
+                    "Series": name,
+                    "Created": item[created_key].isoformat(),
+                }
+                if rank < KeepNewest:
+                    Kept.append(dict(Entry, Reason="Newest " + str(KeepNewest)))
+                elif item[created_key].timestamp() >= Cutoff:
+                    Kept.append(dict(Entry, Reason="Within " + str(self.settings["MaxAgeDays"]) + " days"))
+                else:
+                    Expired.append(Entry)
+        return Kept, Expired
+
+    def plan(self):
+        """Lists the pipeline's images and bundles and decides which to delete
+
+        :return: dictionary with the Images and Bundles to Keep and Delete
+        """
+
+        Images = self._paginate("describe_workspace_images", "Images", ImageType="OWNED")
+        Bundles = self._paginate("describe_workspace_bundles", "Bundles")
+        Workspaces = self._paginate("describe_workspaces", "Workspaces")
+        Layers = self.layer_cache.records().values()
+        logger.info(
+            "Found %s images, %s bundles, %s WorkSpaces and %s cached layers.",
+            len(Images),
+            len(Bundles),
+            len(Workspaces),
+            len(Layers),
+        )
+
+        InUse = {workspace["BundleId"]: workspace["WorkspaceId"] for workspace in Workspaces}
+        LayerBundles = {layer["BundleId"] for layer in Layers if layer.get("BundleId")}
+        LayerImages = {layer["ImageId"] for layer in Layers}
+
+        BundlesKept, BundlesExpired = self._expired(Bundles, "BundleId", "CreationTime")
+        BundlesDeleted = []
+        for entry in BundlesExpired:
+            if entry["Id"] in InUse:
+                BundlesKept.append(dict(entry, Reason="Used by WorkSpace " + InUse[entry["Id"]]))
+            elif entry["Id"] in self.protected_bundles:
+                BundlesKept.append(dict(entry, Reason="Default builder bundle"))
+            elif entry["Id"] in LayerBundles:
+                BundlesKept.append(dict(entry, Reason="Cached image layer"))
+            elif not self._tagged(entry["Id"]):
+                BundlesKept.append(dict(entry, Reason="Missing retention tags"))
+            else:
+                BundlesDeleted.append(entry)
+
+        # Images are still referenced by the bundles that are not deleted
+        Deleted = {entry["Id"] for entry in BundlesDeleted}
+        Referenced = {
+            bundle["ImageId"]: bundle["BundleId"]
+            for bundle in Bundles
+            if bundle.get("ImageId") and bundle["BundleId"] not in Deleted
+        }
+        Replaced = {}
+        for bundle in Bundles:
+            if bundle["BundleId"] in Deleted and bundle.get("ImageId"):
+                Replaced.setdefault(bundle["ImageId"], []).append(bundle["BundleId"])
+        States = {image["ImageId"]: image["State"] for image in Images}
+
+        ImagesKept, ImagesExpired = self._expired(Images, "ImageId", "Created")
+        ImagesDeleted = []
+        for entry in ImagesExpired:
+            if entry["Id"] in Referenced:
+                ImagesKept.append(dict(entry, Reason="Used by bundle " + Referenced[entry["Id"]]))
+            elif entry["Id"] in LayerImages:
+                ImagesKept.append(dict(entry, Reason="Cached image layer"))
+            elif States[entry["Id"]] not in DELETABLE_IMAGE_STATES:
+                ImagesKept.append(dict(entry, Reason="Image is " + States[entry["Id"]]))
+            elif not self._tagged(entry["Id"]):
+                ImagesKept.append(dict(entry, Reason="Missing retention tags"))
+            else:
+                ImagesDeleted.append(dict(entry, Bundles=Replaced.get(entry["Id"], [])))
+
+        return {
+            "Images": {"Keep": ImagesKept, "Delete": ImagesDeleted},
+            "Bundles": {"Keep": BundlesKept, "Delete": BundlesDeleted},
+        }
+
+    def _delete(self, operation, key, entry):
+        try:
+            getattr(self.workspaces_client, operation)(**{key: entry["Id"]})
+            logger.info("Deleted %s (%s).", entry["Name"], entry["Id"])
+            return dict(entry, Status="Deleted")
+        except Exception as e:
+            logger.error(e)
+            # Left for the next run, which plans again from the current state
+            Status = "Throttled" if is_throttling_error(e) else "Failed"
+            logger.info("Unable to delete %s (%s).", entry["Name"], entry["Id"])
+            return dict(entry, Status=Status, Error=str(e))
+
+    def prune(self, plan):
+        """Deletes the planned bundles, then the planned images, concurrently
+
+        Bundles go first, since an image cannot be deleted while a bundle uses it. Calls
+        are rate limited by aws_client, and at most Concurrency run at a time.
+
+        :param plan: dictionary returned by plan
+        :return: dictionary with the results for Images and Bundles
+        """
+
+        Results = {"Images": [], "Bundles": []}
+        if self.settings["DryRun"]:
+            logger.info("Dry run, nothing deleted.")
+            return Results
+
+        Workers = max(1, int(self.settings["Concurrency"]))
+        with ThreadPoolExecutor(max_workers=Workers) as executor:
+            Results["Bundles"] = list(
+                executor.map(
+                    lambda entry: self._delete("delete_workspace_bundle", "BundleId", entry),
+                    plan["Bundles"]["Delete"],
+                )
+            )
+            # Images whose bundles were not all deleted are still in use
+            Remaining = {result["Id"] for result in Results["Bundles"] if result["Status"] != "Deleted"}
+            Images = []
+            for entry in plan["Images"]["Delete"]:
+                if Remaining.intersection(entry["Bundles"]):
+                    Results["Images"].append(dict(entry, Status="Skipped"))
+                else:
+                    Images.append(entry)
+            Results["Images"] += list(
+                executor.map(
+                    lambda entry: self._delete("delete_workspace_image", "ImageId", entry),
+                    Images,
+                )
+            )
+        return Results
@@ -0,0 +1,317 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import logging
+import time
+from wks_automation import aws_client
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+METRIC_NAMESPACE = "WKS_Automation"
+
+# Defaults for the FleetRollout pipeline parameter
+DEFAULT_ROLLOUT = {
+    "WorkspaceIds": [],
+    "BatchSize": 25,
+    "Concurrency": 5,
+    "CanarySize": 5,
+    "MaxFailureRate": 0.1,
+}
+
+# States of a migrated WorkSpace that end its migration
+SUCCEEDED_STATES = ["AVAILABLE", "STOPPED"]
+FAILED_STATES = ["ERROR", "UNHEALTHY", "TERMINATING", "TERMINATED", "SUSPENDED"]
+
+# A migration still pending after this long is counted as failed
+MIGRATION_TIMEOUT = 3 * 3600
+
+
+def validate_rollout(Rollout, Name="FleetRollout"):
+    """Checks the FleetRollout pipeline parameter
+
+    :param Rollout: dictionary of settings, or false for no rollout
+    :param Name: string, name of the setting for problem messages
+    :return: list of problems, empty if the settings are valid
+    """
+
+    if Rollout is False or Rollout is None:
+        return []
+    if not isinstance(Rollout, dict):
+        return [Name + " must be an object or false."]
+
+    Problems = []
+    for Field in sorted(set(Rollout) - set(DEFAULT_ROLLOUT) - {"SourceBundleId"}):
+        Problems.append(Name + ": unknown field " + Field + ".")
+    if "SourceBundleId" in Rollout and not isinstance(Rollout["SourceBundleId"], str):
+        Problems.append(Name + ": SourceBundleId must be a bundle id.")
+    if "WorkspaceIds" in Rollout and not (
+        isinstance(Rollout["WorkspaceIds"], list) and all(isinstance(value, str) for value in Rollout["WorkspaceIds"])
+    ):
+        Problems.append(Name + ": WorkspaceIds must be a list of WorkSpace ids.")
+    for Field, Minimum in (("BatchSize", 1), ("Concurrency", 1), ("CanarySize", 0)):
+        if Field in Rollout and (
+            not isinstance(Rollout[Field], int) or isinstance(Rollout[Field], bool) or Rollout[Field] < Minimum
+        ):
+            Problems.append(Name + ": " + Field + " must be a whole number of " + str(Minimum) + " or more.")
+    if "MaxFailureRate" in Rollout and (
+        not isinstance(Rollout["MaxFailureRate"], (int, float))
+        or isinstance(Rollout["MaxFailureRate"], bool)
+        or not 0 <= Rollout["MaxFailureRate"] <= 1
+    ):
+        Problems.append(Name + ": MaxFailureRate must be a number from 0 to 1.")
+    return Problems
+
+
+def plan_waves(workspaces, canary_size, batch_size):
+    """Splits the WorkSpaces to migrate into a canary wave and batches
+
+    :param workspaces: list of dictionaries with WorkspaceId and BundleId
+    :param canary_size: integer, size of the first wave, 0 for no canary
+    :param batch_size: integer, size of the other waves
+    :return: list of lists of dictionaries
+    """
+
+    Waves = []
+    if canary_size:
+        Waves.append(workspaces[:canary_size])
+        workspaces = workspaces[canary_size:]
+    for index in range(0, len(workspaces), batch_size):
+        Waves.append(workspaces[index:index + batch_size])
+    return [wave for wave in Waves if wave]
+
+
+class FleetRollout:
+    """Migrates user WorkSpaces onto new bundles in waves
+
+    The first wave is a small canary. Each wave must finish before the next starts, and
+    the rollout halts if the failures in a wave go over the allowed failure rate. No more
+    than the concurrency limit of migrations are in progress at once. The rollout is a
+    plain dictionary, so it can be carried through the Step Function between calls to
+    advance.
+
+    :param batch_size (optional): integer, WorkSpaces per wave after the canary
+    :param concurrency (optional): integer, migrations in progress at once
+    :param canary_size (optional): integer, WorkSpaces in the canary wave
+    :param max_failure_rate (optional): float, failed share of a wave that halts the rollout
+    """
+
+    def __init__(
+        self,
+        batch_size=DEFAULT_ROLLOUT["BatchSize"],
+        concurrency=DEFAULT_ROLLOUT["Concurrency"],
+        canary_size=DEFAULT_ROLLOUT["CanarySize"],
+        max_failure_rate=DEFAULT_ROLLOUT["MaxFailureRate"],
+        workspaces_client=None,
+        cloudwatch_client=None,
+    ):
+        self.batch_size = max(int(batch_size), 1)
+        self.concurrency = max(int(concurrency), 1)
+        self.canary_size = max(int(canary_size), 0)
+        self.max_failure_rate = float(max_failure_rate)
+        self.workspaces_client = workspaces_client or aws_client.client("workspaces")
+        self.cloudwatch_client = cloudwatch_client or aws_client.client("cloudwatch")
+
+    def plan(self, source_bundle_id, bundles, workspace_ids=None, exclude=()):
+        """Finds the WorkSpaces on the source bundle and plans their migration
+
+        Each WorkSpace moves to the new bundle with its compute type, or the first new
+        bundle if none match.
+
+        :param source_bundle_id: string, bundle the WorkSpaces are on today
+        :param bundles: list of new bundle descriptions from create_workspace_bundle
+        :param workspace_ids (optional): list, only migrate these WorkSpaces
+        :param exclude (optional): WorkSpace ids and user names never to migrate
+        :return: dictionary, the rollout
+        """
+
+        Targets = {bundle["ComputeType"]["Name"]: bundle["BundleId"] for bundle in reversed(bundles)}
+        Default = bundles[0]["BundleId"]
+        Exclude = {value.lower() for value in exclude}
+
+        Workspaces = []
+        paginator = self.workspaces_client.get_paginator("describe_workspaces")
+        for page in paginator.paginate(BundleId=source_bundle_id):
+            for workspace in page["Workspaces"]:
+                if workspace_ids and workspace["WorkspaceId"] not in workspace_ids:
+                    continue
+                if workspace["WorkspaceId"].lower() in Exclude or workspace.get("UserName", "").lower() in Exclude:
+                    continue
+                if workspace["State"] in FAILED_STATES:
+                    continue
+                ComputeType = workspace.get("WorkspaceProperties", {}).get("ComputeTypeName")
+                Workspaces.append(
+                    {"WorkspaceId": workspace["WorkspaceId"], "BundleId": Targets.get(ComputeType, Default)}
+                )
+
+        Waves = plan_waves(Workspaces, self.canary_size, self.batch_size)
+        logger.info(
+            "Planned migration of %s WorkSpace(s) from %s in %s wave(s).",
+            len(Workspaces),
+            source_bundle_id,
+            len(Waves),
+        )
+        return {
+            "Status": "IN_PROGRESS" if Waves else "COMPLETE",
+            "Started": round(time.time()),
+            "Waves": Waves,
+            "Wave": 0,
+            "Launched": 0,
+            "InFlight": [],
+            "Succeeded": 0,
+            "WaveFailed": 0,
+            "Failed": [],
+        }
+
+    def _check_in_flight(self, rollout):
+        """Moves finished migrations out of InFlight
+
+        :return: number of migrations that finished
+        """
+
+        InFlight = rollout["InFlight"]
+        States = {}
+        TargetIds = [migration["TargetWorkspaceId"] for migration in InFlight]
+        for index in range(0, len(TargetIds), 25):
+            response = self.workspaces_client.describe_workspaces(WorkspaceIds=TargetIds[index:index + 25])
+            States.update({workspace["WorkspaceId"]: workspace["State"] for workspace in response["Workspaces"]})
+
+        Now = time.time()
+        Remaining = []
+        for migration in InFlight:
+            State = States.get(migration["TargetWorkspaceId"], "PENDING")
+            if State in SUCCEEDED_STATES:
+                rollout["Succeeded"] += 1
+            elif State in FAILED_STATES or Now - migration["Started"] > MIGRATION_TIMEOUT:
+                self._fail(rollout, migration["WorkspaceId"], "Migrated WorkSpace is " + State + ".")
+            else:
+                Remaining.append(migration)
+        rollout["InFlight"] = Remaining
+        return len(InFlight) - len(Remaining)
+
+    def _fail(self, rollout, workspace_id, error):
+        logger.info("Migration of %s failed: %s", workspace_id, error)
+        rollout["WaveFailed"] += 1
+        rollout["Failed"].append({"WorkspaceId": workspace_id, "Error": error})
+
+    def _launch(self, rollout):
+        """Starts migrations from the current wave, up to the concurrency limit
+
+        :return: number of migrations started or failed to start
+        """
+
+        Wave = rollout["Waves"][rollout["Wave"]]
+        Slots = self.concurrency - len(rollout["InFlight"])
+        Batch = Wave[rollout["Launched"]:rollout["Launched"] + max(Slots, 0)]
+        for workspace in Batch:
+            rollout["Launched"] += 1
+            try:
+                response = self.workspaces_client.migrate_workspace(
+                    SourceWorkspaceId=workspace["WorkspaceId"], BundleId=workspace["BundleId"]
+                )
+                rollout["InFlight"].append(
+                    {
+                        "WorkspaceId": workspace["WorkspaceId"],
+                        "TargetWorkspaceId": response["TargetWorkspaceId"],
+                        "Started": round(time.time()),
+                    }
+                )
+            except Exception as e:
+                logger.error(e)
+                if aws_client.is_throttling_error(e):
+                    rollout["Launched"] -= 1
+                    break
+                self._fail(rollout, workspace["WorkspaceId"], str(e))
+        return len(Batch)
+
+    def advance(self, rollout):
+        """Checks migrations in progress, halts or moves to the next wave, and starts
+        more migrations
+
+        :param rollout: dictionary from plan or a previous advance
+        :return: tuple of the updated rollout and whether anything changed
+        """
+
+        if rollout["Status"] != "IN_PROGRESS":
+            return rollout, False
+
+        Changed = self._check_in_flight(rollout) > 0
+        WaveSize = len(rollout["Waves"][rollout["Wave"]])
+
+        # Failures already over the limit cannot recover, so halt without waiting for
+        # the rest of the wave
+        if rollout["WaveFailed"] / WaveSize > self.max_failure_rate:
+            rollout["Status"] = "HALTED"
+            rollout["HaltReason"] = "{0} of {1} migrations failed in {2} wave {3}.".format(
+                rollout["WaveFailed"],
+                WaveSize,
+                "canary" if rollout["Wave"] == 0 and self.canary_size else "rollout",
+                rollout["Wave"] + 1,
+            )
+            logger.info("Halting rollout: %s", rollout["HaltReason"])
+            return rollout, True
+
+        if rollout["Launched"] == WaveSize and not rollout["InFlight"]:
+            logger.info("Wave %s of %s complete.", rollout["Wave"] + 1, len(rollout["Waves"]))
+            rollout["Wave"] += 1
+            rollout["Launched"] = 0
+            rollout["WaveFailed"] = 0
+            Changed = True
+            if rollout["Wave"] == len(rollout["Waves"]):
+                rollout["Status"] = "COMPLETE"
+                return rollout, Changed
+
+        Changed = self._launch(rollout) > 0 or Changed
+        return rollout, Changed
+
+    def report(self, rollout):
+        """Summarizes the rollout progress and throughput, and publishes it as metrics
+
+        :param rollout: dictionary
+        :return: dictionary
+        """
+
+        Total = sum(len(wave) for wave in rollout["Waves"])
+        Elapsed = max(time.time() - rollout["Started"], 1)
+        Report = {
+            "Status": rollout["Status"],
+            "Total": Total,
+            "Succeeded": rollout["Succeeded"],
+            "Failed": len(rollout["Failed"]),
+            "InFlight": len(rollout["InFlight"]),
+            "Wave": min(rollout["Wave"] + 1, len(rollout["Waves"])),
+            "Waves": len(rollout["Waves"]),
+            "ElapsedMinutes": round(Elapsed / 60),
+            "PerHour": round(rollout["Succeeded"] / (Elapsed / 3600), 1),
+        }
+        Report["Remaining"] = Total - Report["Succeeded"] - Report["Failed"] - Report["InFlight"]
+        if "HaltReason" in rollout:
+            Report["HaltReason"] = rollout["HaltReason"]
+
+        try:
+            self.cloudwatch_client.put_metric_data(
+                Namespace=METRIC_NAMESPACE,
+                MetricData=[
+                    {"MetricName": "RolloutSucceeded", "Value": Report["Succeeded"], "Unit": "Count"},
+                    {"MetricName": "RolloutFailed", "Value": Report["Failed"], "Unit": "Count"},
+                    {"MetricName": "RolloutInFlight", "Value": Report["InFlight"], "Unit": "Count"},
+                    {"MetricName": "RolloutThroughput", "Value": Report["PerHour"], "Unit": "Count"},
+                ],
+            )
+        except Exception as e:
+            logger.error(e)
+            logger.info("Unable to publish rollout metrics.")
+        return Report
@@ -0,0 +1,228 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import hashlib
+import json
+import logging
+import re
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Install routine step types, with the minimum and maximum number of attributes after
+# the step type
+STEP_TYPES = {
+    "DOWNLOAD_S3": (1, 2),
+    "DOWNLOAD_HTTP": (1, 2),
+    "RUN_POWERSHELL": (1, 1),
+    "RUN_COMMAND": (1, 1),
+    "REBOOT": (0, 0),
+    "PUSH_FILE": (2, 2),
+}
+
+# Retry policy for a failed step, unless the routine or the step sets its own. Field
+# names follow Step Functions Retry. Exit code 1618 is another installation in
+# progress. TransportErrors covers WinRM connection failures and AWS API throttling.
+DEFAULT_STEP_RETRY = {
+    "MaxAttempts": 2,
+    "IntervalSeconds": 30,
+    "BackoffRate": 2.0,
+    "MaxDelaySeconds": 300,
+    "ExitCodes": [1618],
+    "TransportErrors": True,
+}
+
+# Prints True if Windows has a reboot pending from servicing, updates or file renames
+PENDING_REBOOT_SCRIPT = """
+[bool]((Test-Path 'HKLM:\\SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\Component Based Servicing\\RebootPending') -or
+    (Test-Path 'HKLM:\\SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\WindowsUpdate\\Auto Update\\RebootRequired') -or
+    [bool](Get-ItemProperty 'HKLM:\\SYSTEM\\CurrentControlSet\\Control\\Session Manager' -Name PendingFileRenameOperations -ErrorAction Ignore))
+"""
+
+
+def split_s3_url(s3_url):
+    """Splits an s3://bucket/key URL
+
+    :param s3_url: string
+    :return: tuple of bucket and key, key is empty if the URL has no key
+    """
+
+    Parts = s3_url.replace("s3://", "", 1).split("/", 1)
+    return Parts[0], Parts[1] if len(Parts) > 1 else ""
+
+
+def split_step(step):
+    """Separates the optional step settings, a JSON object after the step attributes
+
+    :param step: list starting with the step type
+    :return: tuple of the step without settings and the settings dictionary
+    """
+
+    if len(step) > 1 and isinstance(step[-1], dict):
+        return step[:-1], step[-1]
+    return step, {}
+
+
+def step_hash(step):
+    """Returns a short, stable identifier for an install routine step, used to match
+    a step with its earlier runs. Step settings are not part of the identifier.
+
+    :param step: list starting with the step type
+    :return: string, hex digest
+    """
+
+    step = split_step(step)[0]
+    Normalized = [step[0].upper()] + list(step[1:])
+    return hashlib.sha256(json.dumps(Normalized).encode("utf-8")).hexdigest()[:16]
+
+
+def retry_policy(Options, RoutineRetry=None):
+    """Returns the retry policy for a step, the step's Retry setting over the routine's
+
+    :param Options: dictionary of step settings
+    :param RoutineRetry: dictionary, routine retry policy, or False for no retries
+    :return: dictionary with every DEFAULT_STEP_RETRY field
+    """
+
+    Policy = dict(DEFAULT_STEP_RETRY)
+    for Override in (RoutineRetry, Options.get("Retry")):
+        if Override is False:
+            Policy["MaxAttempts"] = 0
+        elif Override:
+            Policy.update(Override)
+    return Policy
+
+
+def retry_delay(Policy, Retries):
+    """Returns the wait before a retry, growing by BackoffRate after each one
+
+    :param Policy: dictionary, step retry policy
+    :param Retries: integer, number of the retry about to run, starting at 1
+    :return: integer, seconds
+    """
+
+    Delay = Policy["IntervalSeconds"] * Policy["BackoffRate"] ** (Retries - 1)
+    return int(min(Delay, Policy["MaxDelaySeconds"]))
+
+
+def validate_retry(Retry, Name="Retry"):
+    """Checks a step retry policy
+
+    :param Retry: dictionary, or False for no retries
+    :param Name: string, name of the setting for problem messages
+    :return: list of problems, empty if the policy is valid
+    """
+
+    if Retry is False:
+        return []
+    if not isinstance(Retry, dict):
+        return [Name + " must be an object or false."]
+
+    Problems = []
+    for Field in sorted(set(Retry) - set(DEFAULT_STEP_RETRY)):
+        Problems.append(Name + ": unknown field " + Field + ".")
+    for Field in ("MaxAttempts", "IntervalSeconds", "MaxDelaySeconds"):
+        if Field in Retry and (not isinstance(Retry[Field], int) or isinstance(Retry[Field], bool) or Retry[Field] < 0):
+            Problems.append(Name + ": " + Field + " must be a whole number of 0 or more.")
+    if "BackoffRate" in Retry and (
+        not isinstance(Retry["BackoffRate"], (int, float)) or isinstance(Retry["BackoffRate"], bool) or Retry["BackoffRate"] < 1
+    ):
+        Problems.append(Name + ": BackoffRate must be a number of 1 or more.")
+    if "ExitCodes" in Retry and not (
+        isinstance(Retry["ExitCodes"], list)
+        and all(isinstance(code, int) and not isinstance(code, bool) for code in Retry["ExitCodes"])
+    ):
+        Problems.append(Name + ": ExitCodes must be a list of exit codes.")
+    if "TransportErrors" in Retry and not isinstance(Retry["TransportErrors"], bool):
+        Problems.append(Name + ": TransportErrors must be true or false.")
+    return Problems
+
+
+def validate_routine(InstallRoutine):
+    """Checks an install routine against the step schema
+
+    :param InstallRoutine: list of steps, each a list starting with the step type and
+        optionally ending with a settings object
+    :return: list of problems, empty if the routine is valid
+    """
+
+    Problems = []
+    if not isinstance(InstallRoutine, list):
+        return ["InstallRoutine must be a list of steps."]
+
+    for number, step in enumerate(InstallRoutine, start=1):
+        if not isinstance(step, list) or not step or not isinstance(step[0], str):
+            Problems.append("Step " + str(number) + ": must be a list starting with the step type.")
+            continue
+
+        step, Options = split_step(step)
+        if set(Options) - {"Retry"}:
+            Problems.append("Step " + str(number) + ": the only step setting is Retry.")
+        Problems.extend(validate_retry(Options.get("Retry", {}), "Step " + str(number) + " Retry"))
+
+        StepType = step[0].upper()
+        if StepType not in STEP_TYPES:
+            Problems.append("Step " + str(number) + ": unknown step type " + step[0] + ".")
+            continue
+
+        Minimum, Maximum = STEP_TYPES[StepType]
+        if not Minimum <= len(step) - 1 <= Maximum:
+            Problems.append(
+                "Step " + str(number) + ": " + StepType + " takes " + str(Minimum)
+                + (" to " + str(Maximum) if Maximum != Minimum else "") + " attribute(s)."
+            )
+            continue
+
+        if not all(isinstance(attribute, str) and attribute for attribute in step[1:]):
+            Problems.append("Step " + str(number) + ": attributes must be non-empty strings.")
+            continue
+
+        if StepType == "DOWNLOAD_S3":
+            Bucket, Key = split_s3_url(step[1])
+            if not step[1].startswith("s3://") or not Bucket or not Key or Key.endswith("/"):
+                Problems.append("Step " + str(number) + ": " + step[1] + " is not an s3://bucket/key URL.")
+        elif StepType == "DOWNLOAD_HTTP":
+            if not step[1].lower().startswith(("http://", "https://")):
+                Problems.append("Step " + str(number) + ": " + step[1] + " is not an http or https URL.")
+        elif StepType == "PUSH_FILE":
+            if not re.match(r"^[A-Za-z]:\\[^\\]", step[1]):
+                Problems.append("Step " + str(number) + ": " + step[1] + " is not a full path to a file.")
+            if step[2].startswith("s3://"):
+                Bucket, Key = split_s3_url(step[2])
+                if not Bucket or not Key or Key.endswith("/"):
+                    Problems.append("Step " + str(number) + ": " + step[2] + " is not an s3://bucket/key URL.")
+
+    return Problems
+
+
+def routine_artifacts(InstallRoutine):
+    """Lists the S3 objects and HTTP URLs an install routine downloads or pushes
+
+    :param InstallRoutine: list of steps, assumed valid
+    :return: tuple of a list of (bucket, key) and a list of URLs
+    """
+
+    S3Objects = []
+    Urls = []
+    for step in InstallRoutine:
+        step = split_step(step)[0]
+        if step[0].upper() == "DOWNLOAD_S3":
+            S3Objects.append(split_s3_url(step[1]))
+        elif step[0].upper() == "DOWNLOAD_HTTP":
+            Urls.append(step[1])
+        elif step[0].upper() == "PUSH_FILE" and step[2].startswith("s3://"):
+            S3Objects.append(split_s3_url(step[2]))
+    return S3Objects, Urls
@@ -0,0 +1,238 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import copy
+import functools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import sys
+import time
+
+# Lambda handlers log through the root logger, records go to CloudWatch as one JSON
+# object per line so they can be filtered by pipeline execution and builder
+LOG_LEVEL = os.environ.get("Log_Level", "INFO").upper()
+
+# Records from the same line of code after the first LOG_SAMPLE_FIRST in an invocation
+# are sampled, one in LOG_SAMPLE_EVERY is kept. Warnings and errors are always kept, and
+# so are records logged with extra={"sample": False}.
+LOG_SAMPLE_FIRST = int(os.environ.get("Log_Sample_First", "10"))
+LOG_SAMPLE_EVERY = int(os.environ.get("Log_Sample_Every", "50"))
+
+# Secrets that must not reach the logs, pre-signed URL signatures and credentials,
+# passwords, and access key ids
+REDACTIONS = [
+    (re.compile(r"(X-Amz-(?:Signature|Credential|Security-Token)=)[^&\s\"']+", re.IGNORECASE), r"\1REDACTED"),
+    (re.compile(r"((?:password|passwd|pwd|secret)[\"']?\s*[:=]\s*[\"']?)[^\s\"',;&]+", re.IGNORECASE), r"\1REDACTED"),
+    (re.compile(r"(ConvertTo-SecureString\s+(?:-String\s+)?[\"'])[^\"']+", re.IGNORECASE), r"\1REDACTED"),
+    (re.compile(r"\b(?:AKIA|ASIA)[A-Z0-9]{16}\b"), "REDACTED"),
+]
+
+# Ids added to every record of the current invocation
+Context = {"Execution": None, "Builder": None, "RequestId": None}
+
+
+def redact(text):
+    """Removes secrets from a log message
+
+    :param text: string
+    :return: string
+    """
+
+    for pattern, replacement in REDACTIONS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def correlation_ids(event):
+    """Finds the pipeline execution and image builder WorkSpace an event belongs to
+
+    :param event: Lambda event, Step Function state or EventBridge event
+    :return: tuple of execution name and WorkSpace id, each None if not found
+    """
+
+    if not isinstance(event, dict):
+        return None, None
+
+    Parameters = event.get("AutomationParameters") or {}
+    Execution = (
+        Parameters.get("PipelineExecutionId")
+        or (event.get("PipelineExecution") or {}).get("Name")
+        or event.get("PipelineExecutionId")
+        or (event.get("detail") or {}).get("name")
+    )
+    try:
+        Builder = event["ImageBuilderStatus"]["Workspaces"][0]["WorkspaceId"]
+    except (KeyError, IndexError, TypeError):
+        Builder = (Parameters.get("ImageBuilderIdArray") or {}).get("WorkspaceId")
+    return Execution, Builder
+
+
+def bind(**ids):
+    """Sets ids for the rest of the invocation, once a function learns them
+
+    :param ids: Execution, Builder or RequestId
+    """
+
+    Context.update(ids)
+
+
+class ContextFilter(logging.Filter):
+    """Adds the invocation's ids to each record, in the thread that logged it"""
+
+    def filter(self, record):
+        record.execution = Context["Execution"]
+        record.builder = Context["Builder"]
+        record.request_id = Context["RequestId"]
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps the first records from each line of code, then one in every few"""
+
+    def __init__(self, first=LOG_SAMPLE_FIRST, every=LOG_SAMPLE_EVERY):
+        super().__init__()
+        self.first = first
+        self.every = every
+        self.counts = {}
+        self.suppressed = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not getattr(record, "sample", True):
+            return True
+
+        Key = (record.pathname, record.lineno)
+        Count = self.counts.get(Key, 0) + 1
+        self.counts[Key] = Count
+        if Count <= self.first:
+            return True
+        if self.every and (Count - self.first) % self.every == 0:
+            record.occurrence = Count
+            return True
+        self.suppressed += 1
+        return False
+
+    def reset(self):
+        """Starts counting again for a new invocation
+
+        :return: integer, records suppressed since the last reset
+        """
+
+        Suppressed = self.suppressed
+        self.counts = {}
+        self.suppressed = 0
+        return Suppressed
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a single line JSON object, with secrets redacted"""
+
+    def format(self, record):
+        Entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created))
+            + ".%03dZ" % record.msecs,
+            "level": record.levelname,
+            "message": redact(record.getMessage()),
+            "location": record.module + ":" + str(record.lineno),
+            "function": os.environ.get("AWS_LAMBDA_FUNCTION_NAME"),
+            "requestId": getattr(record, "request_id", None),
+            "execution": getattr(record, "execution", None),
+            "builder": getattr(record, "builder", None),
+        }
+        if getattr(record, "occurrence", None):
+            Entry["occurrence"] = record.occurrence
+        if record.exc_info:
+            Entry["exception"] = redact(self.formatException(record.exc_info))
+        return json.dumps(Entry, default=str)
+
+
+class JsonQueueHandler(logging.handlers.QueueHandler):
+    """Queues records with their message merged, keeping the exception for JsonFormatter
+
+    The default prepare formats the record and drops exc_info, which would put the
+    traceback in the message instead of its own field.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+# Records are queued by the handler and written by a background thread, the handler
+# only waits for the queue to drain when the invocation ends
+_queue = queue.Queue(-1)
+_sampler = SamplingFilter()
+_listener = None
+
+
+def configure():
+    """Routes the root logger through the queue, once per Lambda container"""
+
+    global _listener
+    if _listener:
+        return
+
+    Writer = logging.StreamHandler(sys.stdout)
+    Writer.setFormatter(JsonFormatter())
+    Handler = JsonQueueHandler(_queue)
+    Handler.addFilter(_sampler)
+    Handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(Handler)
+    root.setLevel(LOG_LEVEL)
+
+    _listener = logging.handlers.QueueListener(_queue, Writer)
+    _listener.start()
+
+
+def flush():
+    """Waits until every queued record is written"""
+
+    if _listener:
+        _queue.join()
+
+
+def logged(handler):
+    """Logs a handler's records as JSON tagged with its pipeline execution and builder,
+    sampled, redacted, and written in the background"""
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        configure()
+        logging.getLogger().setLevel(LOG_LEVEL)
+        Execution, Builder = correlation_ids(event)
+        bind(
+            Execution=Execution,
+            Builder=Builder,
+            RequestId=getattr(context, "aws_request_id", None),
+        )
+        try:
+            return handler(event, context)
+        finally:
+            Suppressed = _sampler.reset()
+            if Suppressed:
+                logging.getLogger().info("Sampling suppressed %s repetitive log records.", Suppressed)
+            flush()
+
+    return wrapper
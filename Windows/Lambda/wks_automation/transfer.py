@@ -0,0 +1,136 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import base64
+import gzip
+import hashlib
+import logging
+import time
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# cmd.exe rejects command lines over 8191 characters, leave room for the echo and path
+CHUNK_SIZE = 7800
+
+# Decodes and decompresses the staged chunks, then prints the SHA256 of the written file
+RESTORE_SCRIPT = """$ErrorActionPreference = 'Stop'
+$Staging = '{staging}'
+$Destination = '{destination}'
+$Bytes = [Convert]::FromBase64String([IO.File]::ReadAllText($Staging))
+$Compressed = New-Object IO.MemoryStream(,$Bytes)
+$Gzip = New-Object IO.Compression.GZipStream($Compressed, [IO.Compression.CompressionMode]::Decompress)
+$Folder = Split-Path -Path $Destination -Parent
+if ($Folder) {{ New-Item -Path $Folder -ItemType Directory -Force | Out-Null }}
+$Output = [IO.File]::Create($Destination)
+try {{ $Gzip.CopyTo($Output) }} finally {{ $Output.Close(); $Gzip.Close() }}
+Remove-Item -Path $Staging -Force
+(Get-FileHash -Path $Destination -Algorithm SHA256).Hash
+"""
+
+
+def encode_powershell(script):
+    """Encodes a PowerShell script for the -EncodedCommand argument
+
+    :param script: string
+    :return: string
+    """
+
+    return base64.b64encode(script.encode("utf-16-le")).decode("ascii")
+
+
+def run(protocol, shell_id, command, arguments):
+    """Runs one command in an open WinRM shell
+
+    :return: tuple of status code, standard output and standard error
+    """
+
+    command_id = protocol.run_command(shell_id, command, arguments)
+    try:
+        std_out, std_err, status_code = protocol.get_command_output(shell_id, command_id)
+    finally:
+        protocol.cleanup_command(shell_id, command_id)
+    return status_code, std_out, std_err
+
+
+def push_bytes(session, data, destination, staging_dir="C:\\wks_automation"):
+    """Writes data to a file on the image builder WorkSpace over WinRM
+
+    The data is gzip compressed and base64 encoded, appended to a staging file in chunks
+    that fit on a command line, then restored and checked against its SHA256. All
+    commands run in a single WinRM shell.
+
+    :param session: active pywinrm session
+    :param data: bytes
+    :param destination: string, full path of the file to write
+    :param staging_dir (optional): string, folder for the staging file
+    :return: dictionary with Verified, Size, Compressed, Chunks and Duration
+    """
+
+    StartTime = time.time()
+    Digest = hashlib.sha256(data).hexdigest().upper()
+    Encoded = base64.b64encode(gzip.compress(data, mtime=0)).decode("ascii")
+    Chunks = [Encoded[i:i + CHUNK_SIZE] for i in range(0, len(Encoded), CHUNK_SIZE)]
+    Staging = staging_dir.rstrip("\\") + "\\push_" + Digest[:16] + ".b64"
+    Result = {
+        "Verified": False,
+        "Size": len(data),
+        "Compressed": len(Encoded),
+        "Chunks": len(Chunks),
+    }
+
+    protocol = session.protocol
+    shell_id = protocol.open_shell()
+    try:
+        for number, chunk in enumerate(Chunks):
+            # The space before the redirection stops a trailing digit being read as a
+            # stream number, base64 decoding ignores it
+            status_code, std_out, std_err = run(
+                protocol,
+                shell_id,
+                "cmd",
+                ["/c", "echo", chunk, ">" if number == 0 else ">>", Staging],
+            )
+            if status_code != 0:
+                raise RuntimeError(std_err.decode("utf-8", "ignore").strip())
+
+        Script = RESTORE_SCRIPT.format(
+            staging=Staging.replace("'", "''"), destination=destination.replace("'", "''")
+        )
+        status_code, std_out, std_err = run(
+            protocol,
+            shell_id,
+            "powershell",
+            ["-NoProfile", "-NonInteractive", "-EncodedCommand", encode_powershell(Script)],
+        )
+        if status_code != 0:
+            raise RuntimeError(std_err.decode("utf-8", "ignore").strip())
+        Result["Verified"] = std_out.decode("utf-8", "ignore").strip().upper() == Digest
+        if not Result["Verified"]:
+            logger.error("SHA256 of %s does not match the content sent.", destination)
+    finally:
+        protocol.close_shell(shell_id)
+
+    Result["Duration"] = round(time.time() - StartTime, 3)
+    logger.info(
+        "Pushed %s bytes to %s as %s base64 characters in %s chunk(s).",
+        Result["Size"],
+        destination,
+        Result["Compressed"],
+        Result["Chunks"],
+    )
+    return Result
@@ -0,0 +1,374 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Change-driven build triggering.
+
+Build definitions are Step Function inputs saved as JSON objects under BUILDS_PREFIX in
+the installation source bucket. The index maps each S3 object and HTTP URL their
+install routines download or push to the definitions that use them. A change to one
+of them marks those builds pending, and a pending build starts once its artifacts have
+not changed for the debounce period, so uploads made together start each build once.
+"""
+
+import json
+import logging
+import re
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from botocore.exceptions import ClientError
+from wks_automation import aws_client
+from wks_automation.aws_client import is_throttling_error
+from wks_automation.routine import routine_artifacts, validate_routine
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Installation source bucket locations of the build definitions and the trigger state
+BUILDS_PREFIX = "wks_automation/builds/"
+INDEX_KEY = "wks_automation/triggers/index.json"
+PENDING_KEY = "wks_automation/triggers/pending.json"
+
+# A pending build starts after this long without another change to its artifacts, or
+# this long after the first change if changes keep arriving
+DEFAULT_DEBOUNCE_MINUTES = 15
+DEFAULT_MAX_WAIT_MINUTES = 120
+
+# Response headers that change when the file behind an HTTP URL changes
+HTTP_VALIDATORS = ("ETag", "Last-Modified", "Content-Length")
+
+# Characters not allowed in a Step Function execution name
+EXECUTION_NAME = re.compile(r"[^A-Za-z0-9_-]")
+
+
+def definition_routines(definition):
+    """Lists the install routines of a build definition, including layered builds
+
+    :param definition: dictionary, Step Function input
+    :return: list of install routines
+    """
+
+    Routines = [definition.get("InstallRoutine") or []]
+    Layers = definition.get("Layers") or {}
+    if Layers:
+        Routines.append(Layers.get("BaseRoutine") or [])
+        for child in Layers.get("Children") or []:
+            Routines.append(child.get("InstallRoutine") or [])
+    return Routines
+
+
+def definition_artifacts(definition):
+    """Lists the S3 objects and HTTP URLs a build definition downloads or pushes
+
+    :param definition: dictionary, Step Function input
+    :return: tuple of a sorted list of bucket/key strings and a sorted list of URLs
+    """
+
+    S3Objects = set()
+    Urls = set()
+    for Routine in definition_routines(definition):
+        if validate_routine(Routine):
+            logger.error("Skipping install routine that does not validate.")
+            continue
+        Objects, Links = routine_artifacts(Routine)
+        S3Objects.update(bucket + "/" + key for bucket, key in Objects)
+        Urls.update(Links)
+    return sorted(S3Objects), sorted(Urls)
+
+
+def build_index(definitions):
+    """Maps each artifact to the build definitions that use it
+
+    :param definitions: dictionary of definition name to Step Function input
+    :return: dictionary with Objects and Urls, each mapping an artifact to names
+    """
+
+    Index = {"Objects": {}, "Urls": {}}
+    for Name, Definition in sorted(definitions.items()):
+        Objects, Urls = definition_artifacts(Definition)
+        for location in Objects:
+            Index["Objects"].setdefault(location, []).append(Name)
+        for url in Urls:
+            Index["Urls"].setdefault(url, []).append(Name)
+    return Index
+
+
+def s3_changes(event):
+    """Reads the changed objects from an EventBridge S3 event or S3 event notification
+
+    :param event: dictionary
+    :return: list of dictionaries with Object (bucket/key) and Deleted
+    """
+
+    Changes = []
+    if event.get("source") == "aws.s3":
+        Changes.append(
+            {
+                "Object": event["detail"]["bucket"]["name"] + "/" + event["detail"]["object"]["key"],
+                "Deleted": event.get("detail-type") == "Object Deleted",
+            }
+        )
+    for record in event.get("Records", []):
+        if record.get("eventSource") == "aws:s3":
+            # Keys in S3 event notifications are URL encoded
+            Changes.append(
+                {
+                    "Object": record["s3"]["bucket"]["name"] + "/"
+                    + urllib.parse.unquote_plus(record["s3"]["object"]["key"]),
+                    "Deleted": record["eventName"].startswith("ObjectRemoved"),
+                }
+            )
+    return Changes
+
+
+def http_validators(url, timeout=10):
+    """Reads the headers that identify the current version of the file behind a URL
+
+    :param url: string
+    :param timeout: integer seconds
+    :return: dictionary of header values, or None if the URL could not be reached
+    """
+
+    request = urllib.request.Request(url, method="HEAD")
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:  # nosec B310
+            return {header: response.headers.get(header) for header in HTTP_VALIDATORS}
+    except (urllib.error.URLError, OSError) as e:
+        logger.error("Unable to check %s: %s", url, e)
+        return None
+
+
+def execution_name(definition_name, now):
+    """Names a triggered execution after its build definition
+
+    :param definition_name: string
+    :param now: epoch time
+    :return: string, at most 80 characters
+    """
+
+    return EXECUTION_NAME.sub("-", definition_name)[:60] + "-" + time.strftime("%Y%m%d%H%M%S", time.gmtime(now))
+
+
+class S3TriggerStore:
+    """Reads build definitions and keeps the index and pending builds as JSON objects
+    in the installation source bucket"""
+
+    def __init__(self, bucket, s3_client=None):
+        self.bucket = bucket
+        self.s3_client = s3_client or aws_client.client("s3")
+
+    def definitions(self):
+        """Returns all build definitions as a dictionary of name to Step Function input"""
+
+        Definitions = {}
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=BUILDS_PREFIX):
+            for item in page.get("Contents", []):
+                if item["Key"].endswith(".json"):
+                    Name = item["Key"][len(BUILDS_PREFIX):-len(".json")]
+                    Definitions[Name] = self.definition(Name)
+        return Definitions
+
+    def definition(self, name):
+        """Returns one build definition, or None if it was removed"""
+
+        return self.load(BUILDS_PREFIX + name + ".json", None)
+
+    def load(self, key, default):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=key)
+        except ClientError as error:
+            if error.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return default
+            raise
+        return json.loads(response["Body"].read())
+
+    def save(self, key, value):
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=key,
+            Body=json.dumps(value, indent=1).encode("utf-8"),
+            ContentType="application/json",
+        )
+
+
+class LocalTriggerStore:
+    """In-memory stand-in for S3TriggerStore, for local runs and tests"""
+
+    def __init__(self, definitions=None):
+        self.objects = {}
+        for name, definition in (definitions or {}).items():
+            self.objects[BUILDS_PREFIX + name + ".json"] = definition
+
+    def definitions(self):
+        return {
+            key[len(BUILDS_PREFIX):-len(".json")]: value
+            for key, value in self.objects.items()
+            if key.startswith(BUILDS_PREFIX)
+        }
+
+    def definition(self, name):
+        return self.objects.get(BUILDS_PREFIX + name + ".json")
+
+    def load(self, key, default):
+        return json.loads(json.dumps(self.objects[key])) if key in self.objects else default
+
+    def save(self, key, value):
+        self.objects[key] = json.loads(json.dumps(value))
+
+
+class BuildTrigger:
+    """Starts the builds whose artifacts changed.
+
+    Changes are collected into pending builds, keyed by definition name, so a burst of
+    uploads to the artifacts of one build starts it once. Callers must not run
+    concurrently, the pending builds are read and written back without locking.
+    """
+
+    def __init__(
+        self,
+        store,
+        state_machine_arn=None,
+        debounce_minutes=DEFAULT_DEBOUNCE_MINUTES,
+        max_wait_minutes=DEFAULT_MAX_WAIT_MINUTES,
+        sfn_client=None,
+    ):
+        self.store = store
+        self.state_machine_arn = state_machine_arn
+        self.debounce = float(debounce_minutes) * 60
+        self.max_wait = float(max_wait_minutes) * 60
+        self.sfn_client = sfn_client or aws_client.client("stepfunctions")
+
+    def reindex(self):
+        """Rebuilds the index from the build definitions, keeping the last seen
+        version of each HTTP URL
+
+        :return: dictionary, the index
+        """
+
+        Previous = self.store.load(INDEX_KEY, {})
+        Index = build_index(self.store.definitions())
+        Known = Previous.get("Validators", {})
+        Index["Validators"] = {url: Known[url] for url in Index["Urls"] if url in Known}
+        self.store.save(INDEX_KEY, Index)
+        logger.info(
+            "Indexed %s S3 object(s) and %s URL(s).", len(Index["Objects"]), len(Index["Urls"])
+        )
+        return Index
+
+    def index(self):
+        Index = self.store.load(INDEX_KEY, None)
+        return Index if Index is not None else self.reindex()
+
+    def record(self, artifacts, now=None):
+        """Marks the builds that use the changed artifacts as pending
+
+        :param artifacts: list of changed bucket/key strings or URLs
+        :param now (optional): epoch time of the change
+        :return: sorted list of affected definition names
+        """
+
+        now = time.time() if now is None else now
+        Index = self.index()
+        Pending = self.store.load(PENDING_KEY, {})
+        Affected = set()
+        for artifact in artifacts:
+            for name in Index["Objects"].get(artifact, []) + Index["Urls"].get(artifact, []):
+                Entry = Pending.setdefault(name, {"FirstChange": now, "Changes": []})
+                Entry["LastChange"] = now
+                if artifact not in Entry["Changes"]:
+                    Entry["Changes"].append(artifact)
+                Affected.add(name)
+        if Affected:
+            self.store.save(PENDING_KEY, Pending)
+            logger.info("Builds pending after artifact changes: %s.", ", ".join(sorted(Affected)))
+        return sorted(Affected)
+
+    def check_urls(self, now=None):
+        """Checks whether the files behind the indexed HTTP URLs changed since the last
+        check, and marks the builds that use them as pending. The first check of a URL
+        only records its version.
+
+        :param now (optional): epoch time
+        :return: list of changed URLs
+        """
+
+        Index = self.index()
+        Changed = []
+        for url in Index["Urls"]:
+            Validators = http_validators(url)
+            if Validators is None:
+                continue
+            if not any(Validators.values()):
+                logger.info("%s has no version headers, changes cannot be detected.", url)
+                continue
+            if url in Index["Validators"] and Index["Validators"][url] != Validators:
+                logger.info("%s changed.", url)
+                Changed.append(url)
+            Index["Validators"][url] = Validators
+        self.store.save(INDEX_KEY, Index)
+        self.record(Changed, now)
+        return Changed
+
+    def due(self, Pending, now):
+        """Returns the names of pending builds whose debounce period has passed"""
+
+        return sorted(
+            name
+            for name, entry in Pending.items()
+            if now - entry["LastChange"] >= self.debounce or now - entry["FirstChange"] >= self.max_wait
+        )
+
+    def flush(self, now=None):
+        """Starts the pending builds that are due
+
+        :param now (optional): epoch time
+        :return: dictionary with Started (definition name to execution ARN) and Waiting
+        """
+
+        now = time.time() if now is None else now
+        Pending = self.store.load(PENDING_KEY, {})
+        Due = self.due(Pending, now)
+        Started = {}
+        if not Due:
+            return {"Started": Started, "Waiting": sorted(Pending)}
+
+        try:
+            for name in Due:
+                Definition = self.store.definition(name)
+                if Definition is None:
+                    logger.info("Build definition %s was removed, dropping it.", name)
+                    del Pending[name]
+                    continue
+
+                response = self.sfn_client.start_execution(
+                    stateMachineArn=self.state_machine_arn,
+                    name=execution_name(name, now),
+                    input=json.dumps(Definition),
+                )
+                logger.info("Started build %s for changes to %s.", name, ", ".join(Pending[name]["Changes"]))
+                Started[name] = response["executionArn"]
+                del Pending[name]
+        except Exception as e:
+            logger.error(e)
+            if is_throttling_error(e):
+                raise
+            logger.info("Unable to start every due build, the rest stay pending.")
+        finally:
+            self.store.save(PENDING_KEY, Pending)
+        return {"Started": Started, "Waiting": sorted(Pending)}